@@ -0,0 +1,427 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for caching results computed from the
+             Elasticsearch database between index reloads.
+"""
+import os
+import time
+import fcntl
+import pickle
+import asyncio
+import hashlib
+from collections import Counter, OrderedDict
+
+
+# Marks a key absent from the shared store, as None can be a cached value
+MISSING = object()
+
+
+class Generation:
+    """
+    A counter identifying the version of the data held in the index.
+    Backed by a file, the counter is shared by every process of the host.
+
+    Attributes:
+        value (int): The current generation, bumped on every data load.
+    """
+    def __init__(self, path=None):
+        """
+        Args:
+            path (str): The file holding the counter, None to keep it in memory.
+        """
+        self._path = path
+        self._value = 0
+        self._version = None
+
+    @property
+    def value(self):
+        """
+        Read the current generation.
+
+        Returns:
+            (int): The generation, 0 until the data is first loaded.
+        """
+        if self._path is None:
+            return self._value
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            return 0
+        # Only read the file again once another process has replaced it
+        if (stat.st_ino, stat.st_mtime_ns) != self._version:
+            try:
+                with open(self._path, encoding='ascii') as file:
+                    stat = os.fstat(file.fileno())
+                    self._value = int(file.read())
+            except FileNotFoundError:
+                return 0
+            self._version = (stat.st_ino, stat.st_mtime_ns)
+        return self._value
+
+    def bump(self):
+        """
+        Mark the index data as changed.
+
+        Returns:
+            (int): The new generation.
+        """
+        if self._path is None:
+            self._value += 1
+            return self._value
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        # Bumps take turns through a separate lock file, while the counter
+        # itself is replaced atomically so readers never see it half written
+        with open(self._path + '.lock', 'wb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self._path, encoding='ascii') as file:
+                    value = int(file.read()) + 1
+            except FileNotFoundError:
+                value = 1
+            temp_path = f"{self._path}.{os.getpid()}"
+            with open(temp_path, 'w', encoding='ascii') as file:
+                file.write(str(value))
+            os.replace(temp_path, self._path)
+        return value
+
+
+class SharedStore:
+    """
+    A directory of pickled cache entries, shared by the worker processes
+    of a host so a value is computed once per host rather than per worker.
+    Pointed at /dev/shm, the entries never leave memory.
+
+    Attributes:
+        directory (str): The directory holding the entries.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get(self, key, generation):
+        """
+        Read the value of a key, if it is still valid.
+
+        Args:
+            key (Hashable): The cache key.
+            generation (int): The current index generation.
+
+        Returns:
+            (Any): The value, or MISSING if it is absent, expired or stale.
+        """
+        try:
+            with open(self._path(key), 'rb') as file:
+                expires, stored_generation, value = pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return MISSING
+        if expires <= time.time() or stored_generation != generation:
+            return MISSING
+        return value
+
+    def set(self, key, value, ttl, generation):
+        """
+        Write the value of a key, replacing it atomically.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The picklable value.
+            ttl (float): Seconds the value stays valid for.
+            generation (int): The index generation the value was computed at.
+
+        Returns:
+            None
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}"
+        with open(temp_path, 'wb') as file:
+            pickle.dump((time.time() + ttl, generation, value), file)
+        os.replace(temp_path, path)
+
+    def lock(self, key):
+        """
+        Block until this process holds the lock on computing a key.
+
+        Args:
+            key (Hashable): The cache key.
+
+        Returns:
+            (BinaryIO): The lock file, released by closing it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # The lock is held until the caller closes the file, so it outlives
+        # this call and cannot be opened in a with block here
+        file = open(self._path(key) + '.lock', 'wb')  # pylint: disable=consider-using-with
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return file
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest)
+
+
+class ExpiringLRU:
+    """
+    The entries of a cache, which expire after a fixed time and are evicted
+    least recently used first beyond a number of entries or a total size.
+
+    Attributes:
+        ttl (float): Seconds an entry stays valid for.
+        maxsize (int): Maximum number of entries held at once.
+        maxbytes (int): Maximum total size of the values held, None for no limit.
+        nbytes (int): The total size of the values held.
+    """
+    def __init__(self, ttl, maxsize, maxbytes=None, sizeof=None, clock=time.monotonic):
+        """
+        Args:
+            ttl (float): Seconds an entry stays valid for.
+            maxsize (int): Maximum number of entries held at once.
+            maxbytes (int): Maximum total size of the values held.
+            sizeof (Callable): Returns the size of a value in bytes, needed
+                for maxbytes. Values are counted as empty without it.
+            clock (Callable): Returns the current time in seconds.
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._sizeof = sizeof or (lambda value: 0)
+        self._clock = clock
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Return the value of a key, marking it as the most recently used.
+
+        Args:
+            key (Hashable): The cache key.
+
+        Returns:
+            (Any): The value, or MISSING if it is absent or expired.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self._clock():
+            return MISSING
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        """
+        Hold the value of a key, evicting the least recently used entries
+        beyond the limits.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value.
+
+        Returns:
+            None
+        """
+        nbytes = self._sizeof(value)
+        self.discard(key)
+        # A value over the whole budget would only evict everything else
+        if self.maxbytes is not None and nbytes > self.maxbytes:
+            return
+        self._entries[key] = (self._clock() + self.ttl, value, nbytes)
+        self.nbytes += nbytes
+        while len(self._entries) > self.maxsize or (
+                self.maxbytes is not None and self.nbytes > self.maxbytes):
+            self.nbytes -= self._entries.popitem(last=False)[1][2]
+
+    def discard(self, key):
+        """
+        Drop the value of a key, if held.
+
+        Args:
+            key (Hashable): The cache key.
+
+        Returns:
+            None
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def clear(self):
+        """
+        Drop every entry.
+
+        Returns:
+            None
+        """
+        self._entries.clear()
+        self.nbytes = 0
+
+
+class TTLCache:
+    """
+    An LRU cache whose entries expire after a fixed time, and are all
+    dropped whenever the index generation changes. Concurrent misses
+    on the same key share a single computation, and with a shared store,
+    so do misses in the other workers of the host. Given a way to size
+    values, the cache is bounded by memory as well as by entries.
+    How much load it takes off the database is reported by stats.
+    """
+    def __init__(self, ttl, maxsize, generation=None, store=None, **limits):
+        """
+        Args:
+            ttl (float): Seconds an entry stays valid for.
+            maxsize (int): Maximum number of entries held at once.
+            generation (Generation): The index generation, a private one if None.
+            store (SharedStore): Where to share values with other workers.
+            **limits: The maxbytes, sizeof and clock of the entries, see ExpiringLRU.
+        """
+        self._entries = ExpiringLRU(ttl, maxsize, **limits)
+        # Lookups answered from the cache, computing the value, waiting on
+        # another in-flight miss, and misses answered from the shared store
+        self._counts = Counter(hits=0, misses=0, coalesced=0, shared_hits=0)
+        self._store = store
+        self._generation = generation or Generation()
+        self._seen_generation = self._generation.value
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get_or_set(self, key, factory):
+        """
+        Return the cached value for the key, computing it on a miss.
+
+        Args:
+            key (Hashable): The cache key.
+            factory (Callable): Coroutine function producing the value.
+
+        Returns:
+            (Any): The cached or freshly computed value.
+        """
+        value = self._lookup(key)
+        if value is not MISSING:
+            return value
+
+        # Only the first miss runs the factory, the rest wait on its task
+        task = self._pending.get(key)
+        if task is None:
+            self._counts['misses'] += 1
+            task = asyncio.ensure_future(self._fill(key, factory))
+            self._pending[key] = task
+        else:
+            self._counts['coalesced'] += 1
+        # Shielded so a cancelled request does not cancel the shared work
+        return await asyncio.shield(task)
+
+    def get(self, key):
+        """
+        Return the cached value for the key, without computing it on a miss.
+        Lets a caller compute the value in a task it may cancel, unlike the
+        computation shared by get_or_set.
+
+        Args:
+            key (Hashable): The cache key.
+
+        Returns:
+            (Any): The cached value, or MISSING if it is absent or expired.
+        """
+        value = self._lookup(key)
+        if value is MISSING:
+            self._counts['misses'] += 1
+        return value
+
+    def set(self, key, value, generation):
+        """
+        Cache a value computed by the caller after a miss.
+
+        Args:
+            key (Hashable): The cache key.
+            value (Any): The value.
+            generation (int): The index generation read before computing it,
+                so a value computed against data that has since changed is dropped.
+
+        Returns:
+            None
+        """
+        if generation == self._generation.value:
+            self._check_generation()
+            self._entries.put(key, value)
+
+    def invalidate(self):
+        """
+        Drop every cached entry.
+
+        Returns:
+            None
+        """
+        self._entries.clear()
+
+    def stats(self):
+        """
+        Summarize how much load the cache is taking off the database.
+
+        Returns:
+            (dict): The cache counters and settings.
+        """
+        counts = self._counts
+        lookups = counts['hits'] + counts['misses'] + counts['coalesced']
+        return {
+            **counts,
+            'hit_ratio': (counts['hits'] + counts['coalesced']) / lookups if lookups else 0.0,
+            'size': len(self._entries),
+            'maxsize': self._entries.maxsize,
+            'nbytes': self._entries.nbytes,
+            'maxbytes': self._entries.maxbytes,
+            'ttl': self._entries.ttl,
+            'generation': self._generation.value
+        }
+
+    async def _fill(self, key, factory):
+        generation = self._generation.value
+        try:
+            if self._store is None:
+                value = await factory()
+            else:
+                value = await self._fill_shared(key, factory, generation)
+        finally:
+            self._pending.pop(key, None)
+        # Never store a value computed against data that has since changed
+        if generation == self._generation.value:
+            self._check_generation()
+            self._entries.put(key, value)
+        return value
+
+    def _lookup(self, key):
+        self._check_generation()
+        value = self._entries.get(key)
+        if value is not MISSING:
+            self._counts['hits'] += 1
+        return value
+
+    async def _fill_shared(self, key, factory, generation):
+        value = self._store.get(key, generation)
+        if value is MISSING:
+            # Only one worker computes the value, the others wait to read it
+            loop = asyncio.get_running_loop()
+            lock = await loop.run_in_executor(None, self._store.lock, key)
+            try:
+                value = self._store.get(key, generation)
+                if value is MISSING:
+                    value = await factory()
+                    self._store.set(key, value, self._entries.ttl, generation)
+                    return value
+            finally:
+                lock.close()
+        self._counts['shared_hits'] += 1
+        return value
+
+    def _check_generation(self):
+        if self._seen_generation != self._generation.value:
+            self._seen_generation = self._generation.value
+            self.invalidate()
+
+
+# Caches are shared between the workers of a host through this directory,
+# and kept per process if it is not set
+CACHE_DIR = os.environ.get('CACHE_DIR')
+
+# Shared by every cache, bumped whenever new data is written to the index
+index_generation = Generation(os.path.join(CACHE_DIR, 'generation') if CACHE_DIR else None)
@@ -0,0 +1,236 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for computing the catalogue aggregations
+             over NumPy columns, without a round trip to Elasticsearch.
+"""
+import numpy as np
+from memory import as_list, date_key
+
+
+# The keyword columns and the build_aggs flags and aggregations they serve
+KEYWORD_AGGS = {'directors': ('director', 'director_agg'),
+                'actors': ('cast', 'actor_agg'),
+                'genres': ('genres', 'genre_agg'),
+                'countries': ('country', 'country_agg')}
+# The interval and minimum count of the duration histogram, as in build_aggs
+HISTOGRAM_INTERVAL = 20
+HISTOGRAM_MIN_COUNT = 10
+# The number of buckets of each terms aggregation, as in build_aggs
+TOP_SIZE = 5
+
+
+class KeywordColumn:
+    """
+    A dictionary-encoded keyword column, stored as one (document, code)
+    pair per distinct value of each document so multi-valued fields
+    count each document once, like a terms aggregation.
+
+    Attributes:
+        vocabulary (np.ndarray): The distinct values, sorted so that codes
+            order like the values themselves.
+        owners (np.ndarray): The document of each pair.
+        codes (np.ndarray): The value code of each pair.
+    """
+    def __init__(self, values):
+        """
+        Args:
+            values (list): The value, or list of values, of each document.
+        """
+        vocabulary = sorted({item for value in values for item in as_list(value)})
+        lookup = {item: code for code, item in enumerate(vocabulary)}
+        owners, codes = [], []
+        for doc, value in enumerate(values):
+            for code in sorted({lookup[item] for item in as_list(value)}):
+                owners.append(doc)
+                codes.append(code)
+        self.vocabulary = np.array(vocabulary, dtype=object)
+        self.owners = np.array(owners, dtype=np.int32)
+        self.codes = np.array(codes, dtype=np.int32)
+
+    def counts(self, mask):
+        """
+        Count the documents of each value among the selected documents.
+
+        Args:
+            mask (np.ndarray): Whether each document is selected.
+
+        Returns:
+            (np.ndarray): The document count of each value of the vocabulary.
+        """
+        return np.bincount(self.codes[mask[self.owners]], minlength=len(self.vocabulary))
+
+    def top(self, mask, size=TOP_SIZE):
+        """
+        Find the most common values among the selected documents.
+
+        Args:
+            mask (np.ndarray): Whether each document is selected.
+            size (int): The number of buckets to return.
+
+        Returns:
+            (list[dict]): The most common values and their document counts.
+        """
+        return top_buckets(self.counts(mask), self.vocabulary, size)
+
+
+def top_buckets(counts, keys, size):
+    """
+    Build terms buckets ordered like Elasticsearch, by descending count
+    and then ascending key.
+
+    Args:
+        counts (np.ndarray): The document count of each key.
+        keys (Sequence): The keys, in ascending order.
+        size (int): The number of buckets to return.
+
+    Returns:
+        (list[dict]): The buckets with a document count.
+    """
+    if len(counts) > size:
+        # Only keys tied with or above the size-th largest count can make the cut
+        threshold = np.partition(counts, len(counts) - size)[len(counts) - size]
+        candidates = np.flatnonzero(counts >= max(threshold, 1))
+    else:
+        candidates = np.arange(len(counts))
+    # A stable sort keeps ties in ascending key order
+    order = candidates[np.argsort(-counts[candidates], kind='stable')][:size]
+    return [{'key': keys[i], 'doc_count': int(counts[i])} for i in order if counts[i]]
+
+
+class ColumnarAggs:
+    """
+    The catalogue held as NumPy columns, answering any combination of the
+    build_aggs aggregations with vectorized counts. Missing numbers are
+    stored as the smallest value of their type, so the -1 of an unknown
+    type or rating is counted like any other value, as Elasticsearch does.
+
+    Attributes:
+        type (np.ndarray): The int8 film type of each document.
+        rating (np.ndarray): The int8 rating ID of each document.
+        duration (np.ndarray): The duration of each document.
+        release_year (np.ndarray): The release year of each document.
+        date_added (np.ndarray): The date added of each document, as yyyyMMdd.
+        keywords (dict[str, KeywordColumn]): The keyword columns, by field.
+    """
+    def __init__(self, sources):
+        """
+        Args:
+            sources (list[dict]): The processed source of each document.
+        """
+        def column(field, dtype, convert=lambda value: value):
+            return np.array([np.iinfo(dtype).min if source.get(field) is None
+                             else convert(source[field]) for source in sources], dtype=dtype)
+
+        self.type = column('type', np.int8)
+        self.rating = column('rating', np.int8)
+        self.duration = column('duration', np.int16)
+        self.release_year = column('release_year', np.int16)
+        self.date_added = column('date_added', np.int32, date_key)
+        self.keywords = {field: KeywordColumn([source.get(field) for source in sources])
+                         for field, _ in KEYWORD_AGGS.values()}
+
+    def __len__(self):
+        return len(self.type)
+
+    @classmethod
+    def from_rows(cls, actions):
+        """
+        Build the columns from bulk index actions.
+
+        Args:
+            actions (Iterable[dict]): Bulk index actions, as built by get_row.
+
+        Returns:
+            (ColumnarAggs): The columns of the actions.
+        """
+        return cls([action['_source'] for action in actions])
+
+    def select(self, film_type=None, release_year=None, date_added=None):
+        """
+        Select the documents matching the given filters.
+
+        Args:
+            film_type (int): The film type to keep, 1 for movies and 0 for shows.
+            release_year (dict): A range query on the release year, with
+                any of the gte, gt, lte and lt bounds.
+            date_added (dict): A range query on the date added, with dates in
+                the 'MMddyyyy' or 'yyyy-MM-dd' format.
+
+        Returns:
+            (np.ndarray): Whether each document is selected.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if film_type is not None:
+            mask &= self.type == film_type
+        if release_year:
+            mask &= within(self.release_year, release_year)
+        if date_added:
+            mask &= within(self.date_added, {op: date_key(bound)
+                                             for op, bound in date_added.items()})
+        return mask
+
+    def aggregate(self, film_type=None, release_year=None, date_added=None, **kwargs):
+        """
+        Compute the aggregations requested by build_aggs flags, shaped
+        like the aggregations of an Elasticsearch response.
+
+        Args:
+            film_type (int): The film type to keep, 1 for movies and 0 for shows.
+            release_year (dict): A range query on the release year.
+            date_added (dict): A range query on the date added.
+            **kwargs: The build_aggs flags of the aggregations to include.
+
+        Returns:
+            (dict): The aggregations, keyed like those built by build_aggs.
+        """
+        mask = self.select(film_type, release_year, date_added)
+        aggs = {'total_agg': {'value': int(np.count_nonzero(mask & present(self.type)))}}
+
+        durations = self.duration[mask & present(self.duration)]
+        if kwargs.get('avg_duration', False):
+            aggs['avg_dur_agg'] = {'value': float(durations.mean()) if durations.size else None}
+        if kwargs.get('histo_duration', False):
+            counts = np.bincount(durations // HISTOGRAM_INTERVAL)
+            aggs['histo_dur_agg'] = {'buckets': [
+                {'key': float(bucket * HISTOGRAM_INTERVAL), 'doc_count': int(count)}
+                for bucket, count in enumerate(counts) if count >= HISTOGRAM_MIN_COUNT]}
+        for flag, (field, name) in KEYWORD_AGGS.items():
+            if kwargs.get(flag, False):
+                aggs[name] = {'buckets': self.keywords[field].top(mask)}
+        if kwargs.get('ratings', False):
+            keys, counts = np.unique(self.rating[mask & present(self.rating)],
+                                     return_counts=True)
+            aggs['rating_agg'] = {'buckets': top_buckets(counts, keys.tolist(), TOP_SIZE)}
+        return aggs
+
+
+def present(values):
+    """
+    Check which values of a column are present.
+
+    Args:
+        values (np.ndarray): The values, the smallest of their type where missing.
+
+    Returns:
+        (np.ndarray): Whether each value is present.
+    """
+    return values != np.iinfo(values.dtype).min
+
+
+def within(values, bounds):
+    """
+    Check which values are present and within a range query's bounds.
+
+    Args:
+        values (np.ndarray): The values, the smallest of their type where missing.
+        bounds (dict): The gte, gt, lte and lt bounds of the range.
+
+    Returns:
+        (np.ndarray): Whether each value is within the range.
+    """
+    mask = present(values)
+    for op, compare in (('gte', np.greater_equal), ('gt', np.greater),
+                        ('lte', np.less_equal), ('lt', np.less)):
+        if bounds.get(op) is not None:
+            mask &= compare(values, bounds[op])
+    return mask
@@ -4,36 +4,170 @@ Description: This module is for initializing and loading
              data into the Elasticsearch database.
 """
 import os
-import csv
-import re
-from datetime import datetime
+import json
+import time
+import asyncio
+import socket
+import itertools
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext, asynccontextmanager, closing
+from datetime import datetime, timezone
 from ssl import create_default_context
-from unidecode import unidecode as ud
-from elasticsearch import AsyncElasticsearch
+from elastic_transport import AiohttpHttpNode
+from elasticsearch import AsyncElasticsearch, TransportError, ApiError, ConflictError
 from elasticsearch.helpers import async_bulk
-from schemas import ELASTIC_MAP, RATING_TO_ID
+from schemas import ELASTIC_MAP, ELASTIC_SETTINGS, RATING_TO_ID
+from cache import index_generation
+from transform import filter_text, fingerprint, transform_columns
+from sources import read_chunks, Checkpoint
+from snapshot import open_snapshot
+from memory import MemoryElasticsearch
+from metrics import (INGEST_ROWS, INGEST_BYTES, INGEST_ERRORS, INGEST_SECONDS,
+                     INGEST_ROWS_PER_SECOND)
+
+
+logger = logging.getLogger(__name__)
+
+
+def env_flag(name, default=True):
+    """
+    Read a boolean setting from the environment.
+
+    Args:
+        name (str): The name of the environment variable.
+        default (bool): The value used when the variable is not set.
+
+    Returns:
+        (bool): False if the variable is set to '0', 'false' or 'no', else True.
+    """
+    return os.environ.get(name, str(default)).lower() not in {'0', 'false', 'no'}
+
+
+class MeteredNode(AiohttpHttpNode):
+    """
+    An HTTP node counting its requests in flight, to tell how close
+    the connection pool is to running out of connections.
+
+    Attributes:
+        in_flight (int): The requests currently waiting on the node.
+        peak (int): The most requests in flight at once.
+        requests (int): The requests sent through the node.
+    """
+    def __init__(self, config):
+        super().__init__(config)
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+
+    async def perform_request(self, *args, **kwargs):
+        """
+        Send a request, counting it while it is in flight.
+
+        Returns:
+            (NodeApiResponse): The response of the node.
+        """
+        self.in_flight += 1
+        self.requests += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            return await super().perform_request(*args, **kwargs)
+        finally:
+            self.in_flight -= 1
 
 
 def get_elastic_db():
     """
     Establish and return a connection from a pool of Elasticsearch database instances.
+    With SEARCH_BACKEND set to 'memory', an in-process engine is returned instead.
 
     Returns:
-        (AsyncElasticsearch): Database connection instance.
+        (AsyncElasticsearch | MemoryElasticsearch): Database connection instance.
     """
+    if os.environ.get('SEARCH_BACKEND', 'elasticsearch').lower() == 'memory':
+        return MemoryElasticsearch(os.environ.get('ELASTIC_INDEX', 'memory'))
+
     context = create_default_context(cafile=os.environ['ESDB_CERT'])
+    # Sniffing finds the other nodes of a cluster, but is off for a single node
+    sniff = env_flag('ELASTIC_SNIFF', False)
     esdb = AsyncElasticsearch(hosts=f"https://esdb:{os.environ['ELASTIC_PORT']}",
                             basic_auth=(os.environ['ELASTIC_USERNAME'],
                                         os.environ['ELASTIC_PASSWORD']),
-                            ssl_context=context)
+                            ssl_context=context,
+                            node_class=MeteredNode,
+                            connections_per_node=int(os.environ.get('ELASTIC_POOL_SIZE', 32)),
+                            request_timeout=float(os.environ.get('ELASTIC_REQUEST_TIMEOUT', 10)),
+                            max_retries=int(os.environ.get('ELASTIC_MAX_RETRIES', 3)),
+                            retry_on_timeout=env_flag('ELASTIC_RETRY_ON_TIMEOUT'),
+                            http_compress=env_flag('ELASTIC_HTTP_COMPRESS'),
+                            sniff_on_start=sniff,
+                            sniff_on_node_failure=sniff,
+                            min_delay_between_sniffing=60)
 
     return esdb
 
 
+async def wait_for_elastic_db(esdb, attempts=None, delay=0.5, max_delay=10.0):
+    """
+    Wait for the Elasticsearch database to answer, retrying with
+    exponential backoff so the API does not start before it.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        attempts (int): The number of pings before giving up, defaults
+            to ELASTIC_STARTUP_ATTEMPTS.
+        delay (float): The seconds to wait after the first failed ping,
+            doubled after every other one.
+        max_delay (float): The longest wait between two pings.
+
+    Returns:
+        None
+    """
+    if attempts is None:
+        attempts = int(os.environ.get('ELASTIC_STARTUP_ATTEMPTS', 10))
+    for attempt in range(1, attempts + 1):
+        try:
+            if await esdb.ping():
+                return
+        except TransportError as exc:
+            logger.warning("Elasticsearch ping failed: %s", exc)
+        if attempt < attempts:
+            logger.info("Elasticsearch not ready, retrying in %.1fs", delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)
+    raise RuntimeError(f"Elasticsearch was not ready after {attempts} attempts")
+
+
+def get_pool_stats(esdb):
+    """
+    Report how saturated the connection pool of each node is.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+
+    Returns:
+        (list[dict]): The requests in flight against the pool size of each node.
+    """
+    if isinstance(esdb, MemoryElasticsearch):
+        return []
+    stats = []
+    for node in esdb.transport.node_pool.all():
+        in_flight = getattr(node, 'in_flight', 0)
+        limit = node.config.connections_per_node
+        stats.append({'node': node.base_url,
+                      'in_flight': in_flight,
+                      'peak': getattr(node, 'peak', 0),
+                      'requests': getattr(node, 'requests', 0),
+                      'pool_size': limit,
+                      'saturation': in_flight / limit})
+    return stats
+
+
 async def init_elastic_db(esdb):
     """
     Initialize the Elasticsearch database with the
-    given connection instance.
+    given connection instance. Safe to call from several
+    workers or hosts at once, as they take turns.
     
     Args:
         esdb (AsyncElasticsearch): Database connection instance.
@@ -41,15 +175,263 @@ async def init_elastic_db(esdb):
     Returns:
         None
     """
-    # Create elasticsearch index if DNE
-    if not await esdb.indices.exists(index=os.environ['ELASTIC_INDEX']):
-        # Explicit mappings
-        await esdb.indices.create(index=os.environ['ELASTIC_INDEX'], mappings=ELASTIC_MAP)
+    alias = os.environ['ELASTIC_INDEX']
+    if isinstance(esdb, MemoryElasticsearch):
+        # Nothing persists in memory, so the CSV file is always loaded
+        esdb.load(get_row('datasets/netflix.csv', alias))
+        index_generation.bump()
+        return
+
+    # Loading can instead be left to the ingestion CLI
+    load = env_flag('INGEST_ON_STARTUP')
+
+    # Every worker initializes on startup, but only one at a time loads data
+    async with init_lock(esdb, alias):
+        if await esdb.indices.exists_alias(name=alias):
+            # If no data is in the index, load in the CSV file
+            num_docs = await esdb.count(index=alias)
+            if not load or num_docs['count'] > 0:
+                return
+        elif await esdb.indices.exists(index=alias):
+            # A concrete index from before versioning, replaced by reloading it
+            if not load:
+                return
+        elif not load:
+            # Queries need the alias to exist, even without any data
+            await swap_alias(esdb, alias, await create_index(esdb, alias))
+            return
+
+        await reindex(esdb, 'datasets/netflix.csv', alias)
+
+
+@asynccontextmanager
+async def init_lock(esdb, alias, ttl=None, poll=1.0):
+    """
+    Hold the lock on initializing an alias, kept as a document in the
+    Elasticsearch database so it is shared by every worker and host.
+    A lock outliving its TTL is taken to belong to a crashed holder.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias being initialized.
+        ttl (float): Seconds the lock is held for at most, defaults to
+            INIT_LOCK_TTL.
+        poll (float): Seconds between attempts to take a held lock.
+
+    Returns:
+        (AsyncGenerator): The context holding the lock.
+    """
+    # Named so that it is not mistaken for a version of the alias
+    index = f"{alias}_locks"
+    ttl = ttl or float(os.environ.get('INIT_LOCK_TTL', 3600))
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    await esdb.options(ignore_status=400).indices.create(index=index)
+
+    while True:
+        try:
+            lock = await esdb.create(index=index, id='init', refresh=True,
+                                     document={'owner': owner, 'expires': time.time() + ttl})
+            break
+        except ConflictError:
+            lock = await esdb.options(ignore_status=404).get(index=index, id='init')
+            if lock['found'] and lock['_source']['expires'] < time.time():
+                logger.warning("Taking over the expired lock of %s", lock['_source']['owner'])
+                # Conditional, in case another worker took it over first
+                await esdb.options(ignore_status=[404, 409]).delete(
+                    index=index, id='init', refresh=True,
+                    if_seq_no=lock['_seq_no'], if_primary_term=lock['_primary_term'])
+            else:
+                await asyncio.sleep(poll)
+    try:
+        yield
+    finally:
+        # Conditional, in case the lock expired and another worker took it over
+        await esdb.options(ignore_status=[404, 409]).delete(
+            index=index, id='init', refresh=True,
+            if_seq_no=lock['_seq_no'], if_primary_term=lock['_primary_term'])
+
+
+async def create_index(esdb, alias, bulk=False):
+    """
+    Create a new versioned index to be served behind the given alias.
 
-    # If no data is in the index, load in the CSV file
-    num_docs = await esdb.count(index=os.environ['ELASTIC_INDEX'])
-    if num_docs['count'] == 0:
-        await async_bulk(esdb, get_row('datasets/netflix.csv'))
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias the index will be served under.
+        bulk (bool): Whether to tune the index for a bulk load, with
+            replicas and refreshes disabled until restore_index is called.
+
+    Returns:
+        (str): The name of the new index.
+    """
+    index = f"{alias}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S%f')}"
+    settings = dict(ELASTIC_SETTINGS)
+    if bulk:
+        settings.update({"number_of_replicas": 0, "refresh_interval": "-1"})
+    # Explicit mappings and analyzers
+    await esdb.indices.create(index=index, mappings=ELASTIC_MAP, settings=settings)
+    return index
+
+
+async def restore_index(esdb, index):
+    """
+    Compact a bulk loaded index and restore its live settings.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        index (str): The name of the bulk loaded index.
+
+    Returns:
+        None
+    """
+    await esdb.indices.refresh(index=index)
+    # Merging before adding replicas saves copying the unmerged segments
+    await esdb.options(request_timeout=3600).indices.forcemerge(
+        index=index, max_num_segments=1)
+    # A null refresh interval resets it to the default
+    await esdb.indices.put_settings(index=index, settings={
+        "number_of_replicas": int(os.environ.get('ELASTIC_REPLICAS', 1)),
+        "refresh_interval": None})
+
+
+async def get_versions(esdb, alias):
+    """
+    Retrieve the versioned indices of an alias, and those it points to.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias the indices are served under.
+
+    Returns:
+        (tuple[list[str], list[str]]): All versioned indices, oldest first,
+            and the indices currently behind the alias.
+    """
+    indices = await esdb.indices.get(index=f"{alias}-*", expand_wildcards='open')
+    versions = sorted(indices.body)
+    current = [index for index in versions
+               if alias in indices.body[index].get('aliases', {})]
+    return versions, current
+
+
+async def swap_alias(esdb, alias, index):
+    """
+    Atomically point the alias at the given index, away from any other.
+    A concrete index with the alias name, from before versioning, is removed.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias queries are sent to.
+        index (str): The index to serve under the alias.
+
+    Returns:
+        None
+    """
+    _, current = await get_versions(esdb, alias)
+    actions = [{"remove": {"index": old, "alias": alias}}
+               for old in current if old != index]
+    if await esdb.indices.exists(index=alias) and \
+            not await esdb.indices.exists_alias(name=alias):
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+    await esdb.indices.update_aliases(actions=actions)
+
+
+async def reindex(esdb, source, alias, keep=None, checkpoint=None, **kwargs):
+    """
+    Load a catalogue file into a new versioned index, then swap the alias
+    over to it. Live searches keep using the previous index until the swap,
+    and a failed load leaves the alias untouched.
+
+    With a checkpoint, a failed load keeps its index and the number of rows
+    it loaded, and the next run with the same checkpoint carries on from there.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        source (str): The path of the file to load, or '-' for stdin.
+        alias (str): The alias queries are sent to.
+        keep (int): The number of previous versions kept for rollbacks.
+        checkpoint (str): The path of the file recording the progress, if any.
+        **kwargs: The tuning options passed on to bulk_load.
+
+    Returns:
+        (dict): The throughput summary and per-chunk errors of the load.
+    """
+    progress = Checkpoint(checkpoint) if checkpoint else None
+    state = progress.load() if progress else None
+    if state and state.get('source') == source and state.get('alias') == alias \
+            and await esdb.indices.exists(index=state['index']):
+        index = state['index']
+        logger.info("Resuming the load of '%s' into '%s' after %d rows",
+                    source, index, state['rows'])
+    else:
+        if state:
+            # The partial index of another load would pass for a rollback version
+            await esdb.options(ignore_status=404).indices.delete(index=state['index'])
+        index = await create_index(esdb, alias, bulk=True)
+        if progress:
+            progress.save(source=source, alias=alias, index=index, rows=0)
+    try:
+        report = await bulk_load(esdb, source, index, checkpoint=progress,
+                                 skip=progress.state['rows'] if progress else 0, **kwargs)
+        if report['failed']:
+            raise RuntimeError(f"{report['failed']} documents failed to load "
+                               f"into '{index}': {report['errors'][:3]}")
+        await restore_index(esdb, index)
+    except BaseException:
+        # A checkpointed index is kept for the next run to resume
+        if not progress:
+            await esdb.options(ignore_status=404).indices.delete(index=index)
+        raise
+
+    await swap_alias(esdb, alias, index)
+    if progress:
+        progress.clear()
+    # Drop stale cached results now that queries see the new documents
+    index_generation.bump()
+    await prune_versions(esdb, alias, keep)
+    return report
+
+
+async def rollback(esdb, alias):
+    """
+    Point the alias back at the version loaded before the current one.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias queries are sent to.
+
+    Returns:
+        (str): The name of the index now behind the alias.
+    """
+    versions, current = await get_versions(esdb, alias)
+    previous = [index for index in versions if not current or index < min(current)]
+    if not previous:
+        raise RuntimeError(f"No previous version of '{alias}' to roll back to")
+    await swap_alias(esdb, alias, previous[-1])
+    index_generation.bump()
+    return previous[-1]
+
+
+async def prune_versions(esdb, alias, keep=None):
+    """
+    Delete the oldest versioned indices not behind the alias.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        alias (str): The alias the indices are served under.
+        keep (int): The number of previous versions kept for rollbacks.
+
+    Returns:
+        (list[str]): The names of the deleted indices.
+    """
+    if keep is None:
+        keep = int(os.environ.get('ELASTIC_KEEP_VERSIONS', 1))
+    versions, current = await get_versions(esdb, alias)
+    previous = [index for index in versions if index not in current]
+    stale = previous[:max(len(previous) - keep, 0)]
+    if stale:
+        await esdb.indices.delete(index=','.join(stale))
+    return stale
 
 
 def filter_row(row):
@@ -145,59 +527,246 @@ def filter_dates(row):
 
 
 
-def get_row(csv_filepath):
+def get_row(source, index=None, fmt=None):
     """
-    Given a CSV filepath, process all rows for
+    Given a catalogue file, process all rows for
     insertion into the Elasticsearch database.
 
     Args:
-        excel_sheet (Worksheet): Object for accessing excel file data.
+        source (str): The path of the file to read, or '-' for stdin.
+        index (str): The index to insert into, defaults to ELASTIC_INDEX.
+        fmt (str): The format of the file, guessed from its name if None.
 
     Returns:
-        None
+        (Generator[dict]): The bulk insert actions, one per row.
     """
-    with open(csv_filepath, 'r', encoding='utf-8') as csv_file:
-        csv_reader = csv.DictReader(csv_file)
-        for row in csv_reader:
-            row['genres'] = row.pop('listed_in')
-            # For optimizing elasticsearch, turn empty strings to None
-            for key, value in row.items():
-                if not value:
-                    row[key] = None
-            # Perform more filtering on specific columns
-            filter_dates(row)
-            filter_strings(row)
-            filter_row(row)
-            yield {
-                "_id": row.pop('show_id'),
-                "_index": os.environ['ELASTIC_INDEX'],
-                "_source": row
-            }
-
-
-def filter_text(text, punct=True):
-    """
-    Process the given text to be inserted into the
-    Elasticsearch database.
+    index = index or os.environ['ELASTIC_INDEX']
+    snapshot = get_snapshot(source, fmt)
+    if snapshot is not None:
+        # Already processed, so the documents are only decoded
+        with snapshot:
+            yield from snapshot.actions(index)
+        return
+    for columns in read_chunks(source, 1000, fmt):
+        yield from transform_columns(columns, index)
+
+
+def get_snapshot(source, fmt=None):
+    """
+    Open the up to date snapshot of a catalogue file, built by snapshot.py.
+
+    Args:
+        source (str): The path of the file.
+        fmt (str): The format the file is forced to be read as, if any.
+
+    Returns:
+        (Snapshot): The snapshot, None if there is none, it is stale,
+            or INGEST_SNAPSHOT is false.
+    """
+    if fmt is not None or not env_flag('INGEST_SNAPSHOT'):
+        return None
+    return open_snapshot(source)
+
+
+def process_row(row, index=None):
+    """
+    Process a raw CSV row into a bulk insert action. Loads go through
+    transform.transform_columns instead, which matches this row by row.
+
+    Args:
+        row (dict): The row as read from the CSV file.
+        index (str): The index to insert into, defaults to ELASTIC_INDEX.
+
+    Returns:
+        (dict): The bulk insert action for the row.
+    """
+    row['genres'] = row.pop('listed_in')
+    # For optimizing elasticsearch, turn empty strings to None
+    for key, value in row.items():
+        if not value:
+            row[key] = None
+    # Perform more filtering on specific columns
+    filter_dates(row)
+    filter_strings(row)
+    filter_row(row)
+    show_id = row.pop('show_id')
+    row['fingerprint'] = fingerprint(row)
+    return {
+        "_id": show_id,
+        "_index": index or os.environ['ELASTIC_INDEX'],
+        "_source": row
+    }
+
+
+def transform_chunk(columns, index):
+    """
+    Process a chunk of raw columns into bulk insert actions.
+    This is CPU bound, so it is run in a worker process.
 
     Args:
-        text (str): The text to process and simplify for use.
+        columns (dict[str, list[str]]): The columns as read from the file.
+        index (str): The index to insert into.
 
     Returns:
-        (str): The text after being processed.
+        (tuple[list[dict], int]): The actions and their size in bytes.
+    """
+    actions = transform_columns(columns, index)
+    num_bytes = sum(len(json.dumps(action['_source'])) for action in actions)
+    return actions, num_bytes
+
+
+async def bulk_load(esdb, source, index, **kwargs):
+    """
+    Load a catalogue file into the Elasticsearch database, transforming
+    chunks of rows in a process pool while uploading earlier chunks
+    concurrently. Reading waits while too many chunks are in flight,
+    so memory stays flat however large the file. A file with an up to
+    date snapshot is loaded from it instead, skipping the transform.
 
-    Notes:
-        The following changes are made to the string:
-            - Punctuation removed
-            - Character accents removed
-            - Extraneous whitespace removed
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        source (str): The path of the file to load, or '-' for stdin.
+        index (str): The index to insert into.
+        fmt (str): The format of the file, guessed from its name if None.
+        chunk_size (int): The number of rows per bulk request.
+        concurrency (int): The maximum number of chunks in flight.
+        workers (int): The number of transform processes, 0 to use a thread.
+        skip (int): The number of rows loaded by a previous run, to skip.
+        checkpoint (Checkpoint): Where to record the rows done, if anywhere.
+
+    Returns:
+        (dict): The throughput summary and per-chunk errors of the load.
     """
-    if isinstance(text, str):
-        # Remove accents from characters
-        text = ud(text)
-        # Remove punctuation (except for apostrophes and hyphens due to names)
-        if punct:
-            pattern = r"[^a-zA-Z0-9\s',-]"
-            text = re.sub(pattern, '', text).replace('  ', ' ')
-        return text.strip()
-    return ''
+    chunk_size = kwargs.get('chunk_size', int(os.environ.get('INGEST_CHUNK_SIZE', 1000)))
+    workers = kwargs.get('workers', int(os.environ.get('INGEST_WORKERS', os.cpu_count())))
+    start = time.perf_counter()
+
+    snapshot = get_snapshot(source, kwargs.get('fmt'))
+    if snapshot is not None:
+        chunks = snapshot.chunks(chunk_size, index, kwargs.get('skip', 0))
+        # Nothing is left to transform, so no worker processes are started
+        workers = 0
+    else:
+        chunks = read_chunks(source, chunk_size, kwargs.get('fmt'), kwargs.get('skip', 0))
+    with ProcessPoolExecutor(workers) if workers else nullcontext() as pool, \
+            closing(chunks), snapshot if snapshot is not None else nullcontext():
+        load = BulkLoad(esdb, index, pool, kwargs.get('checkpoint'))
+        await load.run(chunks, kwargs.get('concurrency',
+                                          int(os.environ.get('INGEST_CONCURRENCY', 4))))
+    return load.finish(time.perf_counter() - start)
+
+
+class BulkLoad:
+    """
+    The uploads of a load, one bulk request per chunk, and their throughput
+    and errors.
+
+    Attributes:
+        report (dict): The rows, bytes, chunks and failures loaded so far,
+            with the errors of each failed chunk.
+    """
+    def __init__(self, esdb, index, pool=None, checkpoint=None):
+        """
+        Args:
+            esdb (AsyncElasticsearch): Database connection instance.
+            index (str): The index to insert into.
+            pool (ProcessPoolExecutor): Where to transform chunks, a thread if None.
+            checkpoint (Checkpoint): Where to record the rows done, if anywhere.
+        """
+        self.report = {'rows': 0, 'bytes': 0, 'chunks': 0, 'failed': 0, 'errors': []}
+        self._esdb = esdb
+        self._index = index
+        self._pool = pool
+        self._checkpoint = checkpoint
+
+    async def run(self, chunks, concurrency):
+        """
+        Upload chunks as they are read. Reading waits while too many chunks
+        are in flight, so memory stays flat however large the file.
+
+        Args:
+            chunks (Iterator): The chunks of raw columns, or of actions
+                with their size in bytes.
+            concurrency (int): The maximum number of chunks in flight.
+
+        Returns:
+            None
+        """
+        # Bounds the chunks held in memory, so reading waits on uploads
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        for number in itertools.count():
+            await semaphore.acquire()
+            # Reading and decompressing block, so keep them off the event loop
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                semaphore.release()
+                break
+            task = asyncio.create_task(self._load_chunk(number, chunk))
+            task.add_done_callback(lambda _: semaphore.release())
+            # Finished chunks are let go of, keeping only those in flight
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    def finish(self, seconds):
+        """
+        Complete the report with the throughput of the load, and record it.
+
+        Args:
+            seconds (float): How long the load took.
+
+        Returns:
+            (dict): The throughput summary and per-chunk errors of the load.
+        """
+        report = self.report
+        report['seconds'] = seconds
+        report['rows_per_sec'] = report['rows'] / seconds if seconds else 0.0
+        report['bytes_per_sec'] = report['bytes'] / seconds if seconds else 0.0
+        logger.info("Loaded %d rows (%d failed) in %d chunks, %.0f rows/s, %.0f bytes/s",
+                    report['rows'], report['failed'], report['chunks'],
+                    report['rows_per_sec'], report['bytes_per_sec'])
+        INGEST_ROWS.inc(report['rows'], mode='bulk')
+        INGEST_BYTES.inc(report['bytes'], mode='bulk')
+        INGEST_ERRORS.inc(report['failed'], mode='bulk')
+        INGEST_SECONDS.observe(report['seconds'], mode='bulk')
+        INGEST_ROWS_PER_SECOND.set(report['rows_per_sec'], mode='bulk')
+        return report
+
+    async def _load_chunk(self, number, chunk):
+        if isinstance(chunk, dict):
+            loop = asyncio.get_running_loop()
+            try:
+                actions, num_bytes = await loop.run_in_executor(self._pool, transform_chunk,
+                                                                chunk, self._index)
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                # A malformed row fails its whole chunk, which is reported like
+                # rejected documents instead of being lost with the task
+                rows = len(next(iter(chunk.values()), ()))
+                self._record(number, rows, 0, 0, [repr(exc)])
+                return
+        else:
+            # Snapshot chunks come with their actions
+            actions, num_bytes = chunk
+        try:
+            success, errors = await async_bulk(self._esdb, actions, chunk_size=len(actions),
+                                               raise_on_error=False,
+                                               raise_on_exception=False)
+        except (TransportError, ApiError) as exc:
+            success, errors = 0, [str(exc)]
+        self._record(number, len(actions), success, num_bytes, errors)
+
+    def _record(self, number, rows, success, num_bytes, errors):
+        report = self.report
+        report['rows'] += success
+        report['bytes'] += num_bytes
+        report['chunks'] += 1
+        if errors:
+            report['failed'] += rows - success
+            report['errors'].append({'chunk': number, 'count': len(errors),
+                                     'sample': errors[:3]})
+            logger.warning("Chunk %d had %d failed documents: %s",
+                           number, len(errors), errors[:3])
+        if self._checkpoint is not None:
+            self._checkpoint.finish_chunk(number, rows, failed=bool(errors))
@@ -0,0 +1,39 @@
+"""
+Created by: Brandon Goddard
+Description: This module is the gunicorn configuration, sizing the
+             workers to the host and sharing caches between them.
+"""
+import os
+import shutil
+import multiprocessing
+
+# Gunicorn reads its settings from lowercase module names
+# pylint: disable=invalid-name
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = "uvicorn.workers.UvicornWorker"
+# Workers mostly wait on Elasticsearch, so more than one per CPU keeps them busy.
+# Each holds its own connection pool and suggester, so large hosts are capped.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+# The initial bulk load happens during startup, and can take a while
+timeout = 3600
+# Import the app once, then fork the workers from it. Nothing bound to an
+# event loop is created on import, connections are made in the lifespan.
+preload_app = True
+
+# Workers share cached results through memory-backed files
+os.environ.setdefault('CACHE_DIR', '/dev/shm/catalogue-cache')
+
+
+def on_starting(server):
+    """
+    Clear the cache left over by a previous run before starting the workers.
+
+    Args:
+        server (Arbiter): The gunicorn master.
+
+    Returns:
+        None
+    """
+    server.log.info("Clearing the cache in %s", os.environ['CACHE_DIR'])
+    shutil.rmtree(os.environ['CACHE_DIR'], ignore_errors=True)
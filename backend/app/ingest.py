@@ -0,0 +1,192 @@
+"""
+Created by: Brandon Goddard
+Description: This module is a command-line entry point for loading a
+             catalogue file into the Elasticsearch database, writing
+             only the documents that were added, changed or removed.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+from elasticsearch.helpers import async_bulk, async_scan
+from cache import CACHE_DIR, index_generation
+from metrics import (REGISTRY, INGEST_ROWS, INGEST_ERRORS, INGEST_SECONDS,
+                     INGEST_ROWS_PER_SECOND)
+from database import (get_elastic_db, get_row, create_index, swap_alias,
+                      reindex, rollback)
+from sources import FORMATS
+
+
+logger = logging.getLogger(__name__)
+
+
+async def get_fingerprints(esdb, index):
+    """
+    Retrieve the content fingerprint of every indexed document.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        index (str): The index to read from.
+
+    Returns:
+        (dict[str, str]): The fingerprints, keyed by document ID.
+    """
+    fingerprints = {}
+    async for hit in async_scan(esdb, index=index, query={"query": {"match_all": {}}},
+                                _source=['fingerprint'], size=5000):
+        fingerprints[hit['_id']] = hit['_source'].get('fingerprint')
+    return fingerprints
+
+
+def get_delta_actions(rows, index, fingerprints, report, full=False):
+    """
+    Compare the catalogue rows against the indexed fingerprints, and build
+    the bulk actions needed to bring the index up to date.
+
+    Args:
+        rows (Iterable[dict]): The bulk insert actions of the catalogue rows,
+            as returned by get_row.
+        index (str): The index to write to.
+        fingerprints (dict[str, str]): The indexed fingerprints, keyed by ID.
+            Consumed by this function.
+        report (dict): The counters to update for each row.
+        full (bool): Whether to rewrite unchanged documents too.
+
+    Returns:
+        (Generator[dict]): The index and delete actions.
+    """
+    for action in rows:
+        indexed = fingerprints.pop(action['_id'], None)
+        if indexed is None:
+            report['added'] += 1
+        elif indexed != action['_source']['fingerprint']:
+            report['changed'] += 1
+        elif full:
+            report['rewritten'] += 1
+        else:
+            report['unchanged'] += 1
+            continue
+        yield action
+
+    # Anything left in the index no longer exists in the file
+    for doc_id in fingerprints:
+        report['deleted'] += 1
+        yield {"_op_type": "delete", "_index": index, "_id": doc_id}
+
+
+async def sync_index(esdb, source, index, full=False, **kwargs):
+    """
+    Bring the index in line with the catalogue file, creating it if needed.
+    Rows stream through to the bulk requests, and rerunning after a failure
+    skips the documents that were already written, as they are unchanged.
+
+    Args:
+        esdb (AsyncElasticsearch): Database connection instance.
+        source (str): The path of the file to load, or '-' for stdin.
+        index (str): The alias to write through.
+        full (bool): Whether to rewrite unchanged documents too.
+        chunk_size (int): The number of actions per bulk request.
+        fmt (str): The format of the file, guessed from its name if None.
+
+    Returns:
+        (dict): The counts of added, changed, unchanged, rewritten and deleted
+            documents, and of all the documents written.
+    """
+    if not await esdb.indices.exists(index=index):
+        await swap_alias(esdb, index, await create_index(esdb, index))
+
+    start = time.perf_counter()
+    report = {'added': 0, 'changed': 0, 'unchanged': 0, 'rewritten': 0, 'deleted': 0}
+    fingerprints = await get_fingerprints(esdb, index)
+    actions = get_delta_actions(get_row(source, index, kwargs.get('fmt')), index,
+                                fingerprints, report, full)
+    _, errors = await async_bulk(esdb, actions, chunk_size=kwargs.get('chunk_size', 1000),
+                                 raise_on_error=False)
+    await esdb.indices.refresh(index=index)
+    written = report['added'] + report['changed'] + report['rewritten'] + report['deleted']
+    if written:
+        # Lets API workers sharing CACHE_DIR on this host drop stale results
+        index_generation.bump()
+    report['written'] = written
+    report['errors'] = errors
+
+    seconds = time.perf_counter() - start
+    INGEST_ROWS.inc(written, mode='delta')
+    INGEST_ERRORS.inc(len(errors), mode='delta')
+    INGEST_SECONDS.observe(seconds, mode='delta')
+    INGEST_ROWS_PER_SECOND.set(written / seconds if seconds else 0.0, mode='delta')
+    return report
+
+
+def parse_args(argv=None):
+    """
+    Parse the command-line arguments.
+
+    Args:
+        argv (list[str]): The arguments, defaults to sys.argv.
+
+    Returns:
+        (argparse.Namespace): The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description="Load a catalogue file, writing only what changed.")
+    parser.add_argument('source', nargs='?', default='datasets/netflix.csv',
+                        help="The catalogue file to load, optionally gzip or zstd "
+                             "compressed, or - to read from stdin.")
+    parser.add_argument('--format', choices=FORMATS, default=None,
+                        help="The format of the file, guessed from its name by default.")
+    parser.add_argument('--index', default=os.environ.get('ELASTIC_INDEX'),
+                        help="The alias to write to, defaults to ELASTIC_INDEX.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--full', action='store_true',
+                      help="Rewrite every document, even if unchanged.")
+    mode.add_argument('--reindex', action='store_true',
+                      help="Load into a new index, then swap the alias to it.")
+    mode.add_argument('--rollback', action='store_true',
+                      help="Point the alias back at the previous index.")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="The number of documents per bulk request.")
+    parser.add_argument('--checkpoint', default=None,
+                        help="With --reindex, a file recording the progress of the load, "
+                             "which a rerun after a failure resumes from.")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    """
+    Run the ingestion with the given command-line arguments.
+
+    Args:
+        argv (list[str]): The arguments, defaults to sys.argv.
+
+    Returns:
+        (int): The exit status, non-zero if any document failed.
+    """
+    args = parse_args(argv)
+    if not CACHE_DIR:
+        logger.warning("CACHE_DIR is unset, so the API keeps serving cached results "
+                       "and ETags of the previous data until they expire")
+    esdb = get_elastic_db()
+    try:
+        if args.rollback:
+            report = {'index': await rollback(esdb, args.index), 'errors': []}
+        elif args.reindex:
+            report = await reindex(esdb, args.source, args.index, fmt=args.format,
+                                   checkpoint=args.checkpoint)
+        else:
+            report = await sync_index(esdb, args.source, args.index, full=args.full,
+                                      chunk_size=args.chunk_size, fmt=args.format)
+    finally:
+        await esdb.close()
+        # Hands the ingestion metrics to the API workers sharing CACHE_DIR
+        REGISTRY.flush()
+    print(json.dumps(report, indent=2))
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main()))
@@ -3,15 +3,74 @@ Created by: Brandon Goddard
 Description: This module is for defining the API and
              handling requests to the Elasticsearch database.
 """
+import io
 import os
-from fastapi import FastAPI, HTTPException
+import csv
+import time
+import asyncio
+import hmac
+import logging
+from typing import Annotated
+from functools import partial
+from contextlib import asynccontextmanager
+import orjson
+from elasticsearch import NotFoundError, ApiError, TransportError
+from pydantic import ValidationError
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import (ORJSONResponse, PlainTextResponse, Response,
+                               StreamingResponse)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 import schemas
-from database import get_elastic_db, init_elastic_db
+from cache import TTLCache, SharedStore, CACHE_DIR, MISSING, index_generation
+from database import (get_elastic_db, init_elastic_db, wait_for_elastic_db,
+                      get_pool_stats)
+from queries import (normalize_query, encode_cursor, decode_cursor, build_query,
+                     build_filters, build_search, build_combined_aggs, process_films,
+                     process_hits, process_all_aggs, process_movie_aggs, process_show_aggs)
+from suggest import Suggester, MAX_SIZE
+from slowlog import SlowQueryLog
+from metrics import (REGISTRY, STAGE_SECONDS, ELASTIC_TOOK_SECONDS,
+                     MetricsMiddleware)
+try:
+    # Brotli compresses JSON better than gzip, when the package is installed
+    from brotli_asgi import BrotliMiddleware
+except ImportError:
+    BrotliMiddleware = None
+
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(application):
+    """
+    Connect to and initialize the Elasticsearch database on startup,
+    and close the connection on shutdown. The connection is created
+    here, inside the event loop using it, and kept in the app state.
 
+    Args:
+        application (FastAPI): The application.
 
+    Returns:
+        (AsyncGenerator): The application lifespan.
+    """
+    esdb = application.state.esdb = get_elastic_db()
+    try:
+        await wait_for_elastic_db(esdb)
+        await init_elastic_db(esdb)
+        await suggester.refresh(esdb, os.environ['ELASTIC_INDEX'], index_generation.value)
+        yield
+    finally:
+        await esdb.close()
+
+
+# Hot endpoints return an ORJSONResponse themselves, which FastAPI sends
+# as is, skipping a second validation of data built by this module
 app = FastAPI(openapi_url="/api/docs/openapi.json",
-              docs_url="/api/docs/")
+              docs_url="/api/docs/",
+              default_response_class=ORJSONResponse,
+              lifespan=lifespan)
 
 # Configure CORS middleware
 app.add_middleware(
@@ -20,223 +79,889 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Total-Hits", "X-Total-Hits-Relation", "ETag"],
 )
 
-# Create a connection from a pool of Elasticsearch database instances
-esdb = get_elastic_db()
+# Compress responses large enough to be worth it, such as aggregations
+# and result pages, falling back to gzip for clients without Brotli
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 500))
+if BrotliMiddleware is not None:
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+else:
+    # Level 6 is nearly as small as 9, for a fraction of the CPU time
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=6)
+
+# Count and time every request, by route
+app.add_middleware(MetricsMiddleware)
+
+# Seconds browsers and nginx may reuse aggregations without revalidating
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 60))
+# Tells apart generations counted since different starts of the API,
+# taken once before gunicorn forks, so the workers share it
+STARTED = int(time.time())
+
+# Aggregations only change when the index is reloaded, so share them
+aggs_cache = TTLCache(ttl=float(os.environ.get('AGGS_CACHE_TTL', 300)),
+                      maxsize=int(os.environ.get('AGGS_CACHE_SIZE', 16)),
+                      generation=index_generation,
+                      store=SharedStore(os.path.join(CACHE_DIR, 'aggs')) if CACHE_DIR else None)
+
+# Popular searches are answered from memory, holding the serialized body
+# so hits skip serialization too, and bounded by its size
+search_cache = TTLCache(ttl=float(os.environ.get('SEARCH_CACHE_TTL', 300)),
+                        maxsize=int(os.environ.get('SEARCH_CACHE_SIZE', 1024)),
+                        maxbytes=int(os.environ.get('SEARCH_CACHE_BYTES', 16 * 1024 * 1024)),
+                        sizeof=lambda entry: len(entry[0]),
+                        generation=index_generation)
+
+# Slow queries are logged, and sampled or flagged ones profiled, per worker
+slow_log = SlowQueryLog(threshold=float(os.environ.get('SLOW_QUERY_MS', 500)) / 1000,
+                        sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+                        size=int(os.environ.get('SLOW_QUERY_LOG_SIZE', 100)),
+                        profile_size=int(os.environ.get('PROFILE_BUFFER_SIZE', 20)))
+# Guards the admin endpoints and profiling on demand, left open if unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Typeahead suggestions are served from memory, built from the index
+suggester = Suggester()
+
+
+@app.get("/api/admin/queries/", response_model=schemas.QueryLog)
+async def get_query_log(request: Request):
+    """
+    API endpoint for retrieving the recent slow queries and query profiles
+    of the worker answering, most recent first. Profiles are taken of
+    sampled queries, and of those sent with an X-Profile header by an admin.
+
+    Args:
+        request (Request): The request, for its admin token.
+
+    Returns:
+        (dict): The slow query threshold, slow queries and profiles.
+    """
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Expected a valid X-Admin-Token header")
+    return slow_log.stats()
 
 
-@app.on_event("startup")
-async def startup():
+@app.get("/api/metrics", response_class=PlainTextResponse)
+async def get_metrics():
     """
-    Initialize the Elasticsearch database on startup.
-    
+    API endpoint for scraping the metrics of every worker of the host,
+    in the Prometheus text format.
+
     Returns:
-        None
+        (PlainTextResponse): The metrics exposition.
     """
-    await init_elastic_db(esdb)
+    return PlainTextResponse(REGISTRY.render(),
+                             media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-@app.on_event("shutdown")
-async def shutdown():
+@app.get("/api/health/", response_model=schemas.Health)
+async def get_health(request: Request):
     """
-    Close the Elasticsearch database connection on shutdown.
+    API endpoint for checking that the Elasticsearch database is
+    reachable, and how saturated its connection pool is.
+
+    Args:
+        request (Request): The request, for the database connection.
 
     Returns:
-        None
+        (ORJSONResponse): The database status and pool usage, with a
+            503 status if the database is unreachable.
     """
-    await esdb.close()
+    esdb = request.app.state.esdb
+    ready = await esdb.ping()
+    return ORJSONResponse({'status': 'ok' if ready else 'unavailable',
+                           'pool': get_pool_stats(esdb)},
+                          status_code=200 if ready else 503)
 
 
-@app.get("/api/film/{film_type}/", response_model=list[schemas.Film])
-async def get_film(film_type: str, query: str):
+# Registered before the search route, which would otherwise take 'cache' as a film type
+@app.get("/api/film/cache/", response_model=schemas.CacheStats)
+async def get_search_cache_stats():
+    """
+    API endpoint for retrieving the search result cache counters.
+
+    Returns:
+        (dict): The hit/miss counters, memory footprint and settings of the cache.
+    """
+    return search_cache.stats()
+
+
+@app.get("/api/film/{film_type}/",
+         response_model=list[schemas.Film] | schemas.FacetedFilms)
+async def get_film(request: Request, film_type: str,
+                   params: Annotated[schemas.FilmQuery, Query()]):
     """
     API endpoint for retrieving a film from the Elasticsearch database.
+    Paginated searches return the cursor of the next page in the
+    X-Next-Cursor header, which is absent on the last page. Other searches
+    carry an ETag, are answered with a 304 while the index is unchanged,
+    and are cached until it changes, by their normalized query.
+    With filters, an empty query lists every film matching them.
 
     Args:
+        request (Request): The request, for its conditional headers.
         film_type (str): The type of film to retrieve, being 'movie' or 'show'.
-        query (str): The query text to search for in the database.
+        params (FilmQuery): The query text, filters and options of the search,
+            from the query string.
 
     Returns:
-        (dict): The film data retrieved from the database.
+        (ORJSONResponse): The film data retrieved from the database, with
+            the facets if requested.
     """
     if film_type not in {'movie', 'show'}:
         detail = f"Expected 'movie' or 'show', got '{film_type}'"
         raise HTTPException(status_code=404, detail=detail)
-    query = build_query(film_type, query)
-    result = await esdb.search(index=os.environ['ELASTIC_INDEX'], query=query,
-                               size=8, track_total_hits=True)
-    response = []
-    # If we get no results back, return an empty model
-    if result['hits']['total']['value'] == 0:
-        return response
-    for hit in result['hits']['hits']:
-        hit['_source']['rating'] = schemas.ID_TO_RATING[hit['_source']['rating']]
-        hit['_source'].pop('type')
-        response.append(hit['_source'])
+    profile = wants_profile(request)
+    if params.paginate or params.cursor:
+        return await get_film_page(request, film_type, params, profile)
+    headers, fresh = http_cache(request, max_age=0)
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    fetch = partial(fetch_films, film_type, params, profile)
+    # Profiled searches must reach the database, so they skip the cache
+    body, total = await (fetch() if profile else
+                         search_cache.get_or_set(search_key(film_type, params), fetch))
+    return Response(body, media_type='application/json', headers=headers | total)
+
+
+async def get_film_page(request, film_type, params, profile=False):
+    """
+    Retrieve a page of a paginated film search, with the cursor of the
+    next page in the X-Next-Cursor header, absent on the last page.
 
+    Args:
+        request (Request): The request, for the database connection.
+        film_type (str): The type of film to retrieve, being 'movie' or 'show'.
+        params (FilmQuery): The query text, filters, cursor and options of the search.
+        profile (bool): Whether to profile the search.
+
+    Returns:
+        (ORJSONResponse): The films of the page, with the facets if requested.
+    """
+    # Cursors point into a short-lived point in time, so never reuse pages
+    headers = {'Cache-Control': 'no-store'}
+    start = time.perf_counter()
+    labels = {'route': '/api/film/{film_type}/', 'film_type': film_type}
+    with STAGE_SECONDS.time(stage='build', **labels):
+        search = build_search(film_type, params)
+    result, seconds = await search_films(search, labels, paginate=True, cursor=params.cursor)
+    # A full page means there may be another one after it
+    if len(result['hits']['hits']) == params.size:
+        headers['X-Next-Cursor'] = encode_cursor(
+            result['pit_id'], result['hits']['hits'][-1]['sort'])
+    else:
+        await request.app.state.esdb.close_point_in_time(id=result['pit_id'])
+    headers.update(total_headers(result))
+
+    with STAGE_SECONDS.time(stage='process', **labels):
+        films = process_films(result, params.facets)
+    response = serialize(films, headers=headers, **labels)
+    measures = {'elasticsearch': seconds, 'latency': time.perf_counter() - start,
+                'size': len(response.body)}
+    slow_log.observe(labels, search, result, measures,
+                     rerun=profile_search(search) if profile else None)
     return response
 
 
+@app.websocket("/api/ws/film/")
+async def search_socket(websocket: WebSocket):
+    """
+    WebSocket endpoint for searching as the user types, over one connection.
+    Each message is a SocketQuery holding the whole text typed so far.
+    Queries are debounced, and a newer query cancels the previous one, even
+    while it is running on the database, so only the latest results are sent.
+
+    Args:
+        websocket (WebSocket): The connection.
+
+    Returns:
+        None
+    """
+    await websocket.accept()
+    debounce = float(os.environ.get('SEARCH_DEBOUNCE_MS', 150)) / 1000
+    receive = asyncio.ensure_future(websocket.receive_text())
+    search = query_id = None
+    try:
+        while True:
+            done, _ = await asyncio.wait([task for task in (receive, search) if task],
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if search in done:
+                results = socket_results(search, query_id)
+                # Results are stale once a newer query has arrived
+                if receive not in done:
+                    await websocket.send_text(results)
+                search = None
+            if receive in done:
+                message = receive.result()
+                if search is not None:
+                    # Cancelling the request lets Elasticsearch cancel the search
+                    search.cancel()
+                query_id = socket_query_id(message)
+                search = asyncio.ensure_future(socket_search(message, debounce))
+                receive = asyncio.ensure_future(websocket.receive_text())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in (receive, search):
+            if task is not None:
+                task.cancel()
+
+
+async def socket_search(message, debounce):
+    """
+    Run the search of a WebSocket message once no newer one arrived for
+    the debounce delay, answering from the search cache if possible.
+
+    Args:
+        message (str): The SocketQuery message, as JSON.
+        debounce (float): Seconds to wait before searching.
+
+    Returns:
+        (str): The results message, with the ID of the query, its films,
+            the total hits and the error if it failed.
+    """
+    try:
+        item = schemas.SocketQuery.model_validate_json(message)
+    except ValidationError as exc:
+        error = exc.errors()[0]
+        return socket_message(None, error=f"{'.'.join(map(str, error['loc']))}: {error['msg']}")
+    if item.film_type not in {'movie', 'show'}:
+        return socket_message(item.id, error=f"Expected 'movie' or 'show', got '{item.film_type}'")
+    if not normalize_query(item.query):
+        return socket_message(item.id, b'[]', 0)
+
+    await asyncio.sleep(debounce)
+    # Shares the entries of get_film, but a miss is computed by this task
+    # alone, so that cancelling it cancels the search
+    params = schemas.FilmQuery(query=item.query, fuzzy=item.fuzzy, size=item.size)
+    key = search_key(item.film_type, params)
+    value = search_cache.get(key)
+    if value is MISSING:
+        current = index_generation.value
+        try:
+            value = await fetch_films(item.film_type, params)
+        except (ApiError, TransportError) as exc:
+            return socket_message(item.id, error=f"Search failed: {exc}")
+        search_cache.set(key, value, current)
+    body, total = value
+    return socket_message(item.id, body, int(total['X-Total-Hits']) if total else None)
+
+
+def socket_query_id(message):
+    """
+    Read the ID of a WebSocket message before searching, without validating
+    the rest of it, so that even an unexpected failure is answered with it.
+
+    Args:
+        message (str): The SocketQuery message, as JSON.
+
+    Returns:
+        (int | str): The ID of the query, None if it has none.
+    """
+    try:
+        query_id = orjson.loads(message).get('id')
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    return query_id if isinstance(query_id, (int, str)) else None
+
+
+def socket_results(search, query_id=None):
+    """
+    Take the results message of a finished WebSocket search. Failures other
+    than the database's are bugs, logged here as nothing else awaits the search.
+
+    Args:
+        search (asyncio.Task): The finished socket_search task.
+        query_id (int | str): The ID of the query searched, for the error message.
+
+    Returns:
+        (str): The results message, or an error message if the search raised.
+    """
+    if search.exception() is None:
+        return search.result()
+    logger.error("Searching over the WebSocket failed", exc_info=search.exception())
+    return socket_message(query_id, error="Search failed")
+
+
+def socket_message(query_id, films=b'null', total=None, error=None):
+    """
+    Build a WebSocket results message around serialized films.
+
+    Args:
+        query_id (int | str): The ID of the query answered.
+        films (bytes): The films, as JSON.
+        total (int): The total hits of the query.
+        error (str): Why the query failed, None if it succeeded.
+
+    Returns:
+        (str): The message, as JSON.
+    """
+    head = orjson.dumps({'id': query_id, 'total': total, 'error': error})
+    # The films are cached serialized, so they are spliced in as they are
+    return (head[:-1] + b',"films":' + films + b'}').decode('utf-8')
+
+
+def search_key(film_type, params):
+    """
+    Build the search cache key of a film search. Queries differing only in
+    case, accents or spacing analyze the same, so they share a cache entry,
+    while the database still gets the text as typed.
+
+    Args:
+        film_type (str): The type of film to retrieve, being 'movie' or 'show'.
+        params (FilmQuery): The query text, filters and options of the search.
+
+    Returns:
+        (tuple): The cache key.
+    """
+    options = params.model_dump_json(exclude={'query', 'paginate', 'cursor'},
+                                     exclude_none=True)
+    return (film_type, normalize_query(params.query), options)
+
+
+async def fetch_films(film_type, params, profile=False):
+    """
+    Search the Elasticsearch database for films, serialized for caching.
+
+    Args:
+        film_type (str): The type of film to retrieve, being 'movie' or 'show'.
+        params (FilmQuery): The query text, filters and options of the search.
+        profile (bool): Whether to profile the search.
+
+    Returns:
+        (tuple[bytes, dict]): The JSON body of the films, and the total hits headers.
+    """
+    start = time.perf_counter()
+    labels = {'route': '/api/film/{film_type}/', 'film_type': film_type}
+    with STAGE_SECONDS.time(stage='build', **labels):
+        search = build_search(film_type, params)
+    result, seconds = await search_films(search, labels)
+    with STAGE_SECONDS.time(stage='process', **labels):
+        films = process_films(result, params.facets)
+    with STAGE_SECONDS.time(stage='serialize', **labels):
+        body = orjson.dumps(films)
+    measures = {'elasticsearch': seconds, 'latency': time.perf_counter() - start,
+                'size': len(body)}
+    slow_log.observe(labels, search, result, measures,
+                     rerun=profile_search(search) if profile else None)
+    return body, total_headers(result)
+
+
+async def search_films(search, labels, paginate=False, cursor=None):
+    """
+    Run a film search, timing its round trip.
+
+    Args:
+        search (dict): The search request parameters.
+        labels (dict): The route and film type, for labelling the timings.
+        paginate (bool): Whether to search a point in time, for paging.
+        cursor (str): The cursor of the page to retrieve, None for the first page.
+
+    Returns:
+        (tuple[dict, float]): The search result, and the seconds its round trip took.
+    """
+    start = time.perf_counter()
+    with STAGE_SECONDS.time(stage='elasticsearch', **labels):
+        if paginate:
+            result = await search_page(search, cursor)
+        else:
+            result = await app.state.esdb.search(index=os.environ['ELASTIC_INDEX'], **search)
+    ELASTIC_TOOK_SECONDS.observe(result['took'] / 1000, **labels)
+    return result, time.perf_counter() - start
+
+
+def profile_search(search):
+    """
+    Prepare a search to be run again with profiling, outside any point in time.
+
+    Args:
+        search (dict): The search request parameters.
+
+    Returns:
+        (Callable): Coroutine function running the profiled search.
+    """
+    esdb = app.state.esdb
+    return lambda: esdb.search(index=os.environ['ELASTIC_INDEX'], profile=True, **search)
+
+
+def is_admin(request):
+    """
+    Check whether a request may use the admin features, by its
+    X-Admin-Token header. Everyone may when ADMIN_TOKEN is not set.
+
+    Args:
+        request (Request): The request.
+
+    Returns:
+        (bool): Whether the request is from an admin.
+    """
+    if not ADMIN_TOKEN:
+        return True
+    return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+
+
+def wants_profile(request):
+    """
+    Decide whether to profile the query of a request, if an admin flagged
+    it with the X-Profile header, or if it is sampled.
+
+    Args:
+        request (Request): The request.
+
+    Returns:
+        (bool): Whether to profile the query.
+    """
+    flagged = request.headers.get('X-Profile', '').lower() in {'1', 'true', 'yes'}
+    return (flagged and is_admin(request)) or slow_log.sampled()
+
+
+def total_headers(result):
+    """
+    Build the headers reporting the total hits of a search, if counted.
+
+    Args:
+        result (dict): The search result.
+
+    Returns:
+        (dict[str, str]): The X-Total-Hits and X-Total-Hits-Relation headers.
+    """
+    if 'total' not in result['hits']:
+        return {}
+    return {'X-Total-Hits': str(result['hits']['total']['value']),
+            'X-Total-Hits-Relation': result['hits']['total']['relation']}
+
+
+@app.post("/api/film/batch", response_model=list[schemas.BatchResult])
+async def get_film_batch(request: Request, queries: list[schemas.BatchQuery]):
+    """
+    API endpoint for running several film searches in a single
+    Elasticsearch round trip. Each search succeeds or fails on its own.
+
+    Args:
+        request (Request): The request, for the database connection.
+        queries (list[BatchQuery]): The searches to run, at most BATCH_MAX_SIZE.
+
+    Returns:
+        (ORJSONResponse): The films found or the error of each search, in order.
+    """
+    max_size = int(os.environ.get('BATCH_MAX_SIZE', 20))
+    if len(queries) > max_size:
+        detail = f"Expected at most {max_size} queries, got {len(queries)}"
+        raise HTTPException(status_code=422, detail=detail)
+
+    esdb = request.app.state.esdb
+    labels = {'route': '/api/film/batch', 'film_type': 'batch'}
+    results = [None] * len(queries)
+    searches, positions = [], []
+    with STAGE_SECONDS.time(stage='build', **labels):
+        for position, item in enumerate(queries):
+            if item.film_type not in {'movie', 'show'}:
+                results[position] = {'films': None, 'error': (
+                    f"Expected 'movie' or 'show', got '{item.film_type}'")}
+                continue
+            # An empty header searches the index given to msearch
+            searches.append({})
+            searches.append({'query': build_query(item.film_type, item.query, item.fuzzy),
+                             'size': item.size, '_source': schemas.FILM_FIELDS,
+                             'track_total_hits': False})
+            positions.append(position)
+
+    if searches:
+        with STAGE_SECONDS.time(stage='elasticsearch', **labels):
+            result = await esdb.msearch(index=os.environ['ELASTIC_INDEX'],
+                                        searches=searches)
+        ELASTIC_TOOK_SECONDS.observe(result['took'] / 1000, **labels)
+        with STAGE_SECONDS.time(stage='process', **labels):
+            for position, response in zip(positions, result['responses']):
+                if 'error' in response:
+                    error = response['error']
+                    results[position] = {'films': None,
+                                         'error': error.get('reason', error.get('type'))}
+                else:
+                    results[position] = {'films': process_hits(response['hits']['hits']),
+                                         'error': None}
+    return serialize(results, **labels)
+
+
+# The columns of exported documents, in order
+EXPORT_FIELDS = ['id', 'type'] + schemas.FILM_FIELDS
+EXPORT_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+
+@app.get("/api/export", response_class=StreamingResponse)
+async def export_films(film_type: str | None = None,
+                       release_year_min: int | None = None,
+                       release_year_max: int | None = None,
+                       fmt: str = Query('ndjson', alias='format', pattern='^(ndjson|csv)$')):
+    """
+    API endpoint for downloading every processed film, streamed page by page
+    from a point in time of the index, so memory use stays the same however
+    large the catalogue. Responses are compressed like any other.
+
+    Args:
+        film_type (str): The type of film to export, being 'movie' or 'show',
+            or unset for both.
+        release_year_min (int): The earliest release year exported.
+        release_year_max (int): The latest release year exported.
+        fmt (str): The format of the download, 'ndjson' or 'csv', given as format.
+
+    Returns:
+        (StreamingResponse): The films, one per line.
+    """
+    if film_type not in {None, 'movie', 'show'}:
+        detail = f"Expected 'movie' or 'show', got '{film_type}'"
+        raise HTTPException(status_code=404, detail=detail)
+    clauses = build_filters(schemas.FilmFilters(release_year_min=release_year_min,
+                                                release_year_max=release_year_max))
+    if film_type is not None:
+        clauses.append({"term": {"type": schemas.FILM_TYPE_TO_ID[film_type]}})
+    query = {"bool": {"filter": clauses}} if clauses else {"match_all": {}}
+
+    encode = encode_ndjson if fmt == 'ndjson' else encode_csv
+    headers = {'Content-Disposition': f'attachment; filename="{film_type or "films"}.{fmt}"',
+               'Cache-Control': 'no-store'}
+    return StreamingResponse(encode(export_documents(query)),
+                             media_type=EXPORT_MEDIA_TYPES[fmt], headers=headers)
+
+
+async def export_documents(query):
+    """
+    Retrieve every film matching a query, a page at a time, through a point
+    in time and search_after. The point in time is closed once done, or
+    once the client goes away.
+
+    Args:
+        query (dict): The Elasticsearch query.
+
+    Returns:
+        (AsyncGenerator[list[dict]]): The films of each page, with the fields
+            of EXPORT_FIELDS in order.
+    """
+    esdb = app.state.esdb
+    keep_alive = os.environ.get('PIT_KEEP_ALIVE', '1m')
+    page_size = int(os.environ.get('EXPORT_PAGE_SIZE', 1000))
+    pit = await esdb.open_point_in_time(index=os.environ['ELASTIC_INDEX'],
+                                        keep_alive=keep_alive)
+    pit_id, search_after = pit['id'], None
+    decode_type, decode_rating = schemas.ID_TO_FILM_TYPE.get, schemas.ID_TO_RATING.get
+    try:
+        while True:
+            # Sorting by shard doc alone is the cheapest order to page through
+            result = await esdb.search(pit={"id": pit_id, "keep_alive": keep_alive},
+                                       query=query, size=page_size,
+                                       sort=[{"_shard_doc": "asc"}],
+                                       search_after=search_after,
+                                       source=['type'] + schemas.FILM_FIELDS,
+                                       track_total_hits=False)
+            # The point in time ID may change between pages
+            if 'pit_id' in result:
+                pit_id = result['pit_id']
+            hits = result['hits']['hits']
+            if hits:
+                yield [{'id': hit['_id'],
+                        # Unknown types and ratings are exported empty
+                        'type': decode_type(hit['_source'].get('type')),
+                        **{field: hit['_source'].get(field) for field in schemas.FILM_FIELDS},
+                        'rating': decode_rating(hit['_source'].get('rating'))}
+                       for hit in hits]
+            if len(hits) < page_size:
+                return
+            search_after = hits[-1]['sort']
+    finally:
+        await esdb.close_point_in_time(id=pit_id)
+
+
+async def encode_ndjson(pages):
+    """
+    Encode films as newline delimited JSON.
+
+    Args:
+        pages (AsyncGenerator[list[dict]]): The films of each page.
+
+    Returns:
+        (AsyncGenerator[bytes]): The lines of each page of films.
+    """
+    async for films in pages:
+        yield b''.join(orjson.dumps(film, option=orjson.OPT_APPEND_NEWLINE)
+                       for film in films)
+
+
+async def encode_csv(pages):
+    """
+    Encode films as CSV, with a header row, and list values joined by commas.
+
+    Args:
+        pages (AsyncGenerator[list[dict]]): The films of each page.
+
+    Returns:
+        (AsyncGenerator[str]): The header, then the rows of each page of films.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.getvalue()
+    async for films in pages:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([', '.join(value) if isinstance(value, list) else value
+                          for value in film.values()] for film in films)
+        yield buffer.getvalue()
+
+
+async def search_page(search, cursor=None):
+    """
+    Retrieve a page of results against a point in time of the index,
+    so that pages stay consistent while the index changes.
+
+    Args:
+        search (dict): The search request parameters.
+        cursor (str): The cursor of the page to retrieve, None for the first page.
+
+    Returns:
+        (dict): The search result, including the point in time ID.
+    """
+    esdb = app.state.esdb
+    keep_alive = os.environ.get('PIT_KEEP_ALIVE', '1m')
+    if cursor is None:
+        pit = await esdb.open_point_in_time(index=os.environ['ELASTIC_INDEX'],
+                                            keep_alive=keep_alive)
+        pit_id, search_after = pit['id'], None
+    else:
+        pit_id, search_after = decode_cursor(cursor)
+
+    try:
+        # The shard doc order breaks ties between equal scores
+        return await esdb.search(pit={"id": pit_id, "keep_alive": keep_alive},
+                                 sort=["_score", {"_shard_doc": "asc"}],
+                                 search_after=search_after, **search)
+    except BaseException as exc:
+        # No cursor was handed out for a failed first page, so close its point in time
+        if cursor is None:
+            await esdb.close_point_in_time(id=pit_id)
+        if isinstance(exc, NotFoundError):
+            raise HTTPException(status_code=410, detail="The cursor has expired") from exc
+        raise
+
+
+def serialize(content, route, film_type, **kwargs):
+    """
+    Serialize a response body, timing it as the last stage of the request.
+
+    Args:
+        content (Any): The response data.
+        route (str): The route template, for labelling the timing.
+        film_type (str): The type of film requested, for labelling the timing.
+        **kwargs: Further arguments of the response, such as headers.
+
+    Returns:
+        (ORJSONResponse): The serialized response.
+    """
+    with STAGE_SECONDS.time(route=route, film_type=film_type, stage='serialize'):
+        return ORJSONResponse(content, **kwargs)
+
+
+def http_cache(request, max_age):
+    """
+    Build the caching headers of a read endpoint. Its responses only change
+    when new data is loaded, so the index generation is their ETag. The
+    generation is the counter shared under CACHE_DIR, which workers and
+    ingestion runs bump, including reindexes and rollbacks from the CLI.
+
+    Args:
+        request (Request): The request, for its If-None-Match header.
+        max_age (int): Seconds the response may be reused without
+            revalidating, 0 to revalidate on every use.
+
+    Returns:
+        (tuple[dict, bool]): The response headers, and whether the client
+            already holds the current response.
+    """
+    # Weak, as compression changes the bytes but not the content
+    etag = f'W/"{STARTED:x}-{index_generation.value}"'
+    headers = {'ETag': etag,
+               'Cache-Control': f"public, max-age={max_age}" if max_age else "no-cache"}
+    return headers, etag_matches(request.headers.get('if-none-match'), etag)
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Check an If-None-Match header against an ETag, using weak comparison.
+
+    Args:
+        if_none_match (str): The header value, None if absent.
+        etag (str): The current ETag.
+
+    Returns:
+        (bool): Whether the header lists the ETag.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag.removeprefix('W/') in tags
+
+
+@app.get("/api/suggest/{film_type}/", response_model=list[schemas.Suggestion])
+async def get_suggestions(request: Request, film_type: str, prefix: str,
+                          size: int = Query(5, ge=1, le=MAX_SIZE)):
+    """
+    API endpoint for retrieving title, director and cast completions
+    for the text typed so far.
+
+    Args:
+        request (Request): The request, for the database connection.
+        film_type (str): The type of film to suggest for, being 'movie' or 'show'.
+        prefix (str): The text typed so far.
+        size (int): The maximum number of suggestions.
+
+    Returns:
+        (list[dict]): The best suggestions, most common first.
+    """
+    if film_type not in {'movie', 'show'}:
+        detail = f"Expected 'movie' or 'show', got '{film_type}'"
+        raise HTTPException(status_code=404, detail=detail)
+    suggester.refresh_in_background(request.app.state.esdb, os.environ['ELASTIC_INDEX'],
+                                    index_generation.value)
+    return suggester.search(film_type, prefix, size)
+
+
 @app.get("/api/aggs/movie/", response_model=schemas.MovieAggs)
-async def get_movie_aggs():
+async def get_movie_aggs(request: Request):
     """
     API endpoint for retrieving movie aggregations from the Elasticsearch database.
-    
-    Returns:
-        (dict): The movie aggregation data retrieved from the database.
-    """
-    response = {}
-    query = {"term": {"type": 1}}
-    aggs = build_aggs(avg_duration=True, histo_duration=True)
-    result = await esdb.search(index=os.environ['ELASTIC_INDEX'], query=query,
-                                aggs=aggs, size=0, track_total_hits=True)
-    # Process the average aggregation
-    response['avg_dur_agg'] = int(result['aggregations']['avg_dur_agg']['value'])
-    # Process the total aggregation
-    response['total_agg'] = result['aggregations']['total_agg']['value']
-    # Process the histogram aggregation
-    response['histo_dur_agg'] = {}
-    for data in result['aggregations']['histo_dur_agg']['buckets']:
-        response['histo_dur_agg'][str(int(data["key"]))] = data["doc_count"]
 
-    return response
+    Args:
+        request (Request): The request, for its conditional headers.
+
+    Returns:
+        (Response): The movie aggregation data retrieved from the database.
+    """
+    return await aggs_response(request, 'movie', route='/api/aggs/movie/', film_type='movie')
 
 
 @app.get("/api/aggs/show/", response_model=schemas.ShowAggs)
-async def get_show_aggs():
+async def get_show_aggs(request: Request):
     """
     API endpoint for retrieving show aggregations from the Elasticsearch database.
-    
+
+    Args:
+        request (Request): The request, for its conditional headers.
+
     Returns:
-        (dict): The show aggregation data retrieved from the database.
+        (Response): The show aggregation data retrieved from the database.
     """
-    response = {}
-    query = {"term": {"type": 0}}
-    aggs = build_aggs()
-    result = await esdb.search(index=os.environ['ELASTIC_INDEX'], query=query,
-                                aggs=aggs, size=0, track_total_hits=True)
-    # Process the total aggregation
-    response['total_agg'] = result['aggregations']['total_agg']['value']
-
-    return response
+    return await aggs_response(request, 'show', route='/api/aggs/show/', film_type='show')
 
 
 @app.get("/api/aggs/", response_model=schemas.AllAggs)
-async def get_all_aggs():
+async def get_all_aggs(request: Request):
     """
     API endpoint for retrieving all aggregations from the Elasticsearch database.
-    
-    Returns:
-        (dict): The total aggregation data retrieved from the database.
-    """
-    response = {}
-    query = {"match_all": {}}
-    aggs = build_aggs(directors=True, actors=True, genres=True,
-                      countries=True, ratings=True)
-    result = await esdb.search(index=os.environ['ELASTIC_INDEX'], query=query,
-                                aggs=aggs, size=0, track_total_hits=True)
-    # Process the total aggregation
-    response['total_agg'] = result['aggregations']['total_agg']['value']
-    # Process the top aggregations
-    top_aggs = ['director_agg', 'actor_agg', 'rating_agg',
-                'country_agg', 'genre_agg']
-    for agg in top_aggs:
-        response[agg] = {}
-        for data in result['aggregations'][agg]['buckets']:
-            if agg == 'rating_agg':
-                key = schemas.ID_TO_RATING[data["key"]]
-            else:
-                key = data["key"]
-            response[agg][key] = data["doc_count"]
 
-    return response
+    Args:
+        request (Request): The request, for its conditional headers.
 
+    Returns:
+        (Response): The total aggregation data retrieved from the database.
+    """
+    return await aggs_response(request, 'total', route='/api/aggs/', film_type='all')
 
-def build_query(selector, search_text=''):
+
+@app.get("/api/aggs/combined/", response_model=schemas.CombinedAggs)
+async def get_combined_aggs(request: Request):
     """
-    A helper function for building the Elasticsearch query.
+    API endpoint for retrieving the total, movie and show aggregations
+    together, computed in a single Elasticsearch request.
 
     Args:
-        selector (str): The type of film to retrieve, being 'movie' or 'show'.
-        search_text (str): The query text to search for in the database.
+        request (Request): The request, for its conditional headers.
+
+    Returns:
+        (Response): The total, movie and show aggregation data.
+    """
+    return await aggs_response(request, None, route='/api/aggs/combined/', film_type='all')
+
+
+@app.get("/api/aggs/cache/", response_model=schemas.CacheStats)
+async def get_aggs_cache_stats():
+    """
+    API endpoint for retrieving the aggregation cache counters.
 
     Returns:
-        (dict): The Elasticsearch query.
+        (dict): The hit/miss counters and settings of the cache.
     """
-    # To optimize ES space, store as a byte
-    search_param = -1
-    if selector == 'movie':
-        search_param = 1
-    elif selector == "show":
-        search_param = 0
+    return aggs_cache.stats()
+
 
-    # Build the final query
-    if search_param == -1:
-        query = {"match_all": {}}
+async def aggs_response(request, part, route, film_type):
+    """
+    Respond with aggregations, or with a 304 if the client's copy is current.
+
+    Args:
+        request (Request): The request, for its conditional headers.
+        part (str): The part of the combined aggregations, None for all of them.
+        route (str): The route template, for labelling the timing.
+        film_type (str): The type of film requested, for labelling the timing.
+
+    Returns:
+        (Response): The aggregation data, or an empty 304 response.
+    """
+    headers, fresh = http_cache(request, max_age=HTTP_CACHE_MAX_AGE)
+    if fresh:
+        return Response(status_code=304, headers=headers)
+    if wants_profile(request):
+        # Profiled aggregations must reach the database, so they skip the cache
+        aggs = await fetch_combined_aggs(profile=True)
     else:
-        if not search_text:
-            query = {"match_none": {}}
-        else:
-            # We choose to NOT use wildcards here, performance not ideal.
-            # This should be implemented with an N-gram tokenizer.
-            search_fields = ['title', 'director', 'cast', 'country',
-                            'genres', 'description']
-            query = {
-                "bool": {
-                    "must": [
-                        {"term": {"type": search_param}},
-                        {"multi_match": {"query": search_text,
-                                        "fields": search_fields,
-                                        "operator": "and"}}
-                    ]
-                }
-            }
-
-    return query
-
-
-def build_aggs(**kwargs):
-    """
-    A helper function for building the Elasticsearch aggregations query.
-
-    Args:
-        avg_duration (bool): Whether to include the average duration aggregation.
-        histo_duration (bool): Whether to include the histogram duration aggregation.
-        directors (bool): Whether to include the director aggregation.
-        actors (bool): Whether to include the actor aggregation.
-        genres (bool): Whether to include the genre aggregation.
-        countries (bool): Whether to include the country aggregation.
-        ratings (bool): Whether to include the rating aggregation.
-        
-    Returns:
-        (dict): The Elasticsearch aggregations query.
-    """
-    # Always return the total aggregation
-    aggs = {
-        "total_agg": {"value_count": {"field": "type"}}
-    }
-
-    if kwargs.get("avg_duration", False):
-        aggs["avg_dur_agg"] = {"avg": {"field": "duration"}}
-    if kwargs.get("histo_duration", False):
-        aggs["histo_dur_agg"] = {"histogram": {"field": "duration",
-                                               "interval": 20,
-                                               "min_doc_count": 10}}
-    if kwargs.get("directors", False):
-        aggs["director_agg"] = {"terms": {"field": "director.keyword",
-                                          "size": 5}}
-    if kwargs.get("actors", False):
-        aggs["actor_agg"] = { "terms": {"field": "cast.keyword",
-                                        "size": 5}}
-    if kwargs.get("genres", False):
-        aggs["genre_agg"] = { "terms": {"field": "genres.keyword",
-                                           "size": 5}}
-    if kwargs.get("countries", False):
-        aggs["country_agg"] = {"terms": {"field": "country.keyword",
-                                         "size": 5}}
-    if kwargs.get("ratings", False):
-        aggs["rating_agg"] = {"terms": {"field": "rating",
-                                        "size": 5}}
-
-    return aggs
+        aggs = await combined_aggs()
+    return serialize(aggs if part is None else aggs[part], route=route,
+                     film_type=film_type, headers=headers)
+
+
+async def combined_aggs():
+    """
+    Retrieve every aggregation, from the cache if the index has not changed.
+
+    Returns:
+        (dict): The processed total, movie and show aggregation data.
+    """
+    return await aggs_cache.get_or_set('combined', fetch_combined_aggs)
+
+
+async def fetch_combined_aggs(profile=False):
+    """
+    Query the Elasticsearch database for every aggregation at once.
+
+    Args:
+        profile (bool): Whether to profile the query.
+
+    Returns:
+        (dict): The processed total, movie and show aggregation data.
+    """
+    start = time.perf_counter()
+    labels = {'route': '/api/aggs/combined/', 'film_type': 'all'}
+    with STAGE_SECONDS.time(stage='build', **labels):
+        search = {'query': {"match_all": {}}, 'aggs': build_combined_aggs(), 'size': 0}
+    sent = time.perf_counter()
+    with STAGE_SECONDS.time(stage='elasticsearch', **labels):
+        result = await app.state.esdb.search(index=os.environ['ELASTIC_INDEX'], **search)
+    seconds = time.perf_counter() - sent
+    ELASTIC_TOOK_SECONDS.observe(result['took'] / 1000, **labels)
+
+    with STAGE_SECONDS.time(stage='process', **labels):
+        aggregations = result['aggregations']
+        response = {
+            'total': process_all_aggs(aggregations),
+            'movie': process_movie_aggs(aggregations['movie_agg']),
+            'show': process_show_aggs(aggregations['show_agg'])
+        }
+    # Serialized once more only to be measured, on a cache miss
+    measures = {'elasticsearch': seconds, 'latency': time.perf_counter() - start,
+                'size': len(orjson.dumps(response))}
+    slow_log.observe(labels, search, result, measures,
+                     rerun=profile_search(search) if profile else None)
+    return response
@@ -0,0 +1,741 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for an in-process search engine standing in
+             for the Elasticsearch database, for deployments and tests
+             where the whole catalogue fits in memory.
+"""
+import re
+import math
+import calendar
+import time
+import itertools
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from unidecode import unidecode as ud
+
+
+# The analyzed text fields, matching the text fields of ELASTIC_MAP
+TEXT_FIELDS = ['title', 'director', 'cast', 'country', 'genres', 'description']
+# Words and numbers, keeping inner apostrophes like the standard tokenizer
+TOKEN_PATTERN = re.compile(r"\w+(?:'\w+)*")
+# Search parameters without an effect on in-memory results
+IGNORED_PARAMS = {'index', 'preference', 'request_cache', 'rest_total_hits_as_int',
+                  'ignore_unavailable', 'timeout'}
+# Search parameters supported besides the query, aggregations and size
+SEARCH_PARAMS = {'from_', 'sort', 'search_after', 'track_total_hits', 'source', '_source',
+                 'pit', 'scroll', 'profile'}
+# Scroll and point in time IDs, unique across engines
+CONTEXT_IDS = itertools.count()
+# BM25 parameters, matching the Elasticsearch defaults
+K1, B = 1.2, 0.75
+
+
+def analyze(text):
+    """
+    Split text into lowercase tokens without accents, like the folding analyzer.
+
+    Args:
+        text (str | list[str] | None): The text of a field.
+
+    Returns:
+        (list[str]): The tokens of the text.
+    """
+    return [token for value in as_list(text)
+            for token in TOKEN_PATTERN.findall(ud(value).lower())]
+
+
+def as_list(value):
+    """
+    Treat single and multi-valued fields alike.
+
+    Args:
+        value (Any): The value of a field.
+
+    Returns:
+        (list): The values of the field, empty if it is missing.
+    """
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def date_key(value):
+    """
+    Convert a date in the 'MMddyyyy' format of the mapping, or in the
+    ISO 'yyyy-MM-dd' format, into a sortable integer.
+
+    Args:
+        value (str): The date.
+
+    Returns:
+        (int | None): The date as yyyyMMdd, None if it is missing.
+    """
+    if not value:
+        return None
+    if '-' in value:
+        return int(value[:10].replace('-', ''))
+    return int(value[4:8] + value[:4])
+
+
+def edit_distance(first, second, limit):
+    """
+    Compute the Levenshtein distance between two words, giving up
+    once it exceeds the limit.
+
+    Args:
+        first (str): The first word.
+        second (str): The second word.
+        limit (int): The largest distance of interest.
+
+    Returns:
+        (int): The distance, or limit + 1 if it is larger than the limit.
+    """
+    if abs(len(first) - len(second)) > limit:
+        return limit + 1
+    previous = list(range(len(second) + 1))
+    for i, char in enumerate(first, 1):
+        current = [i]
+        for j, other in enumerate(second, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def count_total(count, track_total_hits):
+    """
+    Report the total hits of a search the way Elasticsearch does.
+
+    Args:
+        count (int): The number of matching documents.
+        track_total_hits (bool | int): How accurately to count the hits,
+            up to 10000 if None.
+
+    Returns:
+        (dict): The value and relation of the total, None if not counted.
+    """
+    if track_total_hits is None:
+        track_total_hits = 10000
+    if track_total_hits is False:
+        return None
+    limit = count if track_total_hits is True else track_total_hits
+    return {'value': min(count, limit), 'relation': 'eq' if count <= limit else 'gte'}
+
+
+class TextField:
+    """
+    An inverted index over an analyzed text field.
+
+    Attributes:
+        postings (dict[str, dict[int, int]]): The term frequency of each token
+            in each document containing it.
+        vocabulary (list[str]): The sorted tokens, for prefix lookups.
+    """
+    def __init__(self, values):
+        """
+        Args:
+            values (list): The value of the field in each document.
+        """
+        self.postings = defaultdict(dict)
+        self._lengths = []
+        for doc, value in enumerate(values):
+            tokens = analyze(value)
+            self._lengths.append(len(tokens))
+            for token, frequency in Counter(tokens).items():
+                self.postings[token][doc] = frequency
+        self.postings = dict(self.postings)
+        self.vocabulary = sorted(self.postings)
+        self._avg_length = sum(self._lengths) / max(len(self._lengths), 1) or 1.0
+
+    def lookup(self, token, prefix=False, fuzziness=0, prefix_length=0):
+        """
+        Find the documents containing a token.
+
+        Args:
+            token (str): The analyzed token.
+            prefix (bool): Whether to match tokens starting with it, like an
+                edge N-gram field.
+            fuzziness (int): The number of edits allowed to match a token.
+            prefix_length (int): The number of leading characters edits are not
+                allowed in.
+
+        Returns:
+            (dict[int, int]): The term frequency in each matching document.
+        """
+        if not (prefix or fuzziness):
+            return self.postings.get(token, {})
+
+        start = token if prefix else token[:prefix_length]
+        lo = bisect_left(self.vocabulary, start)
+        hi = bisect_left(self.vocabulary, start + '\uffff', lo)
+        matched = Counter()
+        for candidate in self.vocabulary[lo:hi]:
+            if prefix or edit_distance(token, candidate, fuzziness) <= fuzziness:
+                matched.update(self.postings[candidate])
+        return matched
+
+    def score(self, postings, doc):
+        """
+        Compute the BM25 score of a document for a looked up token.
+
+        Args:
+            postings (dict[int, int]): The result of looking up the token.
+            doc (int): The document to score.
+
+        Returns:
+            (float): The score of the document.
+        """
+        frequency = postings[doc]
+        idf = math.log(1 + (len(self._lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+        norm = K1 * (1 - B + B * self._lengths[doc] / self._avg_length)
+        return idf * frequency * (K1 + 1) / (frequency + norm)
+
+
+class MemoryIndices:
+    """The subset of the indices API the service calls at runtime."""
+    async def exists(self, **_):
+        """The in-memory index always exists."""
+        return True
+
+    async def exists_alias(self, **_):
+        """The in-memory index always exists."""
+        return True
+
+    async def refresh(self, **_):
+        """Loaded documents are searchable immediately."""
+        return {}
+
+
+class MemoryElasticsearch:
+    """
+    An in-process search engine answering the subset of the AsyncElasticsearch
+    API used by the service, so it can be used in place of a connection.
+    Text fields are searched through inverted indices, while filters and
+    aggregations run over columnar arrays of the stored fields.
+
+    Queries support match_all, match_none, term, terms, range, exists,
+    bool and multi_match, and aggregations support value_count, avg, min,
+    max, sum, terms, histogram, yearly date_histogram, filter and filters. Scoring is BM25, but
+    ties and analysis details can rank hits differently from Elasticsearch.
+
+    Attributes:
+        index (str): The name reported as the index of each hit.
+        indices (MemoryIndices): The indices API.
+    """
+    def __init__(self, index='memory'):
+        self.index = index
+        self.indices = MemoryIndices()
+        # The ID and source of each document, by position
+        self._docs = []
+        self._columns = {}
+        self._text = {}
+        self._terms = {}
+        self._scrolls = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def load(self, actions):
+        """
+        Replace the documents held in memory.
+
+        Args:
+            actions (Iterable[dict]): Bulk index actions, as built by get_row.
+
+        Returns:
+            None
+        """
+        self._docs = [(action['_id'], action['_source']) for action in actions]
+        fields = {field for _, source in self._docs for field in source}
+        self._columns = {field: [source.get(field) for _, source in self._docs]
+                         for field in fields}
+        self._text = {field: TextField(self._columns.get(field, [None] * len(self)))
+                      for field in TEXT_FIELDS}
+        self._terms = {}
+
+    def options(self, **_):
+        """
+        Return the client itself, ignoring any transport options.
+
+        Returns:
+            (MemoryElasticsearch): The client.
+        """
+        return self
+
+    async def close(self):
+        """There is no connection to close."""
+
+    async def ping(self):
+        """
+        Check that the engine is available, which it always is.
+
+        Returns:
+            (bool): True.
+        """
+        return True
+
+    async def msearch(self, searches, index=None, **_):
+        """
+        Run several searches at once. A failed search is reported in
+        its own response, without failing the others.
+
+        Args:
+            searches (list[dict]): Alternating headers and search bodies.
+            index (str): The index of searches whose header names none.
+
+        Returns:
+            (dict): The response of each search, in order.
+        """
+        responses = []
+        for header, body in zip(searches[0::2], searches[1::2]):
+            body = dict(body)
+            if 'from' in body:
+                body['from_'] = body.pop('from')
+            try:
+                response = await self.search(index=header.get('index', index), **body)
+                response['status'] = 200
+            except (TypeError, ValueError, KeyError) as exc:
+                response = {'error': {'type': 'parsing_exception', 'reason': str(exc)},
+                            'status': 400}
+            responses.append(response)
+        return {'took': sum(response.get('took', 0) for response in responses),
+                'responses': responses}
+
+    async def count(self, query=None, **_):
+        """
+        Count the documents matching a query.
+
+        Args:
+            query (dict): The query DSL, defaults to match_all.
+
+        Returns:
+            (dict): The number of matching documents.
+        """
+        return {'count': len(self._evaluate(query or {"match_all": {}}))}
+
+    async def search(self, query=None, aggs=None, size=10, **params):
+        """
+        Search the documents, returning a response shaped like Elasticsearch's.
+
+        Args:
+            query (dict): The query DSL, defaults to match_all.
+            aggs (dict): The aggregations to compute over matching documents.
+            size (int): The number of hits to return.
+            from_ (int): The number of hits to skip.
+            sort (list): The sort order, defaults to descending score.
+            search_after (list): The sort values of the hit to continue after.
+            track_total_hits (bool | int): How accurately to count the hits.
+            source (bool | list | dict): The source fields to return, also
+                accepted as _source.
+            pit (dict): The point in time, echoed back in the response.
+            scroll (str): Keep the remaining hits for scroll requests.
+            profile (bool): Whether to time the query, sorting and each
+                aggregation, reported like a single shard profile.
+
+        Returns:
+            (dict): The search response.
+        """
+        marks = [time.perf_counter()]
+        unexpected = set(params) - SEARCH_PARAMS - IGNORED_PARAMS
+        if unexpected:
+            raise TypeError(f"Unexpected search parameters {sorted(unexpected)}")
+        query = query or {"match_all": {}}
+        scores = self._evaluate(query)
+        marks.append(time.perf_counter())
+        hits = self._ranked_hits(scores, params)
+        marks.append(time.perf_counter())
+        response = {'timed_out': False,
+                    '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                    'hits': {'max_score': max(scores.values(), default=None),
+                             'hits': hits[:size]}}
+        total = count_total(len(scores), params.get('track_total_hits'))
+        if total is not None:
+            response['hits']['total'] = total
+
+        timings = []
+        if aggs:
+            response['aggregations'] = {}
+            for name, spec in aggs.items():
+                aggregated = time.perf_counter()
+                response['aggregations'].update(self._aggregate({name: spec}, list(scores)))
+                timings.append((name, spec, time.perf_counter() - aggregated))
+        if params.get('profile'):
+            response['profile'] = self._profile(query, marks, timings)
+        if params.get('pit') is not None:
+            response['pit_id'] = params['pit']['id']
+        if params.get('scroll') is not None:
+            response['_scroll_id'] = str(next(CONTEXT_IDS))
+            self._scrolls[response['_scroll_id']] = (hits, size)
+        response['took'] = int((time.perf_counter() - marks[0]) * 1000)
+        return response
+
+    async def scroll(self, scroll_id, **_):
+        """
+        Retrieve the next batch of hits of a scrolled search.
+
+        Args:
+            scroll_id (str): The scroll ID of the search.
+
+        Returns:
+            (dict): The search response for the next batch.
+        """
+        hits, size = self._scrolls.get(scroll_id, ([], 0))
+        hits = hits[size:]
+        self._scrolls[scroll_id] = (hits, size)
+        return {'_scroll_id': scroll_id,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'hits': hits[:size]}}
+
+    async def clear_scroll(self, scroll_id, **_):
+        """
+        Release the hits kept for a scrolled search.
+
+        Args:
+            scroll_id (str): The scroll ID of the search.
+
+        Returns:
+            (dict): The acknowledgement.
+        """
+        self._scrolls.pop(scroll_id, None)
+        return {'succeeded': True}
+
+    async def open_point_in_time(self, **_):
+        """
+        Open a point in time. Documents only change on load, so there
+        is nothing to keep.
+
+        Returns:
+            (dict): The point in time ID.
+        """
+        return {'id': f"memory-{next(CONTEXT_IDS)}"}
+
+    async def close_point_in_time(self, **_):
+        """
+        Close a point in time.
+
+        Returns:
+            (dict): The acknowledgement.
+        """
+        return {'succeeded': True}
+
+    def _ranked_hits(self, scores, params):
+        sort = params.get('sort')
+        docs, sort_values = self._sort(scores, sort)
+        if params.get('search_after') is not None:
+            docs = [doc for doc in docs
+                    if self._is_after(sort_values[doc], params['search_after'], sort)]
+        source = params.get('_source', params.get('source'))
+        return [self._hit(doc, scores[doc], sort_values.get(doc), source)
+                for doc in docs[params.get('from_', 0):]]
+
+    def _profile(self, query, marks, timings):
+        def nanos(seconds):
+            return int(seconds * 1e9)
+        start, evaluated, sorted_at = marks
+        (kind, _), = query.items()
+        aggregations = [{'type': next(key for key in spec if key not in {'aggs', 'aggregations'}),
+                         'description': name, 'time_in_nanos': nanos(seconds), 'children': []}
+                        for name, spec, seconds in timings]
+        return {'shards': [{
+            'id': f"[memory][{self.index}][0]",
+            'searches': [{'query': [{'type': kind, 'description': str(query),
+                                     'time_in_nanos': nanos(evaluated - start),
+                                     'children': []}],
+                          'rewrite_time': 0,
+                          'collector': [{'name': 'sort', 'reason': 'search_top_hits',
+                                         'time_in_nanos': nanos(sorted_at - evaluated)}]}],
+            'aggregations': aggregations}]}
+
+    def _hit(self, doc, score, sort_values, source):
+        if source is False:
+            selected = None
+        elif source in (None, True):
+            selected = dict(self._docs[doc][1])
+        else:
+            includes = source if isinstance(source, list) else source.get('includes')
+            excludes = [] if isinstance(source, list) else source.get('excludes', [])
+            selected = {field: value for field, value in self._docs[doc][1].items()
+                        if (not includes or field in includes) and field not in excludes}
+        hit = {'_index': self.index, '_id': self._docs[doc][0], '_score': score}
+        if selected is not None:
+            hit['_source'] = selected
+        if sort_values is not None:
+            hit['sort'] = list(sort_values)
+        return hit
+
+    def _column(self, field):
+        # Keyword subfields hold the same values as their text field
+        column = self._columns.get(field.removesuffix('.keyword'))
+        return [None] * len(self) if column is None else column
+
+    def _values(self, field, doc):
+        value = self._column(field)[doc]
+        if field.removesuffix('.keyword') == 'date_added':
+            value = date_key(value)
+        return as_list(value)
+
+    def _term_docs(self, field, value):
+        # Exact term lookups are cached per field, as the type filter is on every search
+        if field not in self._terms:
+            terms = defaultdict(set)
+            for doc in range(len(self)):
+                for item in self._values(field, doc):
+                    terms[item].add(doc)
+            self._terms[field] = terms
+        if field.removesuffix('.keyword') == 'date_added':
+            value = date_key(value)
+        return self._terms[field].get(value, set())
+
+    def _evaluate(self, query):
+        """Return the score of each document matching the query."""
+        (kind, spec), = query.items()
+        evaluate = {'match_all': lambda _: dict.fromkeys(range(len(self)), 1.0),
+                    'match_none': lambda _: {},
+                    'term': self._term,
+                    'terms': self._terms_query,
+                    'range': self._range,
+                    'exists': self._exists,
+                    'bool': self._bool,
+                    'multi_match': self._multi_match}.get(kind)
+        if evaluate is None:
+            raise ValueError(f"Unsupported query '{kind}'")
+        return evaluate(spec)
+
+    def _term(self, spec):
+        (field, value), = spec.items()
+        value = value['value'] if isinstance(value, dict) else value
+        return dict.fromkeys(self._term_docs(field, value), 1.0)
+
+    def _terms_query(self, spec):
+        (field, values), = spec.items()
+        docs = set().union(*(self._term_docs(field, value) for value in values))
+        return dict.fromkeys(docs, 1.0)
+
+    def _range(self, spec):
+        (field, bounds), = spec.items()
+        return dict.fromkeys(self._range_docs(field, bounds), 1.0)
+
+    def _exists(self, spec):
+        return dict.fromkeys((doc for doc in range(len(self))
+                              if self._values(spec['field'], doc)), 1.0)
+
+    def _range_docs(self, field, bounds):
+        convert = date_key if field == 'date_added' else (lambda value: value)
+        checks = {'gte': lambda value, bound: value >= bound,
+                  'gt': lambda value, bound: value > bound,
+                  'lte': lambda value, bound: value <= bound,
+                  'lt': lambda value, bound: value < bound}
+        limits = [(checks[op], convert(bound)) for op, bound in bounds.items()
+                  if op in checks and bound is not None]
+        return {doc for doc in range(len(self))
+                if any(all(check(value, bound) for check, bound in limits)
+                       for value in self._values(field, doc))}
+
+    def _bool(self, spec):
+        scores = None
+        for clause in as_list(spec.get('must')) + as_list(spec.get('filter')):
+            matched = self._evaluate(clause)
+            # Filter clauses match without contributing to the score
+            weight = 1.0 if clause in as_list(spec.get('must')) else 0.0
+            if scores is None:
+                scores = {doc: score * weight for doc, score in matched.items()}
+            else:
+                scores = {doc: score + matched[doc] * weight
+                          for doc, score in scores.items() if doc in matched}
+
+        should = [self._evaluate(clause) for clause in as_list(spec.get('should'))]
+        default_minimum = 0 if scores is not None else 1 if should else 0
+        minimum = int(spec.get('minimum_should_match', default_minimum))
+        if scores is None:
+            scores = dict.fromkeys(range(len(self)), 0.0 if should else 1.0)
+        if should:
+            counts = Counter(doc for matched in should for doc in matched)
+            scores = {doc: score + sum(matched.get(doc, 0.0) for matched in should)
+                      for doc, score in scores.items() if counts[doc] >= minimum}
+
+        for clause in as_list(spec.get('must_not')):
+            excluded = self._evaluate(clause)
+            scores = {doc: score for doc, score in scores.items() if doc not in excluded}
+        return scores
+
+    def _multi_match(self, spec):
+        tokens = analyze(spec['query'])
+        if not tokens:
+            return {}
+        scores = {}
+        for name in spec.get('fields', TEXT_FIELDS):
+            name, _, boost = name.partition('^')
+            field, _, subfield = name.partition('.')
+            if field not in self._text or subfield not in {'', 'prefix'}:
+                continue
+            postings = self._postings(field, subfield, tokens, spec)
+            if spec.get('operator', 'or').lower() == 'and':
+                docs = set.intersection(*(set(matched) for matched in postings))
+            else:
+                docs = set().union(*postings)
+            # Each document keeps the score of its best matching field
+            for doc in docs:
+                score = float(boost or 1) * sum(self._text[field].score(matched, doc)
+                                                for matched in postings if doc in matched)
+                if score > scores.get(doc, -1.0):
+                    scores[doc] = score
+        return scores
+
+    def _postings(self, field, subfield, tokens, spec):
+        postings = []
+        for token in tokens:
+            # Fuzziness AUTO allows no edits below 3 characters, 2 above 5
+            edits = 0
+            if spec.get('fuzziness', 0) and not subfield:
+                edits = 0 if len(token) < 3 else 1 if len(token) < 6 else 2
+            postings.append(self._text[field].lookup(
+                token, prefix=subfield == 'prefix',
+                fuzziness=edits, prefix_length=spec.get('prefix_length', 0)))
+        return postings
+
+    def _sort(self, scores, sort):
+        if not sort:
+            return sorted(scores, key=lambda doc: (-scores[doc], doc)), {}
+        keys = []
+        for item in as_list(sort):
+            field, order = (item, None) if isinstance(item, str) else next(iter(item.items()))
+            order = order.get('order') if isinstance(order, dict) else order
+            if order is None:
+                order = 'desc' if field == '_score' else 'asc'
+            keys.append((field, order == 'desc'))
+
+        def value(doc, field):
+            if field == '_score':
+                return scores[doc]
+            if field in {'_doc', '_shard_doc'}:
+                return doc
+            values = self._values(field, doc)
+            return values[0] if values else None
+
+        sort_values = {doc: tuple(value(doc, field) for field, _ in keys) for doc in scores}
+        docs = sorted(scores)
+        # Stable sorts from the last key to the first, missing values last
+        for position, (field, descending) in reversed(list(enumerate(keys))):
+            present = [doc for doc in docs if sort_values[doc][position] is not None]
+            missing = [doc for doc in docs if sort_values[doc][position] is None]
+            docs = sorted(present, key=lambda doc, position=position: sort_values[doc][position],
+                          reverse=descending) + missing
+        return docs, sort_values
+
+    @staticmethod
+    def _is_after(values, search_after, sort):
+        for position, (value, after) in enumerate(zip(values, search_after)):
+            item = as_list(sort)[position]
+            field, order = (item, None) if isinstance(item, str) else next(iter(item.items()))
+            order = order.get('order') if isinstance(order, dict) else order
+            descending = (order or ('desc' if field == '_score' else 'asc')) == 'desc'
+            if value == after:
+                continue
+            if value is None or after is None:
+                return after is not None
+            return value < after if descending else value > after
+        return False
+
+    def _aggregate(self, aggs, docs):
+        """Compute the aggregations over the given documents."""
+        results = {}
+        for name, spec in aggs.items():
+            sub_aggs = spec.get('aggs') or spec.get('aggregations')
+            kind, params = next((key, value) for key, value in spec.items()
+                                if key not in {'aggs', 'aggregations'})
+            if kind in {'filter', 'filters'}:
+                results[name] = self._filter_agg(kind, params, docs, sub_aggs)
+                continue
+
+            values = [(doc, value) for doc in docs
+                      for value in self._values(params['field'], doc)]
+            numbers = [value for _, value in values]
+            if kind == 'value_count':
+                results[name] = {'value': len(values)}
+            elif kind == 'avg':
+                results[name] = {'value': sum(numbers) / len(numbers) if numbers else None}
+            elif kind == 'sum':
+                results[name] = {'value': float(sum(numbers))}
+            elif kind in {'min', 'max'}:
+                results[name] = {'value': float({'min': min, 'max': max}[kind](numbers))
+                                 if numbers else None}
+            elif kind == 'terms':
+                results[name] = self._terms_agg(params, values, sub_aggs)
+            elif kind == 'histogram':
+                results[name] = self._histogram_agg(params, values, sub_aggs)
+            elif kind == 'date_histogram':
+                results[name] = self._date_histogram_agg(params, values, sub_aggs)
+            else:
+                raise ValueError(f"Unsupported aggregation '{kind}'")
+        return results
+
+    def _bucket(self, key, docs, sub_aggs):
+        bucket = {'key': key, 'doc_count': len(docs)}
+        if sub_aggs:
+            bucket.update(self._aggregate(sub_aggs, sorted(docs)))
+        return bucket
+
+    def _filter_agg(self, kind, params, docs, sub_aggs):
+        if kind == 'filter':
+            matched = self._evaluate(params)
+            bucket = self._bucket(None, [doc for doc in docs if doc in matched], sub_aggs)
+            bucket.pop('key')
+            return bucket
+        buckets = {}
+        for key, query in params['filters'].items():
+            matched = self._evaluate(query)
+            buckets[key] = self._bucket(key, [doc for doc in docs if doc in matched], sub_aggs)
+            buckets[key].pop('key')
+        return {'buckets': buckets}
+
+    def _terms_agg(self, params, values, sub_aggs):
+        grouped = defaultdict(set)
+        for doc, value in values:
+            grouped[value].add(doc)
+        # Most documents first, ties broken by ascending key
+        ranked = sorted(grouped, key=lambda key: (-len(grouped[key]), key))
+        size = params.get('size', 10)
+        return {'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': sum(len(grouped[key]) for key in ranked[size:]),
+                'buckets': [self._bucket(key, grouped[key], sub_aggs)
+                            for key in ranked[:size]]}
+
+    def _histogram_agg(self, params, values, sub_aggs):
+        interval = params['interval']
+        grouped = defaultdict(set)
+        for doc, value in values:
+            grouped[math.floor(value / interval) * interval].add(doc)
+        min_doc_count = params.get('min_doc_count', 0)
+        keys = sorted(grouped)
+        if min_doc_count == 0 and keys:
+            # Empty buckets between the first and last are filled in
+            keys = [keys[0] + step * interval
+                    for step in range(int((keys[-1] - keys[0]) / interval) + 1)]
+        return {'buckets': [self._bucket(float(key), grouped.get(key, set()), sub_aggs)
+                            for key in keys if len(grouped.get(key, ())) >= min_doc_count]}
+
+    def _date_histogram_agg(self, params, values, sub_aggs):
+        if params.get('calendar_interval') not in {'year', '1y'}:
+            raise ValueError("Only yearly date histograms are supported")
+        grouped = defaultdict(set)
+        for doc, value in values:
+            # Dates are held as yyyyMMdd integers
+            grouped[value // 10000].add(doc)
+        min_doc_count = params.get('min_doc_count', 0)
+        keys = sorted(grouped)
+        if min_doc_count == 0 and keys:
+            keys = list(range(keys[0], keys[-1] + 1))
+        buckets = []
+        for year in keys:
+            if len(grouped.get(year, ())) < min_doc_count:
+                continue
+            # Keyed like Elasticsearch, by the epoch milliseconds of the year start
+            bucket = self._bucket(calendar.timegm((year, 1, 1, 0, 0, 0)) * 1000,
+                                  grouped.get(year, set()), sub_aggs)
+            # Only the year part of a format is honoured
+            bucket['key_as_string'] = str(year) if params.get('format') == 'yyyy' \
+                else f"0101{year}"
+            buckets.append(bucket)
+        return {'buckets': buckets}
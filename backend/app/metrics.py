@@ -0,0 +1,376 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for collecting request and ingestion metrics,
+             and exposing them in the Prometheus text format.
+"""
+import os
+import glob
+import time
+import pickle
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# Latency buckets in seconds, fine enough to tell apart sub-millisecond stages
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    A named metric, with one value per combination of label values.
+
+    Attributes:
+        name (str): The metric name.
+        documentation (str): The help text of the metric.
+        labels (tuple[str]): The label names.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def merge(self, current, other):
+        """
+        Combine the values of the same series from two processes.
+
+        Args:
+            current (Any): The value collected so far.
+            other (Any): The value of another process.
+
+        Returns:
+            (Any): The combined value.
+        """
+        return current + other
+
+    def samples(self, key, value):
+        """
+        Build the exposition lines of a series.
+
+        Args:
+            key (tuple[str]): The label values of the series.
+            value (Any): The value of the series.
+
+        Returns:
+            (list[str]): The sample lines.
+        """
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    """A metric that only goes up, such as a number of requests."""
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """
+        Increase the counter.
+
+        Args:
+            amount (float): The amount to add.
+            **labels: The label values of the series.
+
+        Returns:
+            None
+        """
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A metric that is set to its latest value, such as a throughput.
+    Each series holds the time it was set at and its value.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """
+        Set the gauge.
+
+        Args:
+            value (float): The new value.
+            **labels: The label values of the series.
+
+        Returns:
+            None
+        """
+        self.values[self._key(labels)] = (time.time(), value)
+
+    def merge(self, current, other):
+        # The processes measure the same thing, so keep the latest reading
+        return max(current, other)
+
+    def samples(self, key, value):
+        return super().samples(key, value[1])
+
+
+class Histogram(Metric):
+    """
+    A metric counting observations into buckets, such as latencies.
+    Each series holds its per-bucket counts, the sum and the count.
+
+    Attributes:
+        buckets (tuple[float]): The upper bounds of the buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS,
+                 registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """
+        Record an observation.
+
+        Args:
+            value (float): The observed value.
+            **labels: The label values of the series.
+
+        Returns:
+            None
+        """
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # One more bucket than bounds, for values above the last bound
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the block.
+
+        Args:
+            **labels: The label values of the series.
+
+        Returns:
+            (ContextManager): The timed block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def merge(self, current, other):
+        return [[a + b for a, b in zip(current[0], other[0])],
+                current[1] + other[1], current[2] + other[2]]
+
+    def samples(self, key, value):
+        counts, total, count = value
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += bucket_count
+            labels = format_labels(self.labels + ('le',), key + (str(bound),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def format_labels(names, values):
+    """
+    Format label pairs for the exposition format.
+
+    Args:
+        names (tuple[str]): The label names.
+        values (tuple[str]): The label values.
+
+    Returns:
+        (str): The braced label pairs, empty without labels.
+    """
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"')
+                                      .replace('\n', '\\n'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Registry:
+    """
+    The metrics of the process. With a directory, every process writes
+    its values there, and rendering combines those of all processes, so
+    any gunicorn worker answering a scrape reports for the whole host.
+
+    Attributes:
+        metrics (dict[str, Metric]): The registered metrics, by name.
+        directory (str): The directory shared by the processes, if any.
+    """
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.metrics = {}
+        self.directory = directory
+        self._flush_interval = flush_interval
+        self._flushed = 0.0
+        self._pid = None
+        self._filename = None
+
+    def register(self, metric):
+        """
+        Add a metric to the registry.
+
+        Args:
+            metric (Metric): The metric to add.
+
+        Returns:
+            None
+        """
+        self.metrics[metric.name] = metric
+
+    def flush(self):
+        """
+        Write the values of this process to the shared directory.
+
+        Returns:
+            None
+        """
+        self._flushed = time.monotonic()
+        if self.directory is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pid != os.getpid():
+            # PIDs repeat across container restarts, so a new worker must
+            # not overwrite the file of an exited one
+            self._pid = os.getpid()
+            self._filename = f"{self._pid}-{uuid.uuid4().hex}.pickle"
+        path = os.path.join(self.directory, self._filename)
+        with open(f"{path}.tmp", 'wb') as file:
+            pickle.dump({name: metric.values for name, metric in self.metrics.items()}, file)
+        os.replace(f"{path}.tmp", path)
+
+    def maybe_flush(self):
+        """
+        Write the values of this process, at most once per flush interval.
+
+        Returns:
+            None
+        """
+        if self.directory is not None and time.monotonic() - self._flushed > self._flush_interval:
+            self.flush()
+
+    def collect(self):
+        """
+        Combine the values of every process sharing the directory.
+
+        Returns:
+            (dict[str, dict]): The values of each metric, by name.
+        """
+        if self.directory is None:
+            return {name: metric.values for name, metric in self.metrics.items()}
+        self.flush()
+        combined = {name: {} for name in self.metrics}
+        # Files of exited workers are kept, so counters never go backwards
+        for path in glob.glob(os.path.join(self.directory, '*.pickle')):
+            try:
+                with open(path, 'rb') as file:
+                    snapshot = pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                continue
+            for name, values in snapshot.items():
+                if name not in self.metrics:
+                    continue
+                metric = self.metrics[name]
+                for key, value in values.items():
+                    current = combined[name].get(key)
+                    combined[name][key] = value if current is None else metric.merge(current, value)
+        return combined
+
+    def render(self):
+        """
+        Render every metric in the Prometheus text exposition format.
+
+        Returns:
+            (str): The exposition text.
+        """
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for key, value in sorted(values.items()):
+                lines.extend(metric.samples(key, value))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    """
+    An ASGI middleware counting requests and timing them, labelled by
+    the route template rather than the path, to keep the series bounded.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            self.record(scope, status, time.perf_counter() - start)
+
+    @staticmethod
+    def record(scope, status, seconds):
+        """
+        Count and time a handled request, by its route template.
+
+        Args:
+            scope (dict): The ASGI scope of the request, after routing.
+            status (int): The response status, 500 if none was sent.
+            seconds (float): Seconds the request took.
+
+        Returns:
+            None
+        """
+        route = getattr(scope.get('route'), 'path', 'unmatched')
+        REQUESTS.inc(route=route, method=scope['method'], status=status)
+        REQUEST_SECONDS.observe(seconds, route=route, method=scope['method'])
+        REGISTRY.maybe_flush()
+
+
+# Shared through CACHE_DIR by the workers of a host, like the caches
+REGISTRY = Registry(os.path.join(os.environ['CACHE_DIR'], 'metrics')
+                    if os.environ.get('CACHE_DIR') else None)
+
+REQUESTS = Counter('http_requests_total', "HTTP requests handled.",
+                   ['route', 'method', 'status'])
+REQUEST_SECONDS = Histogram('http_request_duration_seconds',
+                            "Time to handle an HTTP request.", ['route', 'method'])
+STAGE_SECONDS = Histogram('request_stage_duration_seconds',
+                          "Time spent in each stage of a search or aggregation request.",
+                          ['route', 'film_type', 'stage'])
+ELASTIC_TOOK_SECONDS = Histogram('elasticsearch_took_seconds',
+                                 "Time Elasticsearch reports spending on a search.",
+                                 ['route', 'film_type'])
+INGEST_ROWS = Counter('ingest_rows_total', "Rows written to the index.", ['mode'])
+INGEST_BYTES = Counter('ingest_bytes_total', "Bytes of documents written to the index.",
+                       ['mode'])
+INGEST_ERRORS = Counter('ingest_errors_total', "Documents the bulk API failed to write.",
+                        ['mode'])
+INGEST_SECONDS = Histogram('ingest_duration_seconds', "Time taken by an ingestion run.",
+                           ['mode'], buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+INGEST_ROWS_PER_SECOND = Gauge('ingest_rows_per_second',
+                               "Throughput of the latest ingestion run.", ['mode'])
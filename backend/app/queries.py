@@ -0,0 +1,406 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for building the Elasticsearch
+             searches, filters and aggregations of the API, and
+             processing their results into responses and page cursors.
+"""
+import os
+import json
+import base64
+import binascii
+import unicodedata
+from fastapi import HTTPException
+import schemas
+
+
+def build_search(film_type, params):
+    """
+    Build the parameters of a film search.
+
+    Args:
+        film_type (str): The type of film to retrieve, being 'movie' or 'show'.
+        params (FilmQuery): The query text, filters and options of the search.
+
+    Returns:
+        (dict): The search request parameters.
+    """
+    track_total_hits = params.track_total_hits
+    if track_total_hits is None:
+        track_total_hits = True
+    # Only the fields of the response are fetched, leaving out the rest
+    search = {'query': build_query(film_type, params.query, params.fuzzy,
+                                   build_filters(params)),
+              'size': params.size, 'source': schemas.FILM_FIELDS,
+              'track_total_hits': track_total_hits or False}
+    if params.facets:
+        search['aggs'] = build_facets()
+    return search
+
+
+def normalize_query(text):
+    """
+    Normalize search text no further than the index analyzes it, ignoring
+    case, accents and extraneous whitespace, so that equivalent searches
+    share a cache entry.
+
+    Args:
+        text (str): The query text.
+
+    Returns:
+        (str): The normalized query text.
+    """
+    # Only combining marks are dropped, since transliterating the rest
+    # would merge searches the analyzer keeps apart
+    text = ''.join(char for char in unicodedata.normalize('NFKD', text.casefold())
+                   if not unicodedata.combining(char))
+    return ' '.join(text.split())
+
+
+def encode_cursor(pit_id, search_after):
+    """
+    Encode the position of the next page into an opaque cursor.
+
+    Args:
+        pit_id (str): The point in time ID of the search.
+        search_after (list): The sort values of the last hit.
+
+    Returns:
+        (str): The cursor token.
+    """
+    payload = json.dumps([pit_id, search_after], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor into the position of the page it points to.
+
+    Args:
+        cursor (str): The cursor token.
+
+    Returns:
+        (tuple[str, list]): The point in time ID, and the sort values to search after.
+    """
+    try:
+        pit_id, search_after = json.loads(base64.urlsafe_b64decode(cursor))
+    except (binascii.Error, ValueError, TypeError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    return pit_id, search_after
+
+
+def build_query(selector, search_text='', fuzzy=False, filters=None):
+    """
+    A helper function for building the Elasticsearch query.
+
+    Args:
+        selector (str): The type of film to retrieve, being 'movie' or 'show'.
+        search_text (str): The query text to search for in the database.
+        fuzzy (bool): Whether to also match words with typos.
+        filters (list[dict]): Further clauses the films must match, without
+            affecting their score.
+
+    Returns:
+        (dict): The Elasticsearch query.
+    """
+    # To optimize ES space, store as a byte
+    search_param = -1
+    if selector == 'movie':
+        search_param = 1
+    elif selector == "show":
+        search_param = 0
+
+    # Build the final query
+    if search_param == -1:
+        query = {"match_all": {}}
+    else:
+        if not search_text and not filters:
+            query = {"match_none": {}}
+        else:
+            # Partial words match through the edge N-gram prefix fields,
+            # which are plain term lookups unlike wildcards.
+            search_fields = ['title', 'director', 'cast', 'country',
+                            'genres', 'description']
+            prefix_fields = ['title.prefix', 'director.prefix', 'cast.prefix']
+            text_query = {"multi_match": {"query": search_text,
+                                          "fields": search_fields + prefix_fields,
+                                          "operator": "and"}}
+            if fuzzy:
+                # Fuzzy matching N-grams would match almost anything,
+                # so typos are only tolerated on whole words
+                text_query = {"bool": {"should": [
+                    text_query,
+                    {"multi_match": {"query": search_text,
+                                     "fields": search_fields,
+                                     "operator": "and",
+                                     "fuzziness": "AUTO",
+                                     "prefix_length": 1}}
+                ]}}
+            # Exact matches go in filter context, unscored and cached as bitsets
+            query = {
+                "bool": {
+                    "filter": [
+                        {"term": {"type": search_param}},
+                        *(filters or [])
+                    ]
+                }
+            }
+            if search_text:
+                query["bool"]["must"] = [text_query]
+
+    return query
+
+
+def build_filters(filters):
+    """
+    A helper function for building the filter clauses of a film search.
+
+    Args:
+        filters (FilmFilters): The ranges and values the films must match.
+
+    Returns:
+        (list[dict]): The Elasticsearch filter clauses.
+    """
+    clauses = []
+    ranges = [('release_year', filters.release_year_min, filters.release_year_max, {}),
+              ('duration', filters.duration_min, filters.duration_max, {}),
+              # Bounds are given as ISO dates, unlike the indexed format
+              ('date_added', filters.date_added_from and filters.date_added_from.isoformat(),
+               filters.date_added_to and filters.date_added_to.isoformat(),
+               {"format": "yyyy-MM-dd"})]
+    for field, low, high, options in ranges:
+        bounds = {op: bound for op, bound in (("gte", low), ("lte", high)) if bound is not None}
+        if bounds:
+            clauses.append({"range": {field: {**bounds, **options}}})
+    if filters.rating:
+        clauses.append({"terms": {"rating": [schemas.RATING_TO_ID[rating]
+                                             for rating in filters.rating]}})
+    if filters.genres:
+        clauses.append({"terms": {"genres.keyword": filters.genres}})
+    if filters.country:
+        clauses.append({"terms": {"country.keyword": filters.country}})
+    return clauses
+
+
+def build_aggs(**kwargs):
+    """
+    A helper function for building the Elasticsearch aggregations query.
+
+    Args:
+        avg_duration (bool): Whether to include the average duration aggregation.
+        histo_duration (bool): Whether to include the histogram duration aggregation.
+        directors (bool): Whether to include the director aggregation.
+        actors (bool): Whether to include the actor aggregation.
+        genres (bool): Whether to include the genre aggregation.
+        countries (bool): Whether to include the country aggregation.
+        ratings (bool): Whether to include the rating aggregation.
+        years (bool): Whether to include the release decade aggregation.
+        added (bool): Whether to include the year added aggregation.
+        size (int): The number of buckets of the top aggregations, 5 by default.
+        
+    Returns:
+        (dict): The Elasticsearch aggregations query.
+    """
+    # Always return the total aggregation
+    aggs = {
+        "total_agg": {"value_count": {"field": "type"}}
+    }
+
+    if kwargs.get("avg_duration", False):
+        aggs["avg_dur_agg"] = {"avg": {"field": "duration"}}
+    if kwargs.get("histo_duration", False):
+        aggs["histo_dur_agg"] = {"histogram": {"field": "duration",
+                                               "interval": 20,
+                                               "min_doc_count": 10}}
+    size = kwargs.get("size", 5)
+    if kwargs.get("directors", False):
+        aggs["director_agg"] = {"terms": {"field": "director.keyword",
+                                          "size": size}}
+    if kwargs.get("actors", False):
+        aggs["actor_agg"] = { "terms": {"field": "cast.keyword",
+                                        "size": size}}
+    if kwargs.get("genres", False):
+        aggs["genre_agg"] = { "terms": {"field": "genres.keyword",
+                                           "size": size}}
+    if kwargs.get("countries", False):
+        aggs["country_agg"] = {"terms": {"field": "country.keyword",
+                                         "size": size}}
+    if kwargs.get("ratings", False):
+        aggs["rating_agg"] = {"terms": {"field": "rating",
+                                        "size": size}}
+    if kwargs.get("years", False):
+        aggs["year_agg"] = {"histogram": {"field": "release_year",
+                                          "interval": 10,
+                                          "min_doc_count": 1}}
+    if kwargs.get("added", False):
+        aggs["added_agg"] = {"date_histogram": {"field": "date_added",
+                                                "calendar_interval": "year",
+                                                "format": "yyyy",
+                                                "min_doc_count": 1}}
+
+    return aggs
+
+
+def build_facets():
+    """
+    A helper function for building the facet counts returned with a search,
+    scoped to the films it matches.
+
+    Returns:
+        (dict): The Elasticsearch aggregations query.
+    """
+    aggs = build_aggs(histo_duration=True, genres=True, countries=True, ratings=True,
+                      years=True, added=True,
+                      size=int(os.environ.get('FACET_SIZE', 10)))
+    # Searches return few films, so every duration bucket counts
+    aggs["histo_dur_agg"]["histogram"]["min_doc_count"] = 1
+    # Already counted as the total hits
+    del aggs["total_agg"]
+    return aggs
+
+
+def build_combined_aggs():
+    """
+    A helper function for building a single aggregations query serving
+    the total, movie and show aggregations in one index scan.
+
+    Returns:
+        (dict): The Elasticsearch aggregations query.
+    """
+    aggs = build_aggs(directors=True, actors=True, genres=True,
+                      countries=True, ratings=True)
+    # Scope the per-type aggregations with sub-aggregations on the type
+    aggs["movie_agg"] = {"filter": {"term": {"type": 1}},
+                         "aggs": build_aggs(avg_duration=True,
+                                            histo_duration=True)}
+    aggs["show_agg"] = {"filter": {"term": {"type": 0}},
+                        "aggs": build_aggs()}
+
+    return aggs
+
+
+def process_films(result, facets=False):
+    """
+    Process a search result into the films of the response.
+
+    Args:
+        result (dict): The search result.
+        facets (bool): Whether the search counted the films by field.
+
+    Returns:
+        (list[dict] | dict): The films, along with their facets if counted.
+    """
+    films = process_hits(result['hits']['hits'])
+    if not facets:
+        return films
+    return {'films': films, 'facets': process_facets(result['aggregations'])}
+
+
+def process_hits(hits):
+    """
+    Process the hits of a search into films for the response.
+
+    Args:
+        hits (list[dict]): The hits returned by the Elasticsearch database.
+
+    Returns:
+        (list[dict]): The film data of each hit.
+    """
+    # The source is limited to the film fields, so only the rating is decoded
+    decode_rating = schemas.ID_TO_RATING.get
+    return [{**hit['_source'], 'rating': decode_rating(hit['_source'].get('rating'))}
+            for hit in hits]
+
+
+def process_movie_aggs(aggregations):
+    """
+    Process the movie aggregations returned by the Elasticsearch database.
+
+    Args:
+        aggregations (dict): The aggregations scoped to movies.
+
+    Returns:
+        (dict): The processed movie aggregation data.
+    """
+    response = {}
+    # Process the average aggregation
+    response['avg_dur_agg'] = int(aggregations['avg_dur_agg']['value'])
+    # Process the total aggregation
+    response['total_agg'] = aggregations['total_agg']['value']
+    # Process the histogram aggregation
+    response['histo_dur_agg'] = {}
+    for data in aggregations['histo_dur_agg']['buckets']:
+        response['histo_dur_agg'][str(int(data["key"]))] = data["doc_count"]
+
+    return response
+
+
+def process_show_aggs(aggregations):
+    """
+    Process the show aggregations returned by the Elasticsearch database.
+
+    Args:
+        aggregations (dict): The aggregations scoped to shows.
+
+    Returns:
+        (dict): The processed show aggregation data.
+    """
+    response = {}
+    # Process the total aggregation
+    response['total_agg'] = aggregations['total_agg']['value']
+
+    return response
+
+
+def process_facets(aggregations):
+    """
+    Process the facet counts returned by the Elasticsearch database.
+
+    Args:
+        aggregations (dict): The aggregations over the films of a search.
+
+    Returns:
+        (dict): The processed facet counts.
+    """
+    response = {}
+    for agg in ['rating_agg', 'genre_agg', 'country_agg']:
+        response[agg] = {}
+        for data in aggregations[agg]['buckets']:
+            key = schemas.ID_TO_RATING.get(data["key"]) if agg == 'rating_agg' else data["key"]
+            # Films without a rating are stored with an unknown ID
+            if key is not None:
+                response[agg][key] = data["doc_count"]
+    for agg in ['year_agg', 'histo_dur_agg']:
+        response[agg] = {str(int(data["key"])): data["doc_count"]
+                         for data in aggregations[agg]['buckets']}
+    response['added_agg'] = {data["key_as_string"]: data["doc_count"]
+                             for data in aggregations['added_agg']['buckets']}
+
+    return response
+
+
+def process_all_aggs(aggregations):
+    """
+    Process the aggregations over all films returned by the Elasticsearch database.
+
+    Args:
+        aggregations (dict): The aggregations over all films.
+
+    Returns:
+        (dict): The processed total aggregation data.
+    """
+    response = {}
+    # Process the total aggregation
+    response['total_agg'] = aggregations['total_agg']['value']
+    # Process the top aggregations
+    top_aggs = ['director_agg', 'actor_agg', 'rating_agg',
+                'country_agg', 'genre_agg']
+    for agg in top_aggs:
+        response[agg] = {}
+        for data in aggregations[agg]['buckets']:
+            if agg == 'rating_agg':
+                key = schemas.ID_TO_RATING[data["key"]]
+            else:
+                key = data["key"]
+            response[agg][key] = data["doc_count"]
+
+    return response
@@ -3,7 +3,8 @@ Created by: Brandon Goddard
 Description: This module is for defining the models used
              for API and database interactions.
 """
-from pydantic import BaseModel
+from datetime import date
+from pydantic import BaseModel, Field, field_validator
 
 
 # Aggregation models
@@ -73,6 +74,157 @@ class Film(BaseModel):
     genres: list[str] | None = []
     description: str | None = ''
 
+
+# The source fields fetched for search results
+FILM_FIELDS = list(Film.model_fields)
+
+
+class FilmFilters(BaseModel):
+    """
+    API request model for validation, of the structured search filters.
+
+    Attriubutes:
+        release_year_min (int): The earliest release year.
+        release_year_max (int): The latest release year.
+        date_added_from (date): The earliest date the film was added to Netflix.
+        date_added_to (date): The latest date the film was added to Netflix.
+        rating (list[str]): The ratings to keep, any of them matching.
+        genres (list[str]): The genres to keep, any of them matching.
+        country (list[str]): The countries of origin to keep, any of them matching.
+        duration_min (int): The shortest duration, in minutes or seasons.
+        duration_max (int): The longest duration, in minutes or seasons.
+    """
+    release_year_min: int | None = None
+    release_year_max: int | None = None
+    date_added_from: date | None = None
+    date_added_to: date | None = None
+    rating: list[str] | None = None
+    genres: list[str] | None = None
+    country: list[str] | None = None
+    duration_min: int | None = Field(None, ge=0)
+    duration_max: int | None = Field(None, ge=0)
+
+    @field_validator('rating')
+    @classmethod
+    def check_ratings(cls, ratings):
+        """
+        Check that every rating to keep exists.
+
+        Args:
+            ratings (list[str]): The ratings to keep.
+
+        Returns:
+            (list[str]): The ratings.
+        """
+        unknown = [rating for rating in ratings or [] if rating not in RATING_TO_ID]
+        if unknown:
+            raise ValueError(f"Expected ratings among {', '.join(RATING_TO_ID)}, got {unknown}")
+        return ratings
+
+class FilmQuery(FilmFilters):
+    """
+    API request model for validation, of the query string of a film search,
+    where filter values to match are repeated, as in ?genres=Dramas&genres=Comedies.
+
+    Attriubutes:
+        query (str): The query text to search for in the database.
+        fuzzy (bool): Whether to also match words with typos.
+        size (int): The number of films per page.
+        paginate (bool): Whether to start a paginated search.
+        cursor (str): The cursor of the page to retrieve, continuing a paginated search.
+        track_total_hits (int): Count hits exactly up to this number, 0 to skip
+            counting, or unset to always count exactly.
+        facets (bool): Whether to also count the matching films by rating,
+            genre, country, release decade, year added and duration.
+    """
+    query: str
+    fuzzy: bool = False
+    size: int = Field(8, ge=1, le=100)
+    paginate: bool = False
+    cursor: str | None = None
+    track_total_hits: int | None = Field(None, ge=0)
+    facets: bool = False
+
+class Facets(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        rating_agg (dict[str, int]): The most common ratings of the results.
+        genre_agg (dict[str, int]): The most common genres of the results.
+        country_agg (dict[str, int]): The most common countries of the results.
+        year_agg (dict[str, int]): The results released in each decade.
+        added_agg (dict[str, int]): The results added in each year.
+        histo_dur_agg (dict[str, int]): The histogram of result durations.
+    """
+    rating_agg: dict[str, int]
+    genre_agg: dict[str, int]
+    country_agg: dict[str, int]
+    year_agg: dict[str, int]
+    added_agg: dict[str, int]
+    histo_dur_agg: dict[str, int]
+
+class FacetedFilms(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        films (list[Film]): The films found.
+        facets (Facets): The counts of the films matching the search,
+            for refining it further.
+    """
+    films: list[Film]
+    facets: Facets
+
+
+class BatchQuery(BaseModel):
+    """
+    API request model for validation.
+
+    Attriubutes:
+        film_type (str): The type of film to retrieve, being 'movie' or 'show'.
+        query (str): The query text to search for in the database.
+        fuzzy (bool): Whether to also match words with typos.
+        size (int): The number of films to return.
+    """
+    film_type: str
+    query: str
+    fuzzy: bool = False
+    size: int = Field(8, ge=1, le=100)
+
+class SocketQuery(BatchQuery):
+    """
+    WebSocket message model for validation, sent on every keystroke.
+
+    Attriubutes:
+        id (int | str): Echoed back with the results, to match them to the query.
+    """
+    id: int | str | None = None
+
+class BatchResult(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        films (list[Film]): The films found, None if the search failed.
+        error (str): Why the search failed, None if it succeeded.
+    """
+    films: list[Film] | None = None
+    error: str | None = None
+
+class Suggestion(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        text (str): The suggested title or name.
+        field (str): The field suggested from, being 'title', 'director' or 'cast'.
+        count (int): The number of films the suggestion appears in.
+    """
+    text: str
+    field: str
+    count: int
+
 class MovieAggs(TotalAggs, DurationAggs):
     """Inherits from TotalAggs and DurationAggs"""
 
@@ -82,28 +234,162 @@ class ShowAggs(TotalAggs):
 class AllAggs(TotalAggs, TopAggs):
     """Inherits from TotalAggs and TopAggs"""
 
+class CombinedAggs(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        total (AllAggs): The aggregations over all films.
+        movie (MovieAggs): The aggregations over movies.
+        show (ShowAggs): The aggregations over shows.
+    """
+    total: AllAggs
+    movie: MovieAggs
+    show: ShowAggs
+
+class CacheStats(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that queried the database.
+        coalesced (int): Lookups that shared another in-flight query.
+        shared_hits (int): Misses answered by another worker's result.
+        hit_ratio (float): Share of lookups that did not query the database.
+        size (int): The number of entries currently cached.
+        maxsize (int): The maximum number of entries cached.
+        nbytes (int): The memory held by the cached values, in bytes.
+        maxbytes (int): The maximum memory held, None for no limit.
+        ttl (float): Seconds an entry stays valid for.
+        generation (int): The version of the index data being cached.
+    """
+    hits: int
+    misses: int
+    coalesced: int
+    shared_hits: int
+    hit_ratio: float
+    size: int
+    maxsize: int
+    nbytes: int
+    maxbytes: int | None
+    ttl: float
+    generation: int
+
+class QueryLog(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        threshold_ms (float): Milliseconds from which a query is logged as slow.
+        sample_rate (float): Share of queries profiled without being asked to.
+        slow (list[dict]): The recent slow queries, with their body, the time
+            Elasticsearch took, the network and processing time around it,
+            the end-to-end latency and the result size.
+        profiles (list[dict]): The recent profiled queries, along with the
+            time spent on each shard in the query, collectors and aggregations.
+    """
+    threshold_ms: float
+    sample_rate: float
+    slow: list[dict]
+    profiles: list[dict]
+
+class PoolStats(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        node (str): The URL of the Elasticsearch node.
+        in_flight (int): The requests currently waiting on the node.
+        peak (int): The most requests in flight at once.
+        requests (int): The requests sent to the node.
+        pool_size (int): The number of connections kept to the node.
+        saturation (float): The share of the pool in use, above 1 when
+            requests are queued for a connection.
+    """
+    node: str
+    in_flight: int
+    peak: int
+    requests: int
+    pool_size: int
+    saturation: float
+
+class Health(BaseModel):
+    """
+    API response model for validation.
+
+    Attriubutes:
+        status (str): 'ok' if the database is reachable, else 'unavailable'.
+        pool (list[PoolStats]): The connection pool usage of each node.
+    """
+    status: str
+    pool: list[PoolStats]
+
 
 # Elasticsearch models
+ELASTIC_SETTINGS = {
+    "analysis": {
+        "filter": {
+            "prefix_filter": {
+                "type": "edge_ngram",
+                "min_gram": 1,
+                "max_gram": 20}
+        },
+        "analyzer": {
+            # Lets searches match regardless of case and accents
+            "folding": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": ["lowercase", "asciifolding"]},
+            # Indexes every prefix of each word, for search-as-you-type
+            "prefix": {
+                "type": "custom",
+                "tokenizer": "standard",
+                "filter": ["lowercase", "asciifolding", "prefix_filter"]}
+        }
+    }
+}
+
 ELASTIC_MAP = {
     "properties": {
         "type": {"type": "byte"},
-        "title": {"type": "text"},
+        "title": {
+            "type": "text",
+            "analyzer": "folding",
+            "fields": {
+                "prefix": {
+                    "type": "text",
+                    "analyzer": "prefix",
+                    "search_analyzer": "folding"}
+            }
+        },
         "director": {
             "type": "text",
+            "analyzer": "folding",
             "fields": {
                 "keyword": {
-                    "type": "keyword"}
+                    "type": "keyword"},
+                "prefix": {
+                    "type": "text",
+                    "analyzer": "prefix",
+                    "search_analyzer": "folding"}
             }
         },
         "cast": {
             "type": "text",
+            "analyzer": "folding",
             "fields": {
                 "keyword": {
-                    "type": "keyword"}
+                    "type": "keyword"},
+                "prefix": {
+                    "type": "text",
+                    "analyzer": "prefix",
+                    "search_analyzer": "folding"}
             }
         },
         "country": {
             "type": "text",
+            "analyzer": "folding",
             "fields": {
                 "keyword": {
                     "type": "keyword"}
@@ -116,12 +402,15 @@ ELASTIC_MAP = {
         "duration": {"type": "integer"},
         "genres": {
             "type": "text",
+            "analyzer": "folding",
             "fields": {
                 "keyword": {
                     "type": "keyword"}
                 }
             },
-        "description": {"type": "text"}}
+        "description": {"type": "text",
+                        "analyzer": "folding"},
+        "fingerprint": {"type": "keyword", "index": False}}
 }
 
 RATING_TO_ID = {
@@ -141,3 +430,7 @@ RATING_TO_ID = {
     'UR': 13
 }
 ID_TO_RATING = {value: key for key, value in RATING_TO_ID.items()}
+
+# Film types, as stored in the type field; unknown types are stored as -1
+FILM_TYPE_TO_ID = {'show': 0, 'movie': 1}
+ID_TO_FILM_TYPE = {value: key for key, value in FILM_TYPE_TO_ID.items()}
@@ -0,0 +1,177 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for logging slow searches and aggregations,
+             and keeping the Elasticsearch profiles of sampled ones, to
+             tell time spent in the query from the network and our own work.
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from elasticsearch import ApiError, TransportError
+
+
+logger = logging.getLogger(__name__)
+
+# Descriptions of deeply nested queries are cut, to keep entries small
+MAX_DESCRIPTION = 200
+
+
+class SlowQueryLog:
+    """
+    The recent slow queries and query profiles of the process, each kept
+    in a bounded ring buffer so the oldest entries make way for new ones.
+
+    Attributes:
+        threshold (float): Seconds from which a query is logged as slow.
+        sample_rate (float): Share of queries profiled without being asked to.
+        slow (deque[dict]): The most recent slow queries.
+        profiles (deque[dict]): The most recent query profiles.
+    """
+    def __init__(self, threshold, sample_rate=0.0, size=100, profile_size=20):
+        """
+        Args:
+            threshold (float): Seconds from which a query is logged as slow.
+            sample_rate (float): Share of queries profiled without being asked to.
+            size (int): The number of slow queries kept.
+            profile_size (int): The number of profiles kept.
+        """
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.slow = deque(maxlen=size)
+        self.profiles = deque(maxlen=profile_size)
+        self._tasks = set()
+
+    def sampled(self):
+        """
+        Decide whether to profile a query that was not flagged for it.
+
+        Returns:
+            (bool): True for a random sample_rate share of queries.
+        """
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def observe(self, labels, search, result, measures, rerun=None):
+        """
+        Record a query, logging it if slow, and profiling it if asked to.
+        The profiled query is run again in the background, so the response
+        is not held up by it.
+
+        Args:
+            labels (dict): The route template and film type of the request.
+            search (dict): The search request parameters, from build_search or build_aggs.
+            result (dict): The search result.
+            measures (dict): The seconds the search round trip ('elasticsearch')
+                and the whole query path up to serialization ('latency') took,
+                and the size of the serialized response in bytes ('size').
+            rerun (Callable): Coroutine function running the search again
+                with profiling, None to not profile it.
+
+        Returns:
+            (dict): The entry recorded for the query.
+        """
+        route = labels['route']
+        elasticsearch, latency = measures['elasticsearch'], measures['latency']
+        took = result['took'] / 1000
+        hits = result['hits']
+        entry = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'route': route,
+            'film_type': labels['film_type'],
+            'body': search,
+            'took_ms': round(took * 1000, 3),
+            # Whatever Elasticsearch did not report went to the network and client
+            'network_ms': round(max(elasticsearch - took, 0.0) * 1000, 3),
+            'processing_ms': round((latency - elasticsearch) * 1000, 3),
+            'latency_ms': round(latency * 1000, 3),
+            'hits': len(hits['hits']),
+            'total': hits['total']['value'] if 'total' in hits else None,
+            'bytes': measures['size'],
+        }
+        if latency >= self.threshold:
+            self.slow.append(entry)
+            logger.warning("Slow query on %s: %s", route,
+                           json.dumps(entry, separators=(',', ':'), default=str))
+        if rerun is not None:
+            task = asyncio.ensure_future(self._profile(entry, rerun))
+            # Held until done, as the loop only keeps weak references to tasks
+            self._tasks.add(task)
+            task.add_done_callback(self._finish)
+        return entry
+
+    def _finish(self, task):
+        self._tasks.discard(task)
+        # Nothing awaits a profile, so a failure other than the search's is logged here
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Profiling a query failed", exc_info=task.exception())
+
+    async def _profile(self, entry, rerun):
+        start = time.perf_counter()
+        try:
+            result = await rerun()
+        except (ApiError, TransportError) as exc:
+            # Profiling is a diagnostic, a failed search must never fail the service
+            logger.warning("Profiling a query on %s failed: %s", entry['route'], exc)
+            return
+        shards = result['profile']['shards'] if 'profile' in result else []
+        self.profiles.append({**entry,
+                              'profile_ms': round((time.perf_counter() - start) * 1000, 3),
+                              'shards': [summarize_shard(shard) for shard in shards]})
+
+    def stats(self):
+        """
+        Gather the settings and recorded entries, most recent first.
+
+        Returns:
+            (dict): The threshold, sample rate, slow queries and profiles.
+        """
+        return {'threshold_ms': self.threshold * 1000,
+                'sample_rate': self.sample_rate,
+                'slow': list(reversed(self.slow)),
+                'profiles': list(reversed(self.profiles))}
+
+
+def summarize_shard(shard):
+    """
+    Reduce the profile of a shard to where its time went.
+
+    Args:
+        shard (dict): A shard of the profile returned by Elasticsearch.
+
+    Returns:
+        (dict): The shard ID, the totals of each phase in milliseconds,
+            and the timed query and aggregation trees.
+    """
+    searches = shard.get('searches', [])
+    queries = [summarize_node(node) for search in searches for node in search.get('query', [])]
+    aggregations = [summarize_node(node) for node in shard.get('aggregations', [])]
+    return {
+        'id': shard.get('id'),
+        'query_ms': round(sum(node['time_ms'] for node in queries), 3),
+        'rewrite_ms': round(sum(search.get('rewrite_time', 0)
+                                for search in searches) / 1e6, 3),
+        'collector_ms': round(sum(collector.get('time_in_nanos', 0) for search in searches
+                                  for collector in search.get('collector', [])) / 1e6, 3),
+        'aggregation_ms': round(sum(node['time_ms'] for node in aggregations), 3),
+        'query': queries,
+        'aggregations': aggregations,
+    }
+
+
+def summarize_node(node):
+    """
+    Reduce a profiled query or aggregation to its timing, keeping its children.
+
+    Args:
+        node (dict): A node of the profile tree.
+
+    Returns:
+        (dict): The type, description and milliseconds of the node and its children.
+    """
+    return {'type': node.get('type'),
+            'description': node.get('description', '')[:MAX_DESCRIPTION],
+            'time_ms': round(node.get('time_in_nanos', 0) / 1e6, 3),
+            'children': [summarize_node(child) for child in node.get('children', [])]}
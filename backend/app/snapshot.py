@@ -0,0 +1,216 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for building and reading snapshots of the
+             processed catalogue, so that loads skip text processing.
+             Run it at build time to write the snapshot of a file:
+             python snapshot.py datasets/netflix.csv
+"""
+import os
+import sys
+import mmap
+import json
+import array
+import hashlib
+import argparse
+import orjson
+import schemas
+import transform
+from sources import read_chunks
+
+
+MAGIC = b'CATSNAP1'
+SUFFIX = '.snapshot'
+# Building chunks of this many rows keeps memory flat for large files
+BUILD_CHUNK_SIZE = 1000
+
+
+def _code_version():
+    # Any change to the transform invalidates snapshots built by an older one
+    digest = hashlib.sha256()
+    for module in (transform, schemas):
+        with open(module.__file__, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+TRANSFORM_VERSION = _code_version()
+
+
+def snapshot_path(source):
+    """
+    Get the path of the snapshot of a catalogue file.
+
+    Args:
+        source (str): The path of the catalogue file.
+
+    Returns:
+        (str): The path of its snapshot.
+    """
+    return source + SUFFIX
+
+
+def source_hash(source):
+    """
+    Hash the content of a catalogue file.
+
+    Args:
+        source (str): The path of the catalogue file.
+
+    Returns:
+        (str): The hex digest of the file.
+    """
+    with open(source, 'rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def build_snapshot(source, path=None, fmt=None):
+    """
+    Process a catalogue file and write its documents to a snapshot.
+    The records are written as they are processed, followed by their
+    offsets and a footer, so the file is never held in memory.
+
+    Layout: MAGIC, the records, their offsets as native uint64,
+    the JSON footer, its length as a uint32, then MAGIC again. Each record
+    is a JSON array of the ID and the field values, named once in the footer.
+
+    Args:
+        source (str): The path of the catalogue file.
+        path (str): The path of the snapshot, next to the file by default.
+        fmt (str): The format of the file, guessed from its name if None.
+
+    Returns:
+        (dict): The footer of the snapshot.
+    """
+    path = path or snapshot_path(source)
+    offsets = array.array('Q')
+    fields = None
+    with open(f"{path}.tmp", 'wb') as file:
+        file.write(MAGIC)
+        for columns in read_chunks(source, BUILD_CHUNK_SIZE, fmt):
+            # The index is chosen at load time, so only the ID and source are kept
+            for action in transform.transform_columns(columns, None):
+                fields = fields or list(action['_source'])
+                offsets.append(file.tell())
+                file.write(orjson.dumps([action['_id'], *action['_source'].values()]))
+        offsets.append(file.tell())
+        footer = {'version': TRANSFORM_VERSION, 'source': source_hash(source),
+                  'count': len(offsets) - 1, 'fields': fields or [],
+                  'offsets': file.tell(), 'byteorder': sys.byteorder}
+        file.write(offsets.tobytes())
+        encoded = json.dumps(footer).encode('utf-8')
+        file.write(encoded)
+        file.write(len(encoded).to_bytes(4, 'little'))
+        file.write(MAGIC)
+    os.replace(f"{path}.tmp", path)
+    return footer
+
+
+class Snapshot:
+    """
+    A memory-mapped snapshot, decoding its documents on demand.
+
+    Attributes:
+        footer (dict): The version, source hash and document count.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._map)
+        if self._map[:8] != MAGIC or self._map[size - 8:] != MAGIC:
+            self._map.close()
+            raise ValueError(f"'{path}' is not a catalogue snapshot")
+        length = int.from_bytes(self._map[size - 12:size - 8], 'little')
+        self.footer = json.loads(self._map[size - 12 - length:size - 12])
+        start = self.footer['offsets']
+        self._offsets = memoryview(self._map)[start:start + 8 * (len(self) + 1)].cast('Q')
+
+    def __len__(self):
+        return self.footer['count']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def close(self):
+        """
+        Unmap the snapshot, once no document is being read.
+
+        Returns:
+            None
+        """
+        self._offsets.release()
+        self._map.close()
+
+    def actions(self, index, start=0, stop=None):
+        """
+        Decode the documents of the snapshot into bulk insert actions.
+
+        Args:
+            index (str): The index to insert into.
+            start (int): The position of the first document.
+            stop (int): The position after the last document, the end if None.
+
+        Returns:
+            (Generator[dict]): The bulk insert actions.
+        """
+        offsets, data, fields = self._offsets, self._map, self.footer['fields']
+        for position in range(start, len(self) if stop is None else min(stop, len(self))):
+            doc_id, *values = orjson.loads(data[offsets[position]:offsets[position + 1]])
+            yield {"_id": doc_id, "_index": index, "_source": dict(zip(fields, values))}
+
+    def chunks(self, chunk_size, index, skip=0):
+        """
+        Decode the documents in fixed size chunks, for bulk loading.
+
+        Args:
+            chunk_size (int): The number of documents per chunk.
+            index (str): The index to insert into.
+            skip (int): The number of documents to skip.
+
+        Returns:
+            (Generator[tuple[list[dict], int]]): The actions of each chunk,
+                and the size of their records in bytes.
+        """
+        for start in range(skip, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            yield (list(self.actions(index, start, stop)),
+                   self._offsets[stop] - self._offsets[start])
+
+
+def open_snapshot(source):
+    """
+    Open the snapshot of a catalogue file, if there is one built from
+    the same file content by the same version of the transform.
+
+    Args:
+        source (str): The path of the catalogue file.
+
+    Returns:
+        (Snapshot): The snapshot, None if there is none or it is stale.
+    """
+    path = snapshot_path(source)
+    if source == '-' or not os.path.exists(path):
+        return None
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError):
+        return None
+    footer = snapshot.footer
+    if footer.get('version') != TRANSFORM_VERSION or footer.get('byteorder') != sys.byteorder \
+            or footer.get('source') != source_hash(source):
+        snapshot.close()
+        return None
+    return snapshot
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Write the snapshot of a catalogue file, next to it by default.")
+    parser.add_argument('source', nargs='?', default='datasets/netflix.csv',
+                        help="The catalogue file to process.")
+    parser.add_argument('--output', default=None, help="The path of the snapshot.")
+    parser.add_argument('--format', default=None, help="The format of the file.")
+    args = parser.parse_args()
+    print(json.dumps(build_snapshot(args.source, args.output, args.format), indent=2))
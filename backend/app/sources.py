@@ -0,0 +1,246 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for reading catalogue files of any supported
+             format in bounded chunks of columns, and for recording the
+             progress of a load so that it can resume after a failure.
+"""
+import io
+import os
+import sys
+import csv
+import gzip
+import json
+from itertools import islice
+from contextlib import ExitStack
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    from pyarrow import parquet
+except ImportError:
+    parquet = None
+
+
+FORMATS = ('csv', 'ndjson', 'parquet')
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson',
+              '.json': 'ndjson', '.parquet': 'parquet', '.pq': 'parquet'}
+COMPRESSIONS = ('.gz', '.zst', '.zstd')
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def detect_format(source):
+    """
+    Guess the format of a catalogue file from its extension.
+
+    Args:
+        source (str): The path of the file, or '-' for stdin.
+
+    Returns:
+        (str): The format, being 'csv', 'ndjson' or 'parquet'.
+    """
+    root, extension = os.path.splitext(source.lower())
+    if extension in COMPRESSIONS:
+        extension = os.path.splitext(root)[1]
+    # Anything unknown, such as stdin, is taken to be the CSV export
+    return EXTENSIONS.get(extension, 'csv')
+
+
+def decompress(stream):
+    """
+    Decompress a catalogue stream on the fly, if it starts with the
+    gzip or zstd magic bytes.
+
+    Args:
+        stream (BufferedReader): The raw byte stream.
+
+    Returns:
+        (BinaryIO): The decompressed byte stream.
+    """
+    magic = stream.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.GzipFile(fileobj=stream)
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise RuntimeError("Reading zstd compressed files needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    return stream
+
+
+def read_chunks(source, chunk_size, fmt=None, skip=0):
+    """
+    Read the raw rows of a catalogue file in fixed size chunks of columns.
+    Only one chunk is held at a time, however large the file.
+
+    Args:
+        source (str): The path of the file, or '-' for stdin.
+        chunk_size (int): The number of rows per chunk.
+        fmt (str): The format of the file, guessed from its name if None.
+        skip (int): The number of rows to skip, already loaded by a previous run.
+
+    Returns:
+        (Generator[dict[str, list[str]]]): The raw values of each column, by name.
+    """
+    fmt = fmt or detect_format(source)
+    if fmt not in FORMATS:
+        raise ValueError(f"Expected one of {', '.join(FORMATS)}, got '{fmt}'")
+
+    with ExitStack() as stack:
+        if fmt == 'parquet':
+            header, rows = _parquet_rows(source, chunk_size, stack)
+        else:
+            stream = sys.stdin.buffer if source == '-' else stack.enter_context(
+                open(source, 'rb'))
+            # Universal newlines, like the CSV file has always been opened with
+            text = io.TextIOWrapper(decompress(stream), encoding='utf-8')
+            header, rows = _csv_rows(text) if fmt == 'csv' else _ndjson_rows(text)
+        if header is None:
+            return
+
+        width = len(header)
+        rows = islice(rows, skip, None)
+        while chunk := list(islice(rows, chunk_size)):
+            yield dict(zip(header, map(list, zip(*(
+                # Missing values are empty, like csv.DictReader leaves them
+                row if len(row) == width else (row + [''] * width)[:width]
+                for row in chunk)))))
+
+
+def _csv_rows(text):
+    reader = csv.reader(text)
+    return next(reader, None), reader
+
+
+def _ndjson_rows(text):
+    # Records hold the columns of the CSV export, with the first one
+    # setting the column order
+    lines = (line for line in text if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return None, iter(())
+    first = json.loads(first)
+    header = list(first)
+
+    def rows():
+        yield [raw_value(first.get(name)) for name in header]
+        for line in lines:
+            record = json.loads(line)
+            yield [raw_value(record.get(name)) for name in header]
+    return header, rows()
+
+
+def _parquet_rows(source, chunk_size, stack):
+    if parquet is None:
+        raise RuntimeError("Reading Parquet files needs the pyarrow package")
+    if source == '-':
+        raise ValueError("Parquet files cannot be read from stdin, as they are read from the end")
+    file = parquet.ParquetFile(source)
+    stack.callback(file.close)
+    header = file.schema_arrow.names
+
+    def rows():
+        for batch in file.iter_batches(batch_size=chunk_size):
+            columns = batch.to_pydict()
+            for values in zip(*(columns[name] for name in header)):
+                yield [raw_value(value) for value in values]
+    return header, rows()
+
+
+def raw_value(value):
+    """
+    Convert a typed value to the text the CSV export would hold.
+
+    Args:
+        value (Any): The value of a JSON or Parquet record.
+
+    Returns:
+        (str): The raw text, empty for missing values.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, tuple)):
+        return ', '.join(raw_value(item) for item in value)
+    return str(value)
+
+
+class Checkpoint:
+    """
+    The progress of a load, saved to a JSON file after every chunk, so
+    that a failed load resumes after the last row known to be indexed.
+    Chunks finish out of order, so only those without a gap before them,
+    and without failed documents, count as done.
+
+    Attributes:
+        path (str): The path of the checkpoint file.
+        state (dict): The saved progress, with the number of rows done.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        self._finished = {}
+        self._next = 0
+
+    def load(self):
+        """
+        Read the progress saved by a previous run.
+
+        Returns:
+            (dict): The saved progress, None if there is none.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self.state = json.load(file)
+        except FileNotFoundError:
+            return None
+        return self.state
+
+    def save(self, **state):
+        """
+        Update the progress and write it, atomically replacing the file.
+
+        Args:
+            **state: The values to update, such as the rows done.
+
+        Returns:
+            None
+        """
+        self.state.update(state)
+        with open(f"{self.path}.tmp", 'w', encoding='utf-8') as file:
+            json.dump(self.state, file)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def finish_chunk(self, number, rows, failed):
+        """
+        Record a finished chunk, saving the rows done if it closes a gap.
+
+        Args:
+            number (int): The position of the chunk in this run, from 0.
+            rows (int): The number of rows in the chunk.
+            failed (bool): Whether any document of the chunk failed.
+
+        Returns:
+            None
+        """
+        self._finished[number] = None if failed else rows
+        done = 0
+        while self._finished.get(self._next) is not None:
+            done += self._finished.pop(self._next)
+            self._next += 1
+        if done:
+            self.save(rows=self.state.get('rows', 0) + done)
+
+    def clear(self):
+        """
+        Remove the checkpoint once the load has completed.
+
+        Returns:
+            None
+        """
+        self.state = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
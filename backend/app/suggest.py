@@ -0,0 +1,209 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for serving search-as-you-type suggestions
+             from an in-memory prefix index over the indexed films.
+"""
+import asyncio
+import heapq
+import logging
+from bisect import bisect_left
+from collections import Counter
+from elasticsearch.helpers import async_scan
+import schemas
+from database import filter_text
+
+
+logger = logging.getLogger(__name__)
+
+# The fields suggestions are drawn from, in order of preference on ties
+SUGGEST_FIELDS = ['title', 'director', 'cast']
+# The maximum number of suggestions returned for a prefix
+MAX_SIZE = 10
+
+
+def normalize(text):
+    """
+    Normalize text for prefix comparisons, ignoring case, accents,
+    punctuation and extraneous whitespace.
+
+    Args:
+        text (str): The text to normalize.
+
+    Returns:
+        (str): The normalized text.
+    """
+    return ' '.join(filter_text(text).casefold().split())
+
+
+class PrefixIndex:
+    """
+    A sorted array of normalized names, where every word of a name starts
+    a key so that prefixes of later words match too. The best suggestions
+    for short prefixes, which match the most keys, are precomputed.
+
+    Attributes:
+        entries (list[tuple[str, str, int]]): The text, field and count of
+            each name, best first.
+    """
+    def __init__(self, counts, precompute=3, memo_size=4096):
+        """
+        Args:
+            counts (dict[tuple[str, str], int]): The number of films of each
+                (field, text) pair.
+            precompute (int): The prefix length up to which results are built ahead.
+            memo_size (int): The number of longer prefix results remembered.
+        """
+        field_rank = {field: rank for rank, field in enumerate(SUGGEST_FIELDS)}
+        self.entries = sorted(((text, field, count) for (field, text), count in counts.items()),
+                              key=lambda entry: (-entry[2], field_rank[entry[1]],
+                                                 len(entry[0]), entry[0]))
+        keys = []
+        for entry_id, (text, _, _) in enumerate(self.entries):
+            words = normalize(text).split(' ')
+            for start in range(len(words)):
+                keys.append((' '.join(words[start:]), entry_id))
+        keys.sort()
+        self._keys = [key for key, _ in keys]
+        self._ids = [entry_id for _, entry_id in keys]
+        self._memo = {}
+        self._memo_size = memo_size
+        self._precomputed = self._precompute(precompute)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def search(self, prefix, size=5):
+        """
+        Find the best names with a word starting with the given prefix.
+
+        Args:
+            prefix (str): The text typed so far.
+            size (int): The maximum number of suggestions, up to MAX_SIZE.
+
+        Returns:
+            (list[tuple[str, str, int]]): The text, field and count of each match.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        best = self._precomputed.get(prefix) or self._memo.get(prefix)
+        if best is None:
+            lo = bisect_left(self._keys, prefix)
+            hi = bisect_left(self._keys, prefix + '\uffff', lo)
+            best = self._best(lo, hi)
+            if len(self._memo) >= self._memo_size:
+                self._memo.clear()
+            self._memo[prefix] = best
+        return [self.entries[entry_id] for entry_id in best[:size]]
+
+    def _best(self, lo, hi):
+        # Lower entry IDs rank higher, a name can match through several words
+        return heapq.nsmallest(MAX_SIZE, set(self._ids[lo:hi]))
+
+    def _precompute(self, length):
+        precomputed = {}
+        for prefix_length in range(1, length + 1):
+            start = 0
+            while start < len(self._keys):
+                prefix = self._keys[start][:prefix_length]
+                end = bisect_left(self._keys, prefix + '\uffff', start)
+                precomputed[prefix] = self._best(start, end)
+                start = end
+        return precomputed
+
+
+class Suggester:
+    """
+    The prefix indices of each film type, rebuilt from the
+    Elasticsearch database whenever the index generation changes.
+
+    Attributes:
+        indices (dict[str, PrefixIndex]): The prefix index of each film type.
+        generation (int): The index generation the prefix indices were built at.
+    """
+    def __init__(self):
+        self.indices = {}
+        self.generation = None
+        self._task = None
+
+    def search(self, film_type, prefix, size=5):
+        """
+        Find the best suggestions for a film type.
+
+        Args:
+            film_type (str): The type of film, being 'movie' or 'show'.
+            prefix (str): The text typed so far.
+            size (int): The maximum number of suggestions.
+
+        Returns:
+            (list[dict]): The text, field and count of each suggestion.
+        """
+        if film_type not in self.indices:
+            return []
+        return [{'text': text, 'field': field, 'count': count}
+                for text, field, count in self.indices[film_type].search(prefix, size)]
+
+    async def refresh(self, esdb, index, generation):
+        """
+        Rebuild the prefix indices if they are older than the given
+        generation. Concurrent calls share the same rebuild.
+
+        Args:
+            esdb (AsyncElasticsearch): Database connection instance.
+            index (str): The index to read the films from.
+            generation (int): The current index generation.
+
+        Returns:
+            None
+        """
+        if self.generation == generation:
+            return
+        if self._task is None:
+            self._start(esdb, index, generation)
+        await asyncio.shield(self._task)
+
+    def refresh_in_background(self, esdb, index, generation):
+        """
+        Start rebuilding the prefix indices if they are older than the
+        given generation, without waiting for it, so the previous
+        suggestions are served meanwhile.
+
+        Args:
+            esdb (AsyncElasticsearch): Database connection instance.
+            index (str): The index to read the films from.
+            generation (int): The current index generation.
+
+        Returns:
+            None
+        """
+        if self.generation != generation and self._task is None:
+            self._start(esdb, index, generation)
+
+    def _start(self, esdb, index, generation):
+        # Held until done, as the loop only keeps weak references to tasks
+        self._task = asyncio.ensure_future(self._build(esdb, index, generation))
+        self._task.add_done_callback(self._finish)
+
+    def _finish(self, task):
+        self._task = None
+        # Nothing awaits a background rebuild, so its failure is logged here
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Rebuilding the suggestions failed", exc_info=task.exception())
+
+    async def _build(self, esdb, index, generation):
+        counts = {'movie': Counter(), 'show': Counter()}
+        async for hit in async_scan(esdb, index=index, query={"query": {"match_all": {}}},
+                                    _source=['type'] + SUGGEST_FIELDS, size=5000):
+            source = hit['_source']
+            film_type = schemas.ID_TO_FILM_TYPE.get(source.get('type'))
+            if film_type is None:
+                continue
+            for field in SUGGEST_FIELDS:
+                values = source.get(field) or []
+                for value in values if isinstance(values, list) else [values]:
+                    counts[film_type][(field, value)] += 1
+        # Building is CPU bound, so keep it off the event loop
+        loop = asyncio.get_running_loop()
+        self.indices = {film_type: await loop.run_in_executor(None, PrefixIndex, counter)
+                        for film_type, counter in counts.items()}
+        self.generation = generation
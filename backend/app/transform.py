@@ -0,0 +1,218 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for transforming CSV rows into bulk insert
+             actions column by column, producing the same documents as
+             the per-row filters of the database module, only faster.
+"""
+import re
+import json
+import hashlib
+from datetime import date, datetime
+from functools import lru_cache
+from unidecode import unidecode as ud
+from schemas import RATING_TO_ID
+
+
+# Punctuation removed from names, keeping apostrophes and hyphens
+PUNCT_PATTERN = re.compile(r"[^a-zA-Z0-9\s',-]")
+# Dates such as 'September 24, 2021', anything else is left to strptime
+DATE_PATTERN = re.compile(r"([A-Za-z]+) ([0-9]{1,2}), ([0-9]{4})")
+MONTHS = {name.lower(): number for number, name in enumerate(
+    ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+     'August', 'September', 'October', 'November', 'December'], start=1)}
+TYPES = {'TV Show': 0, 'Movie': 1}
+
+
+
+class Transliteration(dict):
+    """
+    The ASCII transliteration of each character, looked up by str.translate
+    and filled in on first use. Unidecode maps characters one at a time,
+    so this matches it on whole strings without its per-character overhead.
+    """
+    def __missing__(self, codepoint):
+        value = self[codepoint] = ud(chr(codepoint))
+        return value
+
+
+TRANSLITERATION = Transliteration()
+
+# Names, genres, dates and durations repeat across the catalogue,
+# so they are only ever cleaned once per process
+MEMO_SIZE = 1 << 16
+
+
+def transform_columns(columns, index):
+    """
+    Process a chunk of raw columns into bulk insert actions. Matches
+    database.process_row applied to each row, field for field.
+
+    Args:
+        columns (dict[str, list[str]]): The raw values of each column, by name.
+        index (str): The index to insert into.
+
+    Returns:
+        (list[dict]): The bulk insert actions, one per row.
+    """
+    types = [TYPES.get(value, -1) for value in columns['type']]
+    source = {}
+    # Keep the column order of the file, with the genres moved last
+    for name, values in columns.items():
+        if name in ('show_id', 'listed_in'):
+            continue
+        if name == 'type':
+            source[name] = types
+        elif name in ('title', 'description'):
+            # Titles and descriptions could contain punctuation, keep them
+            source[name] = [fold(value).strip() if value else None for value in values]
+        elif name == 'director':
+            source[name] = [clean_name(value) if value else None for value in values]
+        elif name == 'cast':
+            source[name] = [list(clean_list(value)) if value else None for value in values]
+        elif name == 'date_added':
+            source[name] = [parse_date(value) if value else None for value in values]
+        elif name == 'release_year':
+            source[name] = [int(value) if value else None for value in values]
+        elif name == 'rating':
+            source[name] = [RATING_TO_ID.get(value, -1) for value in values]
+        elif name == 'duration':
+            source[name] = [parse_duration(value, kind) if value else None
+                            for value, kind in zip(values, types)]
+        else:
+            source[name] = [value or None for value in values]
+    source['genres'] = [list(clean_list(value)) if value else None
+                       for value in columns['listed_in']]
+
+    fields = list(source)
+    actions = []
+    for show_id, values in zip(columns['show_id'], zip(*source.values())):
+        document = dict(zip(fields, values))
+        document['fingerprint'] = fingerprint(document)
+        actions.append({"_id": show_id or None, "_index": index, "_source": document})
+    return actions
+
+
+def fold(text):
+    """
+    Remove the accents of a text, the same as unidecode.
+
+    Args:
+        text (str): The text to fold.
+
+    Returns:
+        (str): The ASCII text.
+    """
+    return text if text.isascii() else text.translate(TRANSLITERATION)
+
+
+def fingerprint(source):
+    """
+    Hash the content of a processed row, so reruns can tell
+    which documents have changed.
+
+    Args:
+        source (dict): The processed row, without a fingerprint.
+
+    Returns:
+        (str): The hex digest of the row content.
+    """
+    content = json.dumps(source, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def filter_text(text, punct=True):
+    """
+    Process the given text to be inserted into the
+    Elasticsearch database.
+
+    Args:
+        text (str): The text to process and simplify for use.
+
+    Returns:
+        (str): The text after being processed.
+
+    Notes:
+        The following changes are made to the string:
+            - Punctuation removed
+            - Character accents removed
+            - Extraneous whitespace removed
+    """
+    if isinstance(text, str):
+        # Remove accents from characters
+        text = fold(text)
+        # Remove punctuation (except for apostrophes and hyphens due to names)
+        if punct:
+            text = PUNCT_PATTERN.sub('', text).replace('  ', ' ')
+        return text.strip()
+    return ''
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def clean_name(text):
+    """
+    Remove the accents and punctuation of a name, memoized.
+
+    Args:
+        text (str): The raw name.
+
+    Returns:
+        (str): The cleaned name.
+    """
+    return filter_text(text)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def clean_list(text):
+    """
+    Split a comma separated list of names and clean each of them, memoized.
+
+    Args:
+        text (str): The raw list, such as a cast or the genres.
+
+    Returns:
+        (tuple[str]): The cleaned names, immutable as they are shared.
+    """
+    return tuple(clean_name(name) for name in text.split(','))
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_date(text):
+    """
+    Convert a date such as 'September 24, 2021' to the MMddyyyy format, memoized.
+
+    Args:
+        text (str): The raw date.
+
+    Returns:
+        (str): The formatted date, None if it is not a valid date.
+    """
+    text = text.strip()
+    match = DATE_PATTERN.fullmatch(text)
+    month = match and MONTHS.get(match[1].lower())
+    try:
+        if not month or match[3] < '1000':
+            # Unusual spellings and years are left to strptime itself
+            return datetime.strptime(text, "%B %d, %Y").strftime("%m%d%Y")
+        day = date(int(match[3]), month, int(match[2]))
+    except ValueError:
+        return None
+    return f"{day.month:02d}{day.day:02d}{day.year}"
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_duration(text, kind):
+    """
+    Convert a duration such as '90 min' or '2 Seasons' to an int, memoized.
+
+    Args:
+        text (str): The raw duration.
+        kind (int): The film type, 1 for movies.
+
+    Returns:
+        (int): The duration, None for movies listed in seasons.
+    """
+    value = int(text.replace('min', '').replace('Seasons', '').replace('Season', '').strip())
+    # Some movies might be listed incorrectly as seasons
+    if kind == 1 and value < 5:
+        return None
+    return value
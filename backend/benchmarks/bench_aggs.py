@@ -0,0 +1,82 @@
+"""
+Created by: Brandon Goddard
+Description: This module is a benchmark comparing the latency of the
+             combined aggregations computed over NumPy columns against
+             the configured search backend. Run it from backend/app:
+             python ../benchmarks/bench_aggs.py --repeat 200
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+sys.path.insert(0, os.getcwd())
+
+from columnar import ColumnarAggs
+from database import get_elastic_db, init_elastic_db, get_row
+from queries import build_combined_aggs
+
+
+def summarize(name, timings):
+    """
+    Print the latency percentiles of a benchmark.
+
+    Args:
+        name (str): The name of the benchmarked approach.
+        timings (list[float]): The seconds taken by each run.
+
+    Returns:
+        (float): The median latency in seconds.
+    """
+    timings = sorted(timings)
+    median = statistics.median(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(f"{name:<12} median {median * 1e6:>10.1f} us   p95 {p95 * 1e6:>10.1f} us")
+    return median
+
+
+async def bench(repeat):
+    """
+    Time the combined aggregations with both approaches.
+
+    Args:
+        repeat (int): The number of runs of each approach.
+
+    Returns:
+        None
+    """
+    columns = ColumnarAggs.from_rows(get_row('datasets/netflix.csv'))
+    esdb = get_elastic_db()
+    try:
+        await init_elastic_db(esdb)
+        index = os.environ['ELASTIC_INDEX']
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await esdb.search(index=index, query={"match_all": {}},
+                              aggs=build_combined_aggs(), size=0)
+            timings.append(time.perf_counter() - start)
+        backend = summarize(os.environ.get('SEARCH_BACKEND', 'elasticsearch'), timings)
+    finally:
+        await esdb.close()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        columns.aggregate(directors=True, actors=True, genres=True,
+                          countries=True, ratings=True)
+        columns.aggregate(film_type=1, avg_duration=True, histo_duration=True)
+        columns.aggregate(film_type=0)
+        timings.append(time.perf_counter() - start)
+    columnar = summarize('columnar', timings)
+    print(f"columnar is {backend / columnar:.1f}x faster")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=100,
+                        help="The number of runs of each approach.")
+    asyncio.run(bench(parser.parse_args().repeat))
@@ -0,0 +1,393 @@
+"""
+Created by: Brandon Goddard
+Description: This module is a load test of the API, driven in-process
+             through the httpx ASGI transport against a stand-in database
+             replaying recorded responses with a configurable latency.
+             It reports throughput, latency percentiles and allocations
+             per request, and saves them as JSON to compare commits.
+             Run it from backend/app:
+             python ../benchmarks/bench_api.py --output bench.json
+             python ../benchmarks/bench_api.py --baseline bench.json
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import itertools
+import statistics
+import subprocess
+import tracemalloc
+
+os.environ.setdefault('ELASTIC_INDEX', 'netflix')
+sys.path.insert(0, os.getcwd())
+
+import httpx
+import orjson
+import main
+from database import get_row
+from memory import MemoryElasticsearch
+from snapshot import build_snapshot, open_snapshot
+
+
+RECORDINGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recordings.json')
+QUERIES = ['love', 'stranger things', 'christmas', 'war', 'adam sandler',
+           'documentary', 'korea', 'anime', 'murder mystery', 'dog']
+
+
+def request_key(method, kwargs):
+    """
+    Build the key a database request is recorded under.
+
+    Args:
+        method (str): The name of the client method.
+        kwargs (dict): The arguments of the request.
+
+    Returns:
+        (str): The key, the same for identical requests.
+    """
+    params = {name: value for name, value in kwargs.items() if name != 'index'}
+    return method + orjson.dumps(params, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+
+
+class RecordingElasticsearch:
+    """
+    A client wrapper recording the responses of another client.
+
+    Attributes:
+        recordings (dict): The responses, keyed by request.
+    """
+    def __init__(self, esdb):
+        self._esdb = esdb
+        self.recordings = {}
+
+    async def search(self, **kwargs):
+        """Run and record a search."""
+        response = await self._esdb.search(**kwargs)
+        self.recordings[request_key('search', kwargs)] = dict(response)
+        return response
+
+    async def msearch(self, **kwargs):
+        """Run and record a multi search."""
+        response = await self._esdb.msearch(**kwargs)
+        self.recordings[request_key('msearch', kwargs)] = dict(response)
+        return response
+
+
+class ReplayElasticsearch:
+    """
+    A stand-in for the Elasticsearch client, answering each request
+    with its recorded response after a fixed latency.
+
+    Attributes:
+        latency (float): Seconds each request takes.
+        requests (int): The requests answered.
+    """
+    def __init__(self, recordings, latency):
+        self._recordings = recordings
+        self.latency = latency
+        self.requests = 0
+
+    async def _replay(self, method, kwargs):
+        await asyncio.sleep(self.latency)
+        self.requests += 1
+        try:
+            return self._recordings[request_key(method, kwargs)]
+        except KeyError:
+            raise KeyError(f"No recorded response for {method}, rerun with --record") from None
+
+    async def search(self, **kwargs):
+        """Replay a search."""
+        return await self._replay('search', kwargs)
+
+    async def msearch(self, **kwargs):
+        """Replay a multi search."""
+        return await self._replay('msearch', kwargs)
+
+    async def ping(self):
+        """The stand-in is always reachable."""
+        return True
+
+    async def close(self):
+        """Nothing to close."""
+
+
+def scenarios():
+    """
+    Build the requests of each benchmarked endpoint.
+
+    Returns:
+        (dict[str, tuple[list[str], bool]]): The URLs requested in turn by
+            each scenario, and whether the result caches are bypassed.
+    """
+    films = [f"/api/film/{film_type}/?query={query}"
+             for query in QUERIES for film_type in ('movie', 'show')]
+    aggs = ['/api/aggs/', '/api/aggs/movie/', '/api/aggs/show/']
+    return {
+        'get_film': (films, False),
+        'get_film_uncached': (films, True),
+        'aggs_cached': (aggs, False),
+        'aggs_uncached': (aggs, True),
+    }
+
+
+async def record(path):
+    """
+    Record the database responses of every scenario, from the in-memory
+    backend loaded with the bundled catalogue.
+
+    Args:
+        path (str): The path of the recordings file to write.
+
+    Returns:
+        (dict): The recordings.
+    """
+    backend = MemoryElasticsearch(os.environ['ELASTIC_INDEX'])
+    backend.load(get_row('datasets/netflix.csv'))
+    main.app.state.esdb = recorder = RecordingElasticsearch(backend)
+    async with client() as http:
+        for urls, _ in scenarios().values():
+            invalidate()
+            for url in urls:
+                (await http.get(url)).raise_for_status()
+    with open(path, 'wb') as file:
+        file.write(orjson.dumps(recorder.recordings))
+    return recorder.recordings
+
+
+def invalidate():
+    """
+    Drop the cached aggregations and search results, so requests reach the database.
+
+    Returns:
+        None
+    """
+    main.aggs_cache.invalidate()
+    main.search_cache.invalidate()
+
+
+def client():
+    """
+    Create an HTTP client sending requests straight to the application.
+
+    Returns:
+        (httpx.AsyncClient): The client.
+    """
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app),
+                             base_url='http://bench')
+
+
+async def run_scenario(urls, uncached, requests, concurrency):
+    """
+    Send the scenario requests from concurrent clients, timing each.
+
+    Args:
+        urls (list[str]): The URLs requested in turn.
+        uncached (bool): Whether to drop cached results before each request.
+        requests (int): The total number of requests.
+        concurrency (int): The number of requests in flight at once.
+
+    Returns:
+        (tuple[list[float], float]): The latency of each request, and the
+            seconds the whole run took.
+    """
+    cycle = itertools.cycle(urls)
+    remaining = iter(range(requests))
+    timings = []
+
+    async def worker(http):
+        for _ in remaining:
+            url = next(cycle)
+            if uncached:
+                invalidate()
+            start = time.perf_counter()
+            response = await http.get(url)
+            timings.append(time.perf_counter() - start)
+            response.raise_for_status()
+
+    async with client() as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(http) for _ in range(concurrency)))
+        return timings, time.perf_counter() - start
+
+
+async def measure_allocations(urls, uncached, requests):
+    """
+    Measure the memory allocated per request, one request at a time.
+
+    Args:
+        urls (list[str]): The URLs requested in turn.
+        uncached (bool): Whether to drop cached results before each request.
+        requests (int): The number of requests measured.
+
+    Returns:
+        (float): The mean peak of memory allocated by a request, in KiB.
+    """
+    peaks = []
+    async with client() as http:
+        # Warm up, so lazily built state is not counted
+        await http.get(urls[0])
+        tracemalloc.start()
+        try:
+            for url in itertools.islice(itertools.cycle(urls), requests):
+                if uncached:
+                    invalidate()
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+                await http.get(url)
+                peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+    return statistics.mean(peaks) / 1024
+
+
+def bench_ingestion(repeat):
+    """
+    Time the get_row ingestion path over the bundled catalogue, both
+    processing the CSV rows and decoding its snapshot, built first if missing.
+
+    Args:
+        repeat (int): The number of passes over the catalogue.
+
+    Returns:
+        (dict[str, dict]): The results of each path.
+    """
+    source = 'datasets/netflix.csv'
+    built = open_snapshot(source)
+    # The snapshot is not committed, and without it get_row would read the CSV again
+    if built is None:
+        build_snapshot(source)
+    else:
+        built.close()
+    results = {}
+    for name, snapshot in (('get_row_csv', 'false'), ('get_row_snapshot', 'true')):
+        os.environ['INGEST_SNAPSHOT'] = snapshot
+        timings, rows = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = sum(1 for _ in get_row(source))
+            timings.append(time.perf_counter() - start)
+        tracemalloc.start()
+        for _ in get_row(source):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {'rows': rows, 'rows_per_sec': rows / statistics.median(timings),
+                         'p50_ms': statistics.median(timings) * 1000,
+                         'peak_kib': peak / 1024}
+    os.environ.pop('INGEST_SNAPSHOT')
+    return results
+
+
+def percentile(timings, fraction):
+    """
+    Get a latency percentile in milliseconds.
+
+    Args:
+        timings (list[float]): The sorted latencies in seconds.
+        fraction (float): The percentile, between 0 and 1.
+
+    Returns:
+        (float): The latency in milliseconds.
+    """
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)] * 1000
+
+
+async def bench(args):
+    """
+    Run every scenario and collect the results.
+
+    Args:
+        args (argparse.Namespace): The benchmark settings.
+
+    Returns:
+        (dict): The results, with the settings and environment they ran in.
+    """
+    if args.record or not os.path.exists(args.recordings):
+        recordings = await record(args.recordings)
+    else:
+        with open(args.recordings, 'rb') as file:
+            recordings = orjson.loads(file.read())
+    main.app.state.esdb = ReplayElasticsearch(recordings, args.latency_ms / 1000)
+
+    results = {}
+    for name, (urls, uncached) in scenarios().items():
+        timings, seconds = await run_scenario(urls, uncached, args.requests, args.concurrency)
+        timings.sort()
+        results[name] = {
+            'requests': len(timings),
+            'rps': len(timings) / seconds,
+            'p50_ms': percentile(timings, 0.50),
+            'p95_ms': percentile(timings, 0.95),
+            'p99_ms': percentile(timings, 0.99),
+            'alloc_kib': await measure_allocations(urls, uncached, args.alloc_requests),
+        }
+    results.update(bench_ingestion(args.ingest_repeat))
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                                capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'settings': {'requests': args.requests, 'concurrency': args.concurrency,
+                         'latency_ms': args.latency_ms},
+            'results': results}
+
+
+def report(current, baseline=None):
+    """
+    Print the results, with the change from a baseline run if given.
+
+    Args:
+        current (dict): The results of this run.
+        baseline (dict): The results of an earlier run.
+
+    Returns:
+        None
+    """
+    previous = (baseline or {}).get('results', {})
+    for name, metrics in current['results'].items():
+        cells = []
+        for metric, value in metrics.items():
+            cell = f"{metric} {value:.2f}" if isinstance(value, float) else f"{metric} {value}"
+            before = previous.get(name, {}).get(metric)
+            if isinstance(value, float) and before:
+                cell += f" ({(value - before) / before:+.0%})"
+            cells.append(cell)
+        print(f"{name:<18} " + '   '.join(cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000,
+                        help="The number of requests per scenario.")
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="The number of requests in flight at once.")
+    parser.add_argument('--latency-ms', type=float, default=2.0,
+                        help="The latency of each replayed database request.")
+    parser.add_argument('--alloc-requests', type=int, default=200,
+                        help="The number of requests measured for allocations.")
+    parser.add_argument('--ingest-repeat', type=int, default=5,
+                        help="The number of passes over the catalogue for get_row.")
+    parser.add_argument('--recordings', default=RECORDINGS,
+                        help="The recorded database responses to replay.")
+    parser.add_argument('--record', action='store_true',
+                        help="Record the responses again from the in-memory backend.")
+    parser.add_argument('--output', default=None, help="Where to save the results as JSON.")
+    parser.add_argument('--baseline', default=None,
+                        help="Earlier results to compare against.")
+    arguments = parser.parse_args()
+
+    results = asyncio.run(bench(arguments))
+    baseline_results = None
+    if arguments.baseline:
+        with open(arguments.baseline, 'r', encoding='utf-8') as baseline_file:
+            baseline_results = json.load(baseline_file)
+    report(results, baseline_results)
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
@@ -0,0 +1,79 @@
+"""
+Created by: Brandon Goddard
+Description: This module is a benchmark of the cold start of the API, from
+             a fresh process to its first served request, with and without
+             the catalogue snapshot. It uses the in-memory backend, as loading
+             documents is then part of every start. Run it from backend/app:
+             python ../benchmarks/bench_startup.py --repeat 5
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+sys.path.insert(0, os.getcwd())
+
+from snapshot import build_snapshot, open_snapshot
+
+
+# Starts the API in a fresh interpreter, and serves one request
+CHILD = """
+import sys
+sys.path.insert(0, '.')
+from fastapi.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    assert client.get('/api/aggs/').status_code == 200
+"""
+
+
+def cold_start(snapshot):
+    """
+    Time a fresh process from its start to its first served request.
+
+    Args:
+        snapshot (bool): Whether the catalogue snapshot may be used.
+
+    Returns:
+        (float): The seconds taken.
+    """
+    env = dict(os.environ, SEARCH_BACKEND='memory', INGEST_SNAPSHOT=str(snapshot),
+               ELASTIC_INDEX=os.environ.get('ELASTIC_INDEX', 'netflix'))
+    env.pop('CACHE_DIR', None)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-W', 'ignore', '-c', CHILD], env=env, check=True)
+    return time.perf_counter() - start
+
+
+def bench(repeat):
+    """
+    Time cold starts with and without the snapshot.
+
+    Args:
+        repeat (int): The number of starts of each kind.
+
+    Returns:
+        None
+    """
+    source = 'datasets/netflix.csv'
+    if open_snapshot(source) is None:
+        start = time.perf_counter()
+        build_snapshot(source)
+        print(f"built snapshot in {time.perf_counter() - start:.3f} s")
+
+    medians = {}
+    for snapshot in (False, True):
+        timings = [cold_start(snapshot) for _ in range(repeat)]
+        medians[snapshot] = statistics.median(timings)
+        name = 'snapshot' if snapshot else 'csv'
+        print(f"{name:<10} median {medians[snapshot]:.3f} s   min {min(timings):.3f} s")
+    print(f"cold start is {medians[False] - medians[True]:.3f} s faster with the snapshot")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="The number of starts of each kind.")
+    bench(parser.parse_args().repeat)
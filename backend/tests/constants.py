@@ -50,6 +50,27 @@ MOCK_MOVIE_AGG = {
 
 MOCK_SHOW_AGG = {'total_agg': 2676}
 
+# Processed sources with an unknown (-1) type or rating, or no duration
+MOCK_UNKNOWN_SOURCES = [
+    {'type': 1, 'rating': 0, 'duration': 90, 'release_year': 2001},
+    {'type': -1, 'rating': -1, 'duration': 30, 'release_year': 2005},
+    {'type': 0, 'rating': -1, 'duration': None, 'release_year': 2010},
+    {'type': -1, 'rating': 3, 'duration': 100, 'release_year': 2015},
+    {'type': 1, 'rating': 3, 'duration': None, 'release_year': None}
+]
+
+# The aggregations Elasticsearch responds with for MOCK_UNKNOWN_SOURCES,
+# where value_count and terms count -1 like any other value
+MOCK_UNKNOWN_AGG = {
+    'total_agg': {'value': 5},
+    'avg_dur_agg': {'value': 73.33333333333333},
+    'rating_agg': {'doc_count_error_upper_bound': 0,
+                   'sum_other_doc_count': 0,
+                   'buckets': [{'key': -1, 'doc_count': 2},
+                               {'key': 3, 'doc_count': 2},
+                               {'key': 0, 'doc_count': 1}]}
+}
+
 MOCK_CSV_ROW = {
     'show_id': 's10',
     'type': 'Movie',
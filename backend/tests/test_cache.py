@@ -0,0 +1,277 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the cache module,
+             which holds results between index reloads.
+"""
+import os
+import sys
+import asyncio
+import threading
+import subprocess
+from ..app.cache import Generation, TTLCache, SharedStore, MISSING
+
+
+APP_DIR = os.path.join(os.path.dirname(__file__), '..', 'app')
+
+
+class FakeClock:
+    """A manually advanced clock for expiring cache entries."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        """Move the clock forward."""
+        self.now += seconds
+
+
+def test_hits_and_expiry():
+    """
+    Test that cached values are reused until their TTL passes.
+
+    Returns:
+        None
+    """
+    clock = FakeClock()
+    cache = TTLCache(ttl=10, maxsize=4, clock=clock)
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        assert await cache.get_or_set('all', factory) == 1
+        assert await cache.get_or_set('all', factory) == 1
+        clock.advance(11)
+        assert await cache.get_or_set('all', factory) == 2
+
+    asyncio.run(run())
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+
+def test_size_limit():
+    """
+    Test that the least recently used entry is evicted first.
+
+    Returns:
+        None
+    """
+    cache = TTLCache(ttl=60, maxsize=2)
+
+    async def factory():
+        return 'value'
+
+    async def run():
+        await cache.get_or_set('movie', factory)
+        await cache.get_or_set('show', factory)
+        await cache.get_or_set('movie', factory)
+        await cache.get_or_set('all', factory)
+
+    asyncio.run(run())
+    assert len(cache) == 2
+    assert cache.stats()['misses'] == 3
+    asyncio.run(cache.get_or_set('movie', factory))
+    assert cache.stats()['hits'] == 2
+
+
+def test_coalescing():
+    """
+    Test that concurrent misses on a key share a single computation.
+
+    Returns:
+        None
+    """
+    cache = TTLCache(ttl=60, maxsize=4)
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'aggs'
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_set('all', factory)
+                                      for _ in range(5)))
+
+    assert asyncio.run(run()) == ['aggs'] * 5
+    assert len(calls) == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['coalesced'] == 4
+
+
+def test_generation_invalidation():
+    """
+    Test that bumping the index generation drops cached entries,
+    including values computed against the previous generation.
+
+    Returns:
+        None
+    """
+    generation = Generation()
+    cache = TTLCache(ttl=60, maxsize=4, generation=generation)
+
+    async def factory():
+        return generation.value
+
+    async def bumping_factory():
+        generation.bump()
+        return 'stale'
+
+    async def run():
+        assert await cache.get_or_set('all', factory) == 0
+        generation.bump()
+        assert await cache.get_or_set('all', factory) == 1
+        await cache.get_or_set('show', bumping_factory)
+
+    asyncio.run(run())
+    assert asyncio.run(cache.get_or_set('all', factory)) == 2
+    assert cache.stats()['misses'] == 4
+    assert len(cache) == 1
+
+
+
+def test_get_and_set():
+    """
+    Test that values computed by the caller after a miss are cached,
+    unless the index generation changed while computing them.
+
+    Returns:
+        None
+    """
+    generation = Generation()
+    cache = TTLCache(ttl=60, maxsize=4, generation=generation)
+    assert cache.get('love') is MISSING
+
+    current = generation.value
+    cache.set('love', ['Love Actually'], current)
+    assert cache.get('love') == ['Love Actually']
+
+    current = generation.value
+    generation.bump()
+    cache.set('war', ['War Horse'], current)
+    assert cache.get('war') is MISSING
+    assert cache.get('love') is MISSING
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 3)
+
+def test_shared_between_workers(tmp_path):
+    """
+    Test that caches sharing a store and generation file, like the
+    workers of a host, compute a value once and drop it together.
+
+    Returns:
+        None
+    """
+    first, second = (Generation(str(tmp_path / 'generation')) for _ in range(2))
+    caches = [TTLCache(ttl=60, maxsize=4, generation=generation,
+                       store=SharedStore(str(tmp_path / 'aggs')))
+              for generation in (first, second)]
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'total_agg': len(calls)}
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_set('combined', factory)
+                                      for cache in caches))
+
+    assert asyncio.run(run()) == [{'total_agg': 1}] * 2
+    assert len(calls) == 1
+    assert sum(cache.stats()['shared_hits'] for cache in caches) == 1
+
+    # A bump in one process is seen by the other
+    first.bump()
+    assert second.value == 1
+    assert asyncio.run(caches[1].get_or_set('combined', factory)) == {'total_agg': 2}
+
+
+def test_bumped_by_another_process(tmp_path):
+    """
+    Test that a search cache built like the API's misses once an
+    ingestion run sharing CACHE_DIR, as set by the compose file, bumps
+    the generation from its own process.
+
+    Returns:
+        None
+    """
+    cache_dir = str(tmp_path / 'catalogue-cache')
+    cache = TTLCache(ttl=60, maxsize=4,
+                     generation=Generation(os.path.join(cache_dir, 'generation')))
+    calls = []
+
+    async def factory():
+        calls.append(1)
+        return len(calls)
+
+    assert asyncio.run(cache.get_or_set('amelie', factory)) == 1
+    assert asyncio.run(cache.get_or_set('amelie', factory)) == 1
+
+    subprocess.run([sys.executable, '-c',
+                    'from cache import index_generation; index_generation.bump()'],
+                   cwd=APP_DIR, env={**os.environ, 'CACHE_DIR': cache_dir}, check=True)
+    assert asyncio.run(cache.get_or_set('amelie', factory)) == 2
+    assert (cache.stats()['hits'], cache.stats()['misses']) == (1, 2)
+
+
+def test_generation_read_while_bumped(tmp_path):
+    """
+    Test that a generation read while another thread bumps it never
+    sees a counter that is half written or goes backwards.
+
+    Returns:
+        None
+    """
+    path = str(tmp_path / 'generation')
+    writer = Generation(path)
+    writer.bump()
+    seen = []
+
+    def bump_all():
+        for _ in range(200):
+            writer.bump()
+
+    thread = threading.Thread(target=bump_all)
+    thread.start()
+    reader = Generation(path)
+    while thread.is_alive():
+        seen.append(reader.value)
+    thread.join()
+    assert min(seen, default=1) >= 1
+    assert seen == sorted(seen)
+    assert reader.value == 201
+
+
+def test_memory_limit():
+    """
+    Test that the least recently used entries are evicted to keep the
+    values within the memory limit, and values over it are not kept.
+
+    Returns:
+        None
+    """
+    cache = TTLCache(ttl=60, maxsize=10, maxbytes=10, sizeof=len)
+
+    def factory(value):
+        async def compute():
+            return value
+        return compute
+
+    async def run():
+        await cache.get_or_set('movie', factory(b'1234'))
+        await cache.get_or_set('show', factory(b'1234'))
+        await cache.get_or_set('movie', factory(b'1234'))
+        await cache.get_or_set('all', factory(b'123456'))
+        await cache.get_or_set('large', factory(b'12345678901'))
+
+    asyncio.run(run())
+    assert len(cache) == 2
+    assert cache.stats()['nbytes'] == 10
+    asyncio.run(cache.get_or_set('movie', factory(b'')))
+    assert cache.stats()['hits'] == 2
+    cache.invalidate()
+    assert cache.stats()['nbytes'] == 0
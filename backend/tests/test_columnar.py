@@ -0,0 +1,122 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the columnar module,
+             which computes aggregations over NumPy columns.
+"""
+import asyncio
+import pytest
+from ..app.columnar import ColumnarAggs
+from ..app.memory import MemoryElasticsearch
+from ..app.database import get_row
+from .constants import (MOCK_TOTAL_AGG, MOCK_MOVIE_AGG, MOCK_SHOW_AGG,
+                        MOCK_UNKNOWN_SOURCES, MOCK_UNKNOWN_AGG)
+from .test_database import CSV_FILEPATH
+
+
+# Every aggregation of build_aggs, for comparing against a search engine
+ALL_AGGS = {"total_agg": {"value_count": {"field": "type"}},
+            "avg_dur_agg": {"avg": {"field": "duration"}},
+            "histo_dur_agg": {"histogram": {"field": "duration", "interval": 20,
+                                            "min_doc_count": 10}},
+            "director_agg": {"terms": {"field": "director.keyword", "size": 5}},
+            "actor_agg": {"terms": {"field": "cast.keyword", "size": 5}},
+            "genre_agg": {"terms": {"field": "genres.keyword", "size": 5}},
+            "country_agg": {"terms": {"field": "country.keyword", "size": 5}},
+            "rating_agg": {"terms": {"field": "rating", "size": 5}}}
+ALL_FLAGS = {"avg_duration": True, "histo_duration": True, "directors": True,
+             "actors": True, "genres": True, "countries": True, "ratings": True}
+
+
+@pytest.fixture(scope="module")
+def actions():
+    """
+    A fixture for the processed rows of the bundled catalogue.
+
+    Returns:
+        list[dict]: The bulk index actions of every row.
+    """
+    return list(get_row(CSV_FILEPATH, 'test_index'))
+
+
+def buckets(aggs):
+    """
+    Flatten aggregations into comparable values.
+
+    Args:
+        aggs (dict): The aggregations of a response.
+
+    Returns:
+        (dict): The value or bucket counts of each aggregation.
+    """
+    return {name: agg['value'] if 'value' in agg else
+            [(bucket['key'], bucket['doc_count']) for bucket in agg['buckets']]
+            for name, agg in aggs.items()}
+
+
+def test_known_aggs(actions):
+    """
+    Test that the aggregations match those computed by Elasticsearch.
+
+    Returns:
+        None
+    """
+    columns = ColumnarAggs.from_rows(actions)
+    total = columns.aggregate(**ALL_FLAGS)
+    movie = columns.aggregate(film_type=1, avg_duration=True, histo_duration=True)
+
+    assert total['total_agg']['value'] == MOCK_TOTAL_AGG['total_agg']
+    for name in ['director_agg', 'actor_agg', 'genre_agg', 'country_agg']:
+        assert ({bucket['key']: bucket['doc_count'] for bucket in total[name]['buckets']}
+                == MOCK_TOTAL_AGG[name])
+    assert int(movie['avg_dur_agg']['value']) == MOCK_MOVIE_AGG['avg_dur_agg']
+    assert ({str(int(bucket['key'])): bucket['doc_count']
+             for bucket in movie['histo_dur_agg']['buckets']}
+            == MOCK_MOVIE_AGG['histo_dur_agg'])
+    assert columns.aggregate(film_type=0)['total_agg']['value'] == MOCK_SHOW_AGG['total_agg']
+
+
+def test_unknown_values():
+    """
+    Test that unknown types and ratings are counted like Elasticsearch
+    counts them, while missing durations are left out.
+
+    Returns:
+        None
+    """
+    columns = ColumnarAggs(MOCK_UNKNOWN_SOURCES)
+    aggs = columns.aggregate(avg_duration=True, ratings=True)
+    assert buckets(aggs) == buckets(MOCK_UNKNOWN_AGG)
+    assert columns.aggregate(film_type=-1)['total_agg']['value'] == 2
+    assert columns.aggregate(release_year={'lt': 2020})['total_agg']['value'] == 4
+
+
+@pytest.mark.parametrize("film_type,release_year,date_added", [
+    (None, None, None),
+    (1, {"gte": 2000, "lt": 2010}, None),
+    (0, None, {"gte": "2019-01-01", "lte": "12312019"}),
+    (None, {"gt": 2015}, {"lt": "2018-06-01"})])
+def test_filtered_aggs(actions, film_type, release_year, date_added):
+    """
+    Test that filtered aggregations match the equivalent filtered search.
+
+    Args:
+        film_type (int): The film type to keep.
+        release_year (dict): A range query on the release year.
+        date_added (dict): A range query on the date added.
+
+    Returns:
+        None
+    """
+    filters = [{"term": {"type": film_type}}] if film_type is not None else []
+    if release_year:
+        filters.append({"range": {"release_year": release_year}})
+    if date_added:
+        filters.append({"range": {"date_added": date_added}})
+    esdb = MemoryElasticsearch('test_index')
+    esdb.load(actions)
+    response = asyncio.run(esdb.search(query={"bool": {"filter": filters}},
+                                       aggs=ALL_AGGS, size=0))
+
+    columns = ColumnarAggs.from_rows(actions)
+    aggs = columns.aggregate(film_type, release_year, date_added, **ALL_FLAGS)
+    assert buckets(aggs) == buckets(response['aggregations'])
@@ -3,9 +3,118 @@ Created by: Brandon Goddard
 Description: This module is for testing the database module,
              which handles Elasticsearch interactions.
 """
-from ..app.database import filter_row, filter_text, filter_dates, filter_strings
+import os
+import csv
+import gzip
+import json
+import asyncio
+from types import SimpleNamespace
+from elastic_transport import SerializerCollection, JsonSerializer
+import pytest
+from elasticsearch import AsyncElasticsearch, ConflictError
+from ..app.database import (filter_row, filter_text, filter_dates, filter_strings,
+                            get_row, process_row, read_chunks, bulk_load, reindex, rollback,
+                            wait_for_elastic_db, get_pool_stats, MeteredNode,
+                            init_lock)
+from ..app.transform import transform_columns
+from ..app.sources import Checkpoint
 from .constants import MOCK_CSV_ROW
 
+
+CSV_FILEPATH = os.path.join(os.path.dirname(__file__), '..', 'app',
+                            'datasets', 'netflix.csv')
+
+
+class FakeIndicesClient:
+    """
+    A stand-in for the Elasticsearch indices client, tracking
+    the indices, their settings and their aliases.
+
+    Attributes:
+        indices (dict): The settings and aliases of each index, keyed by name.
+    """
+    def __init__(self):
+        self.indices = {}
+
+    async def create(self, index, settings=None, **_):
+        """Create an index with the given settings."""
+        self.indices[index] = {'settings': dict(settings or {}), 'aliases': {}}
+
+    async def get(self, index, **_):
+        """Get the indices matching a trailing wildcard pattern."""
+        prefix = index.rstrip('*')
+        return SimpleNamespace(body={name: value for name, value in self.indices.items()
+                                     if name.startswith(prefix)})
+
+    async def exists(self, index):
+        """Check whether an index or alias exists."""
+        return index in self.indices or await self.exists_alias(index)
+
+    async def exists_alias(self, name):
+        """Check whether an alias exists."""
+        return any(name in value['aliases'] for value in self.indices.values())
+
+    async def update_aliases(self, actions):
+        """Apply the alias actions."""
+        for action in actions:
+            for kind, args in action.items():
+                if kind == 'add':
+                    self.indices[args['index']]['aliases'][args['alias']] = {}
+                elif kind == 'remove':
+                    self.indices[args['index']]['aliases'].pop(args['alias'])
+                else:
+                    self.indices.pop(args['index'])
+
+    async def put_settings(self, index, settings):
+        """Update the settings of an index."""
+        self.indices[index]['settings'].update(settings)
+
+    async def delete(self, index):
+        """Delete the comma separated indices."""
+        for name in index.split(','):
+            self.indices.pop(name, None)
+
+    async def refresh(self, **_):
+        """Refreshing has no effect."""
+
+    async def forcemerge(self, **_):
+        """Merging has no effect."""
+
+
+class FakeBulkClient:
+    """
+    A stand-in for the Elasticsearch client, storing bulk inserted documents.
+
+    Attributes:
+        docs (dict): The stored documents, keyed by ID.
+        fail_ids (set): Document IDs the bulk requests should reject.
+        indices (FakeIndicesClient): The indices client.
+    """
+    def __init__(self, fail_ids=()):
+        self.docs = {}
+        self.fail_ids = set(fail_ids)
+        self.indices = FakeIndicesClient()
+        self.transport = SimpleNamespace(serializers=SerializerCollection(
+            {'application/json': JsonSerializer()}))
+
+    def options(self, **_):
+        """Return the client itself, ignoring any transport options."""
+        return self
+
+    async def bulk(self, operations, **_):
+        """Store each document of the bulk request unless it should fail."""
+        items = []
+        for header, source in zip(operations[::2], operations[1::2]):
+            action = json.loads(header)['index']
+            if action['_id'] in self.fail_ids:
+                items.append({'index': {**action, 'status': 400,
+                                        'error': 'mapper_parsing_exception'}})
+            else:
+                self.docs[action['_id']] = json.loads(source)
+                items.append({'index': {**action, 'status': 201}})
+        errors = any(item['index']['status'] >= 300 for item in items)
+        return SimpleNamespace(body={'errors': errors, 'items': items})
+
 def test_filtering():
     """
     Test the filtering function for database insertion.
@@ -56,3 +165,322 @@ def test_filter_text():
     # Test with both punctuations and accents removed
     filtered_text = filter_text(text_to_filter)
     assert filtered_text == text_fully_filtered
+
+
+def test_transform_columns():
+    """
+    Test that the column-wise transform builds exactly the documents
+    the per-row filters do, including for malformed values.
+
+    Returns:
+        None
+    """
+    columns = next(read_chunks(CSV_FILEPATH, 100000))
+    header = list(columns)
+    rows = [dict(zip(header, values)) for values in zip(*columns.values())]
+    odd = {'show_id': '', 'type': 'Movie', 'title': ' Amélie ', 'director': ' ',
+           'cast': 'Zoë Kravitz,, Renée', 'country': '', 'date_added': '',
+           'release_year': '', 'rating': '74 min', 'duration': '2 Seasons',
+           'listed_in': 'Dramas', 'description': 'Café — “crème”'}
+    for date in ('April 1, 2019', ' february 30, 2020', 'Sept 1, 2019', 'August 01, 0999',
+                 'nonsense', ''):
+        rows.append({**odd, 'date_added': date})
+        columns = {name: values + [rows[-1][name]] for name, values in columns.items()}
+
+    expected = [process_row(dict(row), 'test_index') for row in rows]
+    assert transform_columns(columns, 'test_index') == expected
+
+
+def test_bulk_load():
+    """
+    Test that the chunked, parallel load indexes the same
+    documents as processing the CSV file row by row.
+
+    Returns:
+        None
+    """
+    esdb = FakeBulkClient()
+    report = asyncio.run(bulk_load(esdb, CSV_FILEPATH, 'test_index',
+                                   chunk_size=1000, concurrency=2, workers=2))
+    expected = {action['_id']: action['_source']
+                for action in get_row(CSV_FILEPATH, 'test_index')}
+
+    assert esdb.docs == expected
+    assert report['rows'] == len(expected)
+    assert report['chunks'] == -(-len(expected) // 1000)
+    assert report['failed'] == 0 and report['errors'] == []
+    assert report['bytes'] > 0 and report['rows_per_sec'] > 0
+
+
+def test_bulk_load_chunk_errors():
+    """
+    Test that rejected documents are reported with their chunk,
+    without failing the rest of the load.
+
+    Returns:
+        None
+    """
+    esdb = FakeBulkClient(fail_ids={'s1', 's2500'})
+    report = asyncio.run(bulk_load(esdb, CSV_FILEPATH, 'test_index',
+                                   chunk_size=1000, workers=0))
+
+    assert report['failed'] == 2
+    assert sorted(error['chunk'] for error in report['errors']) == [0, 2]
+    assert 's1' not in esdb.docs and 's3' in esdb.docs
+
+
+def test_bulk_load_malformed_rows(tmp_path):
+    """
+    Test that a chunk whose transform fails is reported as failed,
+    and that reindexing it raises without touching the alias.
+
+    Returns:
+        None
+    """
+    with open(CSV_FILEPATH, 'r', encoding='utf-8') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    rows[1500]['duration'] = 'ninety minutes'
+    path = str(tmp_path / 'netflix.csv')
+    with open(path, 'w', encoding='utf-8', newline='') as target:
+        writer = csv.DictWriter(target, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    esdb = FakeBulkClient()
+    report = asyncio.run(bulk_load(esdb, path, 'test_index', chunk_size=1000, workers=0))
+    assert report['failed'] == 1000
+    assert report['rows'] == len(rows) - 1000
+    assert [error['chunk'] for error in report['errors']] == [1]
+    assert 'ValueError' in report['errors'][0]['sample'][0]
+
+    esdb = FakeBulkClient()
+    asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', workers=0))
+    live = dict(esdb.indices.indices)
+    with pytest.raises(RuntimeError):
+        asyncio.run(reindex(esdb, path, 'films', chunk_size=1000, workers=0))
+    assert esdb.indices.indices == live
+
+
+@pytest.mark.parametrize("name", ["netflix.csv.gz", "netflix.csv.zst",
+                                  "netflix.ndjson", "netflix.parquet"])
+def test_read_formats(tmp_path, name):
+    """
+    Test that compressed, NDJSON and Parquet copies of the
+    catalogue load the same documents as the CSV file.
+
+    Args:
+        name (str): The name of the copy, setting its format.
+
+    Returns:
+        None
+    """
+    with open(CSV_FILEPATH, 'r', encoding='utf-8') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    path = str(tmp_path / name)
+    if name.endswith('.gz'):
+        with open(CSV_FILEPATH, 'rb') as source, gzip.open(path, 'wb') as target:
+            target.write(source.read())
+    elif name.endswith('.zst'):
+        zstandard = pytest.importorskip('zstandard')
+        with open(CSV_FILEPATH, 'rb') as source, open(path, 'wb') as target:
+            target.write(zstandard.ZstdCompressor().compress(source.read()))
+    elif name.endswith('.ndjson'):
+        with open(path, 'w', encoding='utf-8') as target:
+            target.writelines(json.dumps(row) + '\n' for row in rows)
+    else:
+        pyarrow = pytest.importorskip('pyarrow')
+        pytest.importorskip('pyarrow.parquet').write_table(
+            pyarrow.Table.from_pylist(rows), path, row_group_size=3000)
+
+    assert list(get_row(path, 'test_index')) == list(get_row(CSV_FILEPATH, 'test_index'))
+
+
+def test_reindex_resume(tmp_path):
+    """
+    Test that a failed load keeps its index and progress,
+    and that the next run only loads the rows after it.
+
+    Returns:
+        None
+    """
+    path = str(tmp_path / 'load.checkpoint')
+    esdb = FakeBulkClient(fail_ids={'s2500'})
+    with pytest.raises(RuntimeError):
+        asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', checkpoint=path,
+                            chunk_size=1000, concurrency=1, workers=0))
+    state = Checkpoint(path).load()
+    # The chunk holding the failed document, and any after it, are redone
+    assert state['rows'] == 2000
+    assert state['index'] in esdb.indices.indices
+
+    esdb.fail_ids.clear()
+    esdb.docs.clear()
+    report = asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', checkpoint=path,
+                                 chunk_size=1000, workers=0))
+    total = sum(1 for _ in get_row(CSV_FILEPATH, 'films'))
+    assert report['rows'] == total - 2000
+    assert 's2000' not in esdb.docs and 's2001' in esdb.docs
+    assert esdb.indices.indices[state['index']]['aliases'] == {'films': {}}
+    assert not os.path.exists(path)
+
+
+def test_reindex_alias_swap():
+    """
+    Test that reindexing loads a new tuned index, swaps the
+    alias over to it, and keeps one previous version.
+
+    Returns:
+        None
+    """
+    esdb = FakeBulkClient()
+    asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', keep=1, workers=0))
+    asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', keep=1, workers=0))
+    first, second = sorted(esdb.indices.indices)
+    assert esdb.indices.indices[first]['aliases'] == {}
+    assert esdb.indices.indices[second]['aliases'] == {'films': {}}
+    assert esdb.indices.indices[second]['settings']['refresh_interval'] is None
+
+    asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', keep=1, workers=0))
+    assert first not in esdb.indices.indices
+    assert len(esdb.indices.indices) == 2
+
+    # The alias goes back to the version loaded before
+    assert asyncio.run(rollback(esdb, 'films')) == second
+    assert esdb.indices.indices[second]['aliases'] == {'films': {}}
+
+
+def test_failed_reindex_keeps_alias():
+    """
+    Test that a failed load is discarded without touching the alias.
+
+    Returns:
+        None
+    """
+    esdb = FakeBulkClient()
+    asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', workers=0))
+    live = dict(esdb.indices.indices)
+
+    esdb.fail_ids = {'s1'}
+    with pytest.raises(RuntimeError):
+        asyncio.run(reindex(esdb, CSV_FILEPATH, 'films', workers=0))
+    assert esdb.indices.indices == live
+
+
+def test_wait_for_elastic_db():
+    """
+    Test that startup retries until the database answers, and gives up
+    after the allowed number of attempts.
+
+    Returns:
+        None
+    """
+    def flaky_client(failures):
+        """A client whose pings only succeed after a few failures."""
+        pings = []
+
+        async def ping():
+            pings.append(True)
+            return len(pings) > failures
+        return SimpleNamespace(ping=ping, pings=pings)
+
+    esdb = flaky_client(failures=2)
+    asyncio.run(wait_for_elastic_db(esdb, attempts=5, delay=0.001))
+    assert len(esdb.pings) == 3
+
+    esdb = flaky_client(failures=10)
+    with pytest.raises(RuntimeError):
+        asyncio.run(wait_for_elastic_db(esdb, attempts=3, delay=0.001))
+    assert len(esdb.pings) == 3
+
+
+def test_pool_stats():
+    """
+    Test that the pool usage of each node is reported.
+
+    Returns:
+        None
+    """
+    esdb = AsyncElasticsearch(hosts="http://esdb:9200", node_class=MeteredNode,
+                              connections_per_node=8)
+    stats = get_pool_stats(esdb)
+    assert stats == [{'node': 'http://esdb:9200', 'in_flight': 0, 'peak': 0,
+                      'requests': 0, 'pool_size': 8, 'saturation': 0.0}]
+
+
+class FakeLockClient:
+    """A stand-in for the document APIs the init lock relies on."""
+    def __init__(self):
+        self.docs = {}
+        self.seq_no = 0
+        self.indices = SimpleNamespace(create=self._noop)
+
+    def options(self, **_):
+        """Return the client itself, whatever the request options."""
+        return self
+
+    async def _noop(self, **_):
+        return {}
+
+    async def create(self, index, document, **kwargs):
+        """Store a document, failing if its ID is already taken."""
+        key = (index, kwargs['id'])
+        if key in self.docs:
+            raise ConflictError("version_conflict_engine_exception", None, {})
+        self.seq_no += 1
+        self.docs[key] = (self.seq_no, document)
+        return {'_seq_no': self.seq_no, '_primary_term': 1}
+
+    async def get(self, index, **kwargs):
+        """Retrieve a document along with its sequence number."""
+        key = (index, kwargs['id'])
+        if key not in self.docs:
+            return {'found': False}
+        seq_no, document = self.docs[key]
+        return {'found': True, '_seq_no': seq_no, '_primary_term': 1, '_source': document}
+
+    async def delete(self, index, if_seq_no=None, **kwargs):
+        """Remove a document, if it is still at the given sequence number."""
+        key = (index, kwargs['id'])
+        if key in self.docs and if_seq_no in (None, self.docs[key][0]):
+            del self.docs[key]
+
+
+def test_init_lock():
+    """
+    Test that workers initialize one at a time, and that a lock left
+    behind by a crashed worker is taken over once expired.
+
+    Returns:
+        None
+    """
+    esdb = FakeLockClient()
+    events = []
+
+    async def worker(name):
+        async with init_lock(esdb, 'films', poll=0.001):
+            events.append(('start', name))
+            await asyncio.sleep(0.01)
+            events.append(('end', name))
+
+    async def run():
+        await asyncio.gather(*(worker(name) for name in range(3)))
+
+    asyncio.run(run())
+    # Each worker finished before the next one started
+    assert [event for event, _ in events] == ['start', 'end'] * 3
+    assert not esdb.docs
+
+    esdb.docs[('films_locks', 'init')] = (0, {'owner': 'crashed', 'expires': 0})
+    asyncio.run(worker('late'))
+    assert events[-1] == ('end', 'late')
+
+    async def taken_over():
+        async with init_lock(esdb, 'films', ttl=0.001):
+            # Another worker takes over the lock once it has expired
+            esdb.seq_no += 1
+            esdb.docs[('films_locks', 'init')] = (esdb.seq_no, {'owner': 'other',
+                                                                'expires': 0})
+
+    asyncio.run(taken_over())
+    # The new holder's lock is left alone
+    assert esdb.docs[('films_locks', 'init')][1]['owner'] == 'other'
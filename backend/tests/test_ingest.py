@@ -0,0 +1,95 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the ingest module,
+             which incrementally loads catalogue CSV files.
+"""
+import csv
+from ..app.ingest import get_delta_actions
+from ..app.database import get_row
+from .test_database import CSV_FILEPATH
+
+
+def write_csv(path, rows):
+    """
+    Write the given catalogue rows to a CSV file.
+
+    Args:
+        path (Path): The path of the CSV file to write.
+        rows (list[dict]): The raw catalogue rows.
+
+    Returns:
+        (str): The path of the written file.
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    return str(path)
+
+
+def read_rows(limit):
+    """
+    Read the first raw rows of the bundled catalogue.
+
+    Args:
+        limit (int): The number of rows to read.
+
+    Returns:
+        (list[dict]): The raw catalogue rows.
+    """
+    with open(CSV_FILEPATH, 'r', encoding='utf-8') as csv_file:
+        return [row for _, row in zip(range(limit), csv.DictReader(csv_file))]
+
+
+def new_report():
+    """Return an empty delta report."""
+    return {'added': 0, 'changed': 0, 'unchanged': 0, 'rewritten': 0, 'deleted': 0}
+
+
+def test_delta_actions(tmp_path):
+    """
+    Test that only added, changed and removed documents produce actions.
+
+    Returns:
+        None
+    """
+    rows = read_rows(4)
+    old_path = write_csv(tmp_path / 'old.csv', rows[:3])
+    fingerprints = {action['_id']: action['_source']['fingerprint']
+                    for action in get_row(old_path, 'test_index')}
+
+    # Change s2, remove s3 and add s4
+    rows[1]['title'] = 'Blood and Water'
+    new_path = write_csv(tmp_path / 'new.csv', [rows[0], rows[1], rows[3]])
+    report = new_report()
+    actions = list(get_delta_actions(get_row(new_path, 'test_index'), 'test_index',
+                                     fingerprints, report))
+
+    assert report == {'added': 1, 'changed': 1, 'unchanged': 1, 'rewritten': 0, 'deleted': 1}
+    assert [(action.get('_op_type', 'index'), action['_id'])
+            for action in actions] == [('index', 's2'), ('index', 's4'),
+                                       ('delete', 's3')]
+    assert actions[0]['_source']['title'] == 'Blood and Water'
+
+
+def test_delta_actions_full(tmp_path):
+    """
+    Test that a full run rewrites unchanged documents too, and counts them.
+
+    Returns:
+        None
+    """
+    path = write_csv(tmp_path / 'catalogue.csv', read_rows(3))
+    fingerprints = {action['_id']: action['_source']['fingerprint']
+                    for action in get_row(path, 'test_index')}
+    report = new_report()
+    actions = list(get_delta_actions(get_row(path, 'test_index'), 'test_index',
+                                     dict(fingerprints), report))
+    assert not actions
+    assert report['unchanged'] == 3
+
+    report = new_report()
+    actions = list(get_delta_actions(get_row(path, 'test_index'), 'test_index',
+                                     fingerprints, report, full=True))
+    assert len(actions) == 3
+    assert report == {**new_report(), 'rewritten': 3}
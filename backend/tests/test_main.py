@@ -3,9 +3,19 @@ Created by: Brandon Goddard
 Description: This module is for testing the main module,
              which defines the API.
 """
+import io
+import os
+import asyncio
+import csv
+import json
+import logging
+from types import SimpleNamespace
 import requests
 import pytest
-from ..app import schemas
+from elasticsearch import ConnectionError as ElasticConnectionError
+from ..app import schemas, main
+from ..app.memory import MemoryElasticsearch
+from ..app.cache import Generation
 from .constants import MOCK_TOTAL_AGG, MOCK_MOVIE_AGG, MOCK_SHOW_AGG
 
 
@@ -123,6 +133,109 @@ def test_valid_query(app_search_url, film_type, check_against_scheme_types):
     assert response.status_code == 200
 
 
+@pytest.mark.parametrize("query,fuzzy", [("stranger thi", False),
+                                         ("Strânger Things", False),
+                                         ("strangr things", True)])
+def test_analyzed_query(app_search_url, query, fuzzy):
+    """
+    Test that partial, accented and misspelled queries still match.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+        query (str): The query text to search for.
+        fuzzy (bool): Whether to tolerate typos in the query.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_search_url}show/",
+                            params={"query": query, "fuzzy": fuzzy},
+                            timeout=TIMEOUT)
+    titles = [film['title'] for film in response.json()]
+    assert 'Stranger Things' in titles
+    assert response.status_code == 200
+
+
+def test_paginated_query(app_search_url):
+    """
+    Test that paging through a search with cursors returns every
+    hit exactly once, ending without a cursor.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+
+    Returns:
+        None
+    """
+    params = {"query": "love", "size": 20, "paginate": True}
+    response = requests.get(f"{app_search_url}movie/", params=params, timeout=TIMEOUT)
+    total = int(response.headers['X-Total-Hits'])
+    titles = [film['title'] for film in response.json()]
+    while 'X-Next-Cursor' in response.headers:
+        params = {"query": "love", "size": 20, "track_total_hits": 0,
+                  "cursor": response.headers['X-Next-Cursor']}
+        response = requests.get(f"{app_search_url}movie/", params=params, timeout=TIMEOUT)
+        assert response.status_code == 200
+        assert 'X-Total-Hits' not in response.headers
+        titles.extend(film['title'] for film in response.json())
+
+    assert total > 20
+    assert len(titles) == total
+
+
+def test_invalid_cursor(app_search_url):
+    """
+    Test that a malformed cursor is rejected.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_search_url}movie/",
+                            params={"query": "love", "cursor": "notacursor"},
+                            timeout=TIMEOUT)
+    assert response.status_code == 400
+
+
+def test_failed_first_page(monkeypatch):
+    """
+    Test that the point in time opened for a first page is closed
+    when its search fails, rather than left open until it expires.
+
+    Args:
+        monkeypatch (MonkeyPatch): For pointing the API at a failing client.
+
+    Returns:
+        None
+    """
+    closed = []
+
+    async def open_point_in_time(**_):
+        return {'id': 'pit'}
+
+    async def close_point_in_time(**kwargs):
+        closed.append(kwargs['id'])
+
+    async def unreachable(**_):
+        raise ElasticConnectionError("Connection refused")
+
+    monkeypatch.setenv('ELASTIC_INDEX', 'test_index')
+    monkeypatch.setattr(main.app.state, 'esdb', SimpleNamespace(
+        open_point_in_time=open_point_in_time, close_point_in_time=close_point_in_time,
+        search=unreachable), raising=False)
+    with pytest.raises(ElasticConnectionError):
+        asyncio.run(main.search_page({'size': 10}))
+    assert closed == ['pit']
+
+    # The point in time of a later page is still in use by its cursor
+    cursor = main.encode_cursor('pit', [1.0, 2])
+    with pytest.raises(ElasticConnectionError):
+        asyncio.run(main.search_page({'size': 10}, cursor))
+    assert closed == ['pit']
+
+
 @pytest.mark.parametrize("film_type", ["movie", "show"])
 def test_empty_query(app_search_url, film_type):
     """
@@ -144,6 +257,95 @@ def test_empty_query(app_search_url, film_type):
     assert response.status_code == 200
 
 
+def test_filtered_query(app_search_url):
+    """
+    Test that filters narrow the results, and that facets count them.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_search_url}movie/",
+                            params={"query": "", "genres": "Dramas", "rating": ["TV-MA", "R"],
+                                    "release_year_min": 2015, "release_year_max": 2019,
+                                    "date_added_from": "2019-01-01", "facets": "true"},
+                            timeout=TIMEOUT)
+    assert response.status_code == 200
+    data = response.json()
+    assert data['films']
+    for film in data['films']:
+        assert 'Dramas' in film['genres']
+        assert film['rating'] in {'TV-MA', 'R'}
+        assert 2015 <= film['release_year'] <= 2019
+        assert int(film['date_added'][4:]) >= 2019
+    facets = schemas.Facets(**data['facets'])
+    assert set(facets.rating_agg) <= {'TV-MA', 'R'}
+    assert facets.genre_agg['Dramas'] == int(response.headers['X-Total-Hits'])
+
+    response = requests.get(f"{app_search_url}movie/",
+                            params={"query": "love", "rating": "XX"}, timeout=TIMEOUT)
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_export(app_url, fmt):
+    """
+    Test that exports stream every film matching the filters, with
+    decoded ratings, in either format.
+
+    Args:
+        app_url (str): The base URL of the API.
+        fmt (str): The format of the export.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_url}/api/export",
+                            params={"format": fmt, "film_type": "movie",
+                                    "release_year_min": 2020},
+                            headers={'Accept-Encoding': 'gzip'}, timeout=TIMEOUT)
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    if fmt == 'ndjson':
+        films = [json.loads(line) for line in response.text.splitlines()]
+    else:
+        films = list(csv.DictReader(io.StringIO(response.text)))
+    assert films
+    assert len({film['id'] for film in films}) == len(films)
+    for film in films:
+        assert film['type'] == 'movie'
+        assert int(film['release_year']) >= 2020
+        assert film['rating'] in schemas.RATING_TO_ID or not film['rating']
+
+
+def test_export_unknown_type(monkeypatch):
+    """
+    Test that films of an unknown type or rating are exported with those
+    fields empty, rather than passed off as shows.
+
+    Args:
+        monkeypatch (MonkeyPatch): For pointing the API at an in-memory index.
+
+    Returns:
+        None
+    """
+    esdb = MemoryElasticsearch('test_index')
+    esdb.load([{'_id': 's1', '_source': {'type': -1, 'title': 'Odd', 'rating': -1}},
+               {'_id': 's2', '_source': {'type': 0, 'title': 'Even', 'rating': 1}}])
+    monkeypatch.setenv('ELASTIC_INDEX', 'test_index')
+    monkeypatch.setattr(main.app.state, 'esdb', esdb, raising=False)
+
+    async def export():
+        return ''.join([text async for text in
+                        main.encode_csv(main.export_documents({"match_all": {}}))])
+
+    films = csv.DictReader(io.StringIO(asyncio.run(export())))
+    assert {film['id']: (film['type'], film['rating']) for film in films} == {
+        's1': ('', ''), 's2': ('show', 'TV-MA')}
+
+
 @pytest.mark.parametrize("film_type", ["movie", "show"])
 def test_wrong_query_param(app_search_url, film_type):
     """
@@ -162,6 +364,29 @@ def test_wrong_query_param(app_search_url, film_type):
     assert response.status_code == 422
 
 
+def test_batch_query(app_search_url):
+    """
+    Test that several searches run in one request, and that an
+    invalid one does not fail the others.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+
+    Returns:
+        None
+    """
+    queries = [{"film_type": "movie", "query": "parks", "size": 3},
+               {"film_type": "films", "query": "parks"},
+               {"film_type": "show", "query": "parks"}]
+    response = requests.post(f"{app_search_url}batch", json=queries, timeout=TIMEOUT)
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data) == 3
+    assert data[0]['error'] is None and 0 < len(data[0]['films']) <= 3
+    assert data[1]['films'] is None and data[1]['error']
+    assert data[2]['films'][0]['title'] == 'Parks and Recreation'
+
+
 @pytest.mark.parametrize("film_type", ["movie", "show"])
 def test_no_search_matches(app_search_url, film_type):
     """
@@ -208,6 +433,185 @@ def test_known_aggs(app_aggs_url, agg_type):
     assert response.status_code == 200
 
 
+def test_combined_aggs(app_aggs_url):
+    """
+    Test whether the combined aggregation endpoint matches the
+    aggregations returned by each of the separate endpoints.
+
+    Args:
+        app_aggs_url (str): The URL of the aggregation endpoint.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_aggs_url}combined/", timeout=TIMEOUT)
+    data = response.json()
+    assert data == {'total': MOCK_TOTAL_AGG,
+                    'movie': MOCK_MOVIE_AGG,
+                    'show': MOCK_SHOW_AGG}
+    assert response.status_code == 200
+
+
+def test_conditional_aggs(app_aggs_url):
+    """
+    Test that aggregations are compressed and carry an ETag, which
+    answers a conditional request with an empty 304 response.
+
+    Args:
+        app_aggs_url (str): The URL of the aggregation endpoint.
+
+    Returns:
+        None
+    """
+    response = requests.get(f"{app_aggs_url}combined/", timeout=TIMEOUT,
+                            headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'max-age' in response.headers['Cache-Control']
+
+    etag = response.headers['ETag']
+    response = requests.get(f"{app_aggs_url}combined/", timeout=TIMEOUT,
+                            headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert not response.content
+
+
+@pytest.mark.skipif(not os.environ.get('CACHE_DIR'),
+                    reason="The API and the tests must share CACHE_DIR")
+def test_etag_after_ingestion(app_aggs_url):
+    """
+    Test that the ETag changes once the generation is bumped by another
+    process, like an ingestion run exec'd into the API container.
+
+    Args:
+        app_aggs_url (str): The URL of the aggregation endpoint.
+
+    Returns:
+        None
+    """
+    etag = requests.get(f"{app_aggs_url}combined/", timeout=TIMEOUT).headers['ETag']
+    Generation(os.path.join(os.environ['CACHE_DIR'], 'generation')).bump()
+    response = requests.get(f"{app_aggs_url}combined/", timeout=TIMEOUT,
+                            headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_search_cache(app_search_url):
+    """
+    Test that searches differing only in case, accents and spacing
+    share a cached result.
+
+    Args:
+        app_search_url (str): The URL of the search endpoint.
+
+    Returns:
+        None
+    """
+    first = requests.get(f"{app_search_url}movie/", params={'query': 'Amélie'}, timeout=TIMEOUT)
+    second = requests.get(f"{app_search_url}movie/", params={'query': '  AMELIE '},
+                          timeout=TIMEOUT)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    # Pages are never cached, but search the same text
+    paged = requests.get(f"{app_search_url}movie/", timeout=TIMEOUT,
+                         params={'query': '  AMELIE ', 'paginate': True})
+    assert paged.json() == second.json()
+
+    # Each worker has its own cache, so only the counters of one are seen
+    stats = requests.get(f"{app_search_url}cache/", timeout=TIMEOUT).json()
+    assert 0.0 <= stats['hit_ratio'] <= 1.0
+    assert stats['nbytes'] <= stats['maxbytes']
+
+
+
+def test_normalize_query():
+    """
+    Test that the search cache key ignores case, accents and whitespace,
+    but keeps apart queries that only share a transliteration.
+
+    Returns:
+        None
+    """
+    params = schemas.FilmQuery(query="  Amélie\tPOULAIN ")
+    assert main.search_key('movie', params)[1] == "amelie poulain"
+    assert main.normalize_query("妈") != main.normalize_query("马")
+    assert main.normalize_query("Москва") != main.normalize_query("Moskva")
+    assert main.normalize_query("©") != main.normalize_query("(c)")
+
+
+def test_search_socket(app_url):
+    """
+    Test that queries streamed over the WebSocket are answered with the
+    results of the latest only, and that invalid messages get an error.
+
+    Args:
+        app_url (str): The URL of the API.
+
+    Returns:
+        None
+    """
+    client = pytest.importorskip("websockets.sync.client")
+    url = app_url.replace('http', 'ws', 1) + "/api/ws/film/"
+    with client.connect(url, open_timeout=TIMEOUT) as socket:
+        for query_id, query in enumerate(['s', 'str', 'stranger', 'stranger things']):
+            socket.send(json.dumps({'film_type': 'show', 'query': query, 'id': query_id}))
+        message = json.loads(socket.recv(timeout=TIMEOUT))
+        assert message['id'] == 3
+        assert message['error'] is None
+        assert message['total'] >= len(message['films']) > 0
+        assert 'Stranger Things' in [film['title'] for film in message['films']]
+
+        socket.send(json.dumps({'film_type': 'shows', 'query': 'love', 'id': 4}))
+        message = json.loads(socket.recv(timeout=TIMEOUT))
+        assert message['id'] == 4
+        assert message['films'] is None and message['error']
+
+
+def test_socket_search_errors(monkeypatch, caplog):
+    """
+    Test that a WebSocket search failing on the database is answered with
+    the error, while any other failure is logged with its traceback.
+
+    Args:
+        monkeypatch (MonkeyPatch): For pointing the API at a failing client.
+        caplog (LogCaptureFixture): The captured log records.
+
+    Returns:
+        None
+    """
+    message = json.dumps({'film_type': 'show', 'query': 'dark', 'id': 7})
+
+    async def unreachable(**_):
+        raise ElasticConnectionError("Connection refused")
+
+    async def broken(**_):
+        return {}
+
+    async def search():
+        task = asyncio.ensure_future(main.socket_search(message, 0))
+        await asyncio.wait([task])
+        return json.loads(main.socket_results(task, main.socket_query_id(message)))
+
+    monkeypatch.setenv('ELASTIC_INDEX', 'test_index')
+    monkeypatch.setattr(main.app.state, 'esdb', SimpleNamespace(search=unreachable),
+                        raising=False)
+    reply = asyncio.run(search())
+    assert reply['id'] == 7
+    assert reply['error'].startswith("Search failed: ")
+
+    monkeypatch.setattr(main.app.state, 'esdb', SimpleNamespace(search=broken))
+    with caplog.at_level(logging.ERROR):
+        reply = asyncio.run(search())
+    assert reply['error'] == "Search failed"
+    # The client can still match the error to its query
+    assert reply['id'] == 7
+    assert isinstance(caplog.records[-1].exc_info[1], KeyError)
+    assert main.socket_query_id('{"query": "dark"}') is None
+    assert main.socket_query_id('not json') is None
+
+
 @pytest.mark.parametrize("agg_type", ["film", "movies", "shows"])
 def test_unknown_agg_endpoint(app_aggs_url, agg_type):
     """
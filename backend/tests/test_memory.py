@@ -0,0 +1,152 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the memory module,
+             which searches the catalogue without Elasticsearch.
+"""
+import asyncio
+from elasticsearch.helpers import async_scan
+from ..app.memory import MemoryElasticsearch
+from ..app.database import get_row
+from .constants import MOCK_TOTAL_AGG, MOCK_MOVIE_AGG
+from .test_database import CSV_FILEPATH
+
+
+def load_engine():
+    """
+    Load the bundled catalogue into an in-memory engine.
+
+    Returns:
+        (MemoryElasticsearch): The loaded engine.
+    """
+    esdb = MemoryElasticsearch('test_index')
+    esdb.load(get_row(CSV_FILEPATH, 'test_index'))
+    return esdb
+
+
+def test_aggregations():
+    """
+    Test that aggregations match those computed by Elasticsearch.
+
+    Returns:
+        None
+    """
+    esdb = load_engine()
+    aggs = {"total": {"value_count": {"field": "type"}},
+            "directors": {"terms": {"field": "director.keyword", "size": 5}},
+            "ratings": {"terms": {"field": "rating", "size": 5}},
+            "movies": {"filter": {"term": {"type": 1}},
+                       "aggs": {"avg_duration": {"avg": {"field": "duration"}},
+                                "histo_duration": {"histogram": {"field": "duration",
+                                                                 "interval": 20,
+                                                                 "min_doc_count": 10}}}}}
+    result = asyncio.run(esdb.search(query={"match_all": {}}, aggs=aggs, size=0))
+    result = result['aggregations']
+
+    assert result['total']['value'] == MOCK_TOTAL_AGG['total_agg']
+    assert ({bucket['key']: bucket['doc_count'] for bucket in result['directors']['buckets']}
+            == MOCK_TOTAL_AGG['director_agg'])
+    assert [bucket['doc_count'] for bucket in result['ratings']['buckets']] \
+        == list(MOCK_TOTAL_AGG['rating_agg'].values())
+    movies = result['movies']
+    assert movies['doc_count'] == MOCK_MOVIE_AGG['total_agg']
+    assert int(movies['avg_duration']['value']) == MOCK_MOVIE_AGG['avg_dur_agg']
+    assert ({str(int(bucket['key'])): bucket['doc_count']
+             for bucket in movies['histo_duration']['buckets']}
+            == MOCK_MOVIE_AGG['histo_dur_agg'])
+
+
+def test_filter_context():
+    """
+    Test that filter clauses narrow the matches without scoring them,
+    and that yearly date histograms count them.
+
+    Returns:
+        None
+    """
+    esdb = load_engine()
+    text = {"multi_match": {"query": "love", "fields": ["title", "description"]}}
+    filters = [{"term": {"type": 1}}, {"range": {"release_year": {"gte": 2018}}},
+               {"range": {"date_added": {"lt": "2020-01-01", "format": "yyyy-MM-dd"}}}]
+    aggs = {"added": {"date_histogram": {"field": "date_added", "calendar_interval": "year",
+                                         "format": "yyyy", "min_doc_count": 1}}}
+    scored = asyncio.run(esdb.search(query={"bool": {"must": [text]}}, size=10000))
+    result = asyncio.run(esdb.search(query={"bool": {"must": [text], "filter": filters}},
+                                     aggs=aggs, size=10000))
+
+    scores = {hit['_id']: hit['_score'] for hit in scored['hits']['hits']}
+    assert result['hits']['hits']
+    for hit in result['hits']['hits']:
+        assert hit['_score'] == scores[hit['_id']]
+        assert hit['_source']['release_year'] >= 2018
+        assert hit['_source']['date_added'][4:] < '2020'
+    buckets = result['aggregations']['added']['buckets']
+    assert {bucket['key_as_string'] for bucket in buckets} <= {'2018', '2019'}
+    assert sum(bucket['doc_count'] for bucket in buckets) == result['hits']['total']['value']
+
+
+def test_search():
+    """
+    Test that text queries match partial and misspelled words, require
+    every word, and page through results in a stable order.
+
+    Returns:
+        None
+    """
+    esdb = load_engine()
+    fields = ['title', 'director', 'cast', 'description', 'title.prefix']
+
+    def shows(text, **kwargs):
+        query = {"bool": {"filter": [{"term": {"type": 0}}],
+                          "must": [{"multi_match": {"query": text, "fields": fields,
+                                                    "operator": "and", **kwargs}}]}}
+        result = asyncio.run(esdb.search(query=query, size=3))
+        return [hit['_source']['title'] for hit in result['hits']['hits']]
+
+    assert shows("stranger thi")[0] == 'Stranger Things'
+    assert shows("Strânger Things")[0] == 'Stranger Things'
+    assert shows("strangr things") == []
+    assert shows("strangr things", fuzziness="AUTO", prefix_length=1)[0] == 'Stranger Things'
+    assert shows("stranger zzzz") == []
+
+    sort = ["_score", {"_shard_doc": "asc"}]
+    query = {"multi_match": {"query": "love", "fields": fields}}
+    first = asyncio.run(esdb.search(query=query, sort=sort, size=5))['hits']['hits']
+    after = asyncio.run(esdb.search(query=query, sort=sort, size=5,
+                                    search_after=first[-1]['sort']))['hits']['hits']
+    everything = asyncio.run(esdb.search(query=query, sort=sort, size=10))['hits']['hits']
+    assert [hit['_id'] for hit in first + after] == [hit['_id'] for hit in everything]
+
+
+def test_scan():
+    """
+    Test that the scroll API works with the scan helper.
+
+    Returns:
+        None
+    """
+    esdb = load_engine()
+
+    async def scan():
+        return [hit['_id'] async for hit in async_scan(esdb, index='test_index',
+                                                       query={"query": {"term": {"type": 0}}},
+                                                       _source=['title'], size=500)]
+
+    ids = asyncio.run(scan())
+    assert len(ids) == len(set(ids)) == 2676
+
+
+def test_msearch():
+    """
+    Test that a failed search in a batch does not fail the others.
+
+    Returns:
+        None
+    """
+    esdb = load_engine()
+    searches = [{}, {"query": {"term": {"type": 0}}, "size": 1},
+                {}, {"query": {"unknown": {}}},
+                {}, {"query": {"term": {"type": 1}}, "size": 2}]
+    responses = asyncio.run(esdb.msearch(searches=searches))['responses']
+    assert [response['status'] for response in responses] == [200, 400, 200]
+    assert len(responses[0]['hits']['hits']) == 1
+    assert len(responses[2]['hits']['hits']) == 2
@@ -0,0 +1,61 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the metrics module,
+             which exposes request and ingestion metrics.
+"""
+import time
+from ..app.metrics import Registry, Counter, Gauge, Histogram
+
+
+def test_render():
+    """
+    Test that counters and histograms render in the Prometheus format,
+    with cumulative buckets.
+
+    Returns:
+        None
+    """
+    registry = Registry()
+    requests = Counter('requests_total', "Requests.", ['route'], registry=registry)
+    latency = Histogram('latency_seconds', "Latency.", ['route'],
+                        buckets=(0.1, 1.0), registry=registry)
+    requests.inc(route='/api/film/{film_type}/')
+    requests.inc(2, route='/api/film/{film_type}/')
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, route='/api/aggs/')
+
+    lines = registry.render().splitlines()
+    assert '# TYPE requests_total counter' in lines
+    assert 'requests_total{route="/api/film/{film_type}/"} 3' in lines
+    assert 'latency_seconds_bucket{route="/api/aggs/",le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{route="/api/aggs/",le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{route="/api/aggs/",le="+Inf"} 3' in lines
+    assert 'latency_seconds_count{route="/api/aggs/"} 3' in lines
+
+
+def test_combined_workers(tmp_path, monkeypatch):
+    """
+    Test that workers sharing a directory report each other's metrics,
+    including those of an exited worker whose PID is reused.
+
+    Returns:
+        None
+    """
+    first, second = Registry(str(tmp_path)), Registry(str(tmp_path))
+    counters = [Counter('requests_total', "Requests.", registry=registry)
+                for registry in (first, second)]
+    gauges = [Gauge('rows_per_second', "Throughput.", registry=registry)
+              for registry in (first, second)]
+    counters[0].inc(2)
+    counters[1].inc(3)
+    monkeypatch.setattr(time, 'time', lambda: 100.0)
+    gauges[1].set(10.0)
+    monkeypatch.setattr(time, 'time', lambda: 200.0)
+    gauges[0].set(5.0)
+    # Both registries run in this process, like a worker restarted with the same PID
+    first.flush()
+
+    lines = second.render().splitlines()
+    assert 'requests_total 5' in lines
+    # The latest reading wins over a higher, older one
+    assert 'rows_per_second 5.0' in lines
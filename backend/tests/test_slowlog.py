@@ -0,0 +1,130 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the slowlog module,
+             which records slow queries and query profiles.
+"""
+import asyncio
+import logging
+from elasticsearch import ConnectionError as ElasticConnectionError
+from ..app.slowlog import SlowQueryLog, summarize_shard
+from ..app.memory import MemoryElasticsearch
+
+
+RESULT = {'took': 30, 'hits': {'total': {'value': 12, 'relation': 'eq'},
+                               'hits': [{'_id': 's1'}, {'_id': 's2'}]}}
+SEARCH_LABELS = {'route': '/api/film/{film_type}/', 'film_type': 'movie'}
+AGGS_LABELS = {'route': '/api/aggs/combined/', 'film_type': 'all'}
+
+SHARD = {
+    'id': '[node][netflix-1][0]',
+    'searches': [{
+        'query': [{'type': 'BooleanQuery', 'description': '+type:[1 TO 1] +title:love',
+                   'time_in_nanos': 3_000_000,
+                   'children': [{'type': 'TermQuery', 'description': 'title:love',
+                                 'time_in_nanos': 2_000_000}]}],
+        'rewrite_time': 500_000,
+        'collector': [{'name': 'SimpleTopScoreDocCollector', 'reason': 'search_top_hits',
+                       'time_in_nanos': 1_000_000}]}],
+    'aggregations': [{'type': 'GlobalOrdinalsStringTermsAggregator',
+                      'description': 'genre_agg', 'time_in_nanos': 4_000_000}],
+}
+
+
+def test_slow_queries():
+    """
+    Test that only queries over the threshold are kept, up to the buffer size,
+    with the time outside Elasticsearch split into network and processing.
+
+    Returns:
+        None
+    """
+    log = SlowQueryLog(threshold=0.1, size=2)
+    log.observe(SEARCH_LABELS, {'size': 2}, RESULT,
+                {'elasticsearch': 0.04, 'latency': 0.05, 'size': 100})
+    assert not log.slow
+
+    for latency in (0.2, 0.3, 0.4):
+        entry = log.observe(SEARCH_LABELS, {'size': 2}, RESULT,
+                            {'elasticsearch': 0.05, 'latency': latency, 'size': 100})
+    assert entry['took_ms'] == 30
+    assert entry['network_ms'] == 20
+    assert entry['processing_ms'] == 350
+    assert (entry['hits'], entry['total']) == (2, 12)
+    assert [entry['latency_ms'] for entry in log.stats()['slow']] == [400, 300]
+
+
+def test_profiles():
+    """
+    Test that profiled queries are run again in the background, and their
+    shard breakdown kept in a bounded buffer.
+
+    Returns:
+        None
+    """
+    log = SlowQueryLog(threshold=10, profile_size=1)
+
+    async def rerun():
+        return {**RESULT, 'profile': {'shards': [SHARD]}}
+
+    async def run():
+        for _ in range(2):
+            log.observe(AGGS_LABELS, {'size': 0}, RESULT,
+                        {'elasticsearch': 0.05, 'latency': 0.06, 'size': 100}, rerun=rerun)
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+    assert not log.slow
+    assert len(log.profiles) == 1
+    shard, = log.profiles[0]['shards']
+    assert shard == summarize_shard(SHARD)
+    assert (shard['query_ms'], shard['rewrite_ms'], shard['collector_ms'],
+            shard['aggregation_ms']) == (3, 0.5, 1, 4)
+    assert shard['query'][0]['children'][0]['time_ms'] == 2
+
+
+def test_failed_profiles(caplog):
+    """
+    Test that a profiled search failing on the database is logged as a
+    warning, while any other failure is logged with its traceback.
+
+    Returns:
+        None
+    """
+    log = SlowQueryLog(threshold=10)
+
+    async def unreachable():
+        raise ElasticConnectionError("Connection refused")
+
+    async def broken():
+        return {}['profile']
+
+    async def run():
+        for rerun in (unreachable, broken):
+            log.observe(AGGS_LABELS, {'size': 0}, RESULT,
+                        {'elasticsearch': 0.05, 'latency': 0.06, 'size': 100}, rerun=rerun)
+        await asyncio.sleep(0.01)
+
+    with caplog.at_level(logging.WARNING):
+        asyncio.run(run())
+    assert not log.profiles
+    warning, error = caplog.records
+    assert warning.getMessage().startswith("Profiling a query on /api/aggs/combined/ failed")
+    assert error.getMessage() == "Profiling a query failed"
+    assert isinstance(error.exc_info[1], KeyError)
+
+
+def test_memory_profile():
+    """
+    Test that the in-memory engine reports a profile shaped like Elasticsearch's.
+
+    Returns:
+        None
+    """
+    esdb = MemoryElasticsearch('test_index')
+    esdb.load([{'_id': 's1', '_source': {'type': 1, 'title': 'Love', 'rating': 1}}])
+    result = asyncio.run(esdb.search(query={'term': {'type': 1}}, profile=True,
+                                     aggs={'rating_agg': {'terms': {'field': 'rating'}}}))
+    shard, = result['profile']['shards']
+    summary = summarize_shard(shard)
+    assert summary['query'][0]['type'] == 'term'
+    assert summary['aggregations'][0]['description'] == 'rating_agg'
@@ -0,0 +1,54 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the snapshot module,
+             which stores the processed catalogue for fast loads.
+"""
+import shutil
+import asyncio
+from ..app.database import get_row, bulk_load
+from ..app.snapshot import build_snapshot, open_snapshot
+from .test_database import CSV_FILEPATH, FakeBulkClient
+
+
+def test_snapshot_matches_transform(tmp_path, monkeypatch):
+    """
+    Test that a snapshot holds the same documents as processing the
+    CSV file, and that loads use it.
+
+    Returns:
+        None
+    """
+    source = str(tmp_path / 'netflix.csv')
+    shutil.copy(CSV_FILEPATH, source)
+    monkeypatch.setenv('INGEST_SNAPSHOT', 'false')
+    expected = list(get_row(source, 'test_index'))
+
+    footer = build_snapshot(source)
+    assert footer['count'] == len(expected)
+    with open_snapshot(source) as snapshot:
+        assert list(snapshot.actions('test_index')) == expected
+        assert list(snapshot.actions('test_index', 10, 12)) == expected[10:12]
+
+    monkeypatch.setenv('INGEST_SNAPSHOT', 'true')
+    assert list(get_row(source, 'test_index')) == expected
+    esdb = FakeBulkClient()
+    report = asyncio.run(bulk_load(esdb, source, 'test_index', chunk_size=1000))
+    assert report['rows'] == len(expected)
+    assert esdb.docs == {action['_id']: action['_source'] for action in expected}
+
+
+def test_stale_snapshot(tmp_path):
+    """
+    Test that a snapshot is ignored once its source file changes.
+
+    Returns:
+        None
+    """
+    source = str(tmp_path / 'netflix.csv')
+    shutil.copy(CSV_FILEPATH, source)
+    build_snapshot(source)
+    with open(source, 'a', encoding='utf-8') as csv_file:
+        csv_file.write('s9999,Movie,New Film,,,,,2024,PG,90 min,Dramas,New.\n')
+
+    assert open_snapshot(source) is None
+    assert list(get_row(source, 'test_index'))[-1]['_id'] == 's9999'
@@ -0,0 +1,108 @@
+"""
+Created by: Brandon Goddard
+Description: This module is for testing the suggest module,
+             which serves search-as-you-type suggestions.
+"""
+import asyncio
+import logging
+from collections import Counter
+from ..app.suggest import PrefixIndex, Suggester, normalize
+from ..app.database import get_row
+from .test_database import CSV_FILEPATH
+
+
+def build_index(film_type=1):
+    """
+    Build a prefix index over the bundled catalogue.
+
+    Args:
+        film_type (int): The type of film to index, 1 for movies.
+
+    Returns:
+        (PrefixIndex): The prefix index.
+    """
+    counts = Counter()
+    for action in get_row(CSV_FILEPATH, 'test_index'):
+        source = action['_source']
+        if source['type'] != film_type:
+            continue
+        counts[('title', source['title'])] += 1
+        if source['director']:
+            counts[('director', source['director'])] += 1
+        for name in source['cast'] or []:
+            counts[('cast', name)] += 1
+    return PrefixIndex(counts)
+
+
+def test_prefix_search():
+    """
+    Test that names are suggested by the prefix of any of their words,
+    most common first, regardless of case and accents.
+
+    Returns:
+        None
+    """
+    index = build_index()
+    suggestions = index.search('anupam', size=3)
+    assert suggestions[0] == ('Anupam Kher', 'cast', 42)
+
+    # Later words match too, and accents in the prefix are ignored
+    assert ('Anupam Kher', 'cast', 42) in index.search('KHÉR', size=10)
+    assert index.search('shah rukh', size=1)[0][0] == 'Shah Rukh Khan'
+    assert index.search('') == []
+    assert index.search('thiscannotpossiblymatchanything') == []
+
+
+def test_prefix_search_matches_scan():
+    """
+    Test that precomputed and memoized results match a brute force scan.
+
+    Returns:
+        None
+    """
+    index = build_index(film_type=0)
+    for prefix in ['a', 'st', 'the', 'stranger t', 'john']:
+        expected = []
+        for entry in index.entries:
+            words = normalize(entry[0]).split(' ')
+            if any(' '.join(words[i:]).startswith(prefix) for i in range(len(words))):
+                expected.append(entry)
+        assert index.search(prefix, size=5) == expected[:5]
+
+
+def test_background_refresh(caplog):
+    """
+    Test that concurrent background rebuilds share one task, and that
+    its failure is logged rather than lost.
+
+    Returns:
+        None
+    """
+    class FailingClient:
+        """A client whose searches always fail."""
+        def __init__(self):
+            self.searches = 0
+
+        def options(self, **_):
+            """Ignore the request options."""
+            return self
+
+        async def search(self, **_):
+            """Count and fail the search."""
+            self.searches += 1
+            raise ConnectionError("Elasticsearch is down")
+
+    esdb = FailingClient()
+    suggester = Suggester()
+
+    async def run():
+        suggester.refresh_in_background(esdb, 'test_index', 1)
+        suggester.refresh_in_background(esdb, 'test_index', 1)
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(run())
+    assert esdb.searches == 1
+    assert suggester.generation is None
+    assert "Rebuilding the suggestions failed" in caplog.text
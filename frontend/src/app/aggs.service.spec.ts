@@ -56,9 +56,9 @@ describe('AggsService', () => {
       }
     );
 
-    const req = httpMock.expectOne('/api/aggs/');
+    const req = httpMock.expectOne('/api/aggs/combined/');
     expect(req.request.method).toBe('GET');
-    req.flush(expectedRes);
+    req.flush({'total': expectedRes, 'movie': {}, 'show': {}});
   });
 
   it('should test an HTTP GET request for movie aggs', () => {
@@ -81,9 +81,9 @@ describe('AggsService', () => {
       }
     );
 
-    const req = httpMock.expectOne('/api/aggs/movie/');
+    const req = httpMock.expectOne('/api/aggs/combined/');
     expect(req.request.method).toBe('GET');
-    req.flush(expectedData);
+    req.flush({'total': {}, 'movie': expectedData, 'show': {}});
   });
 
   it('should test an HTTP GET request for show aggs', () => {
@@ -94,8 +94,20 @@ describe('AggsService', () => {
       },
     );
 
-    const req = httpMock.expectOne('/api/aggs/show/');
+    const req = httpMock.expectOne('/api/aggs/combined/');
     expect(req.request.method).toBe('GET');
-    req.flush(expectedData);
+    req.flush({'total': {}, 'movie': {}, 'show': expectedData});
+  });
+
+  it('should share a single HTTP GET request between all aggs', () => {
+    const aggs = service.getData();
+    aggs.total.subscribe();
+    aggs.movie.subscribe();
+    aggs.show.subscribe();
+
+    const req = httpMock.expectOne('/api/aggs/combined/');
+    req.flush({'total': {'total_agg': 8807},
+               'movie': {'total_agg': 6131},
+               'show': {'total_agg': 2676}});
   });
 });
@@ -26,6 +26,11 @@ interface AggMovieData {
 interface AggShowData {
   total_agg: number
 }
+interface AggCombinedData {
+  total: AggData
+  movie: AggMovieData
+  show: AggShowData
+}
 
 
 @Injectable({
@@ -37,14 +42,17 @@ export class AggsService {
   private aggShowData$: Observable<AggShowData>;
 
   constructor(private http: HttpClient) {
-    this.aggData$ = this.http.get<AggData>('/api/aggs/').pipe(
-      map((data) => this.cleanData(data)),
+    // All aggregations are served by a single request, then sliced per type
+    const combinedData$ = this.http.get<AggCombinedData>('/api/aggs/combined/').pipe(
+      shareReplay(1));
+    this.aggData$ = combinedData$.pipe(
+      map((data) => this.cleanData(data.total)),
       shareReplay(1));
-    this.aggMovieData$ = this.http.get<AggMovieData>('/api/aggs/movie/').pipe(
-      map((data) => this.cleanData(data)),
+    this.aggMovieData$ = combinedData$.pipe(
+      map((data) => this.cleanData(data.movie)),
       shareReplay(1));
-    this.aggShowData$ = this.http.get<AggShowData>('/api/aggs/show/').pipe(
-      map((data) => this.cleanData(data)),
+    this.aggShowData$ = combinedData$.pipe(
+      map((data) => this.cleanData(data.show)),
       shareReplay(1));
   }
 
@@ -107,4 +107,20 @@ describe('SearchService', () => {
     expect(req.request.method).toBe('GET');
     req.flush(expectedRes);
   });
+
+  it('should test an HTTP GET request for suggestions', () => {
+    const filmType = 'show';
+    const prefix = 'stranger th';
+    const expectedRes = [{'text': 'Stranger Things', 'field': 'title', 'count': 1}];
+
+    service.getSuggestions(filmType, prefix).subscribe(
+      (response) => {
+        expect(response).toEqual(expectedRes);
+      }
+    );
+
+    const req = httpMock.expectOne(`/api/suggest/${filmType}/?prefix=${encodeURIComponent(prefix)}`);
+    expect(req.request.method).toBe('GET');
+    req.flush(expectedRes);
+  });
 });
@@ -1,6 +1,7 @@
 import { Injectable } from '@angular/core';
 import { HttpClient } from '@angular/common/http';
 import { Observable } from 'rxjs';
+import { webSocket, WebSocketSubject } from 'rxjs/webSocket';
 
 
 @Injectable({
@@ -12,4 +13,14 @@ export class SearchService {
   getSearchData(filmType: string, searchText: string): Observable<any> {
     return this.http.get<any>(`/api/film/${filmType}/`, {params: {"query": searchText}});
   }
+
+  getSuggestions(filmType: string, prefix: string): Observable<any> {
+    return this.http.get<any>(`/api/suggest/${filmType}/`, {params: {"prefix": prefix}});
+  }
+
+  connectSearch(): WebSocketSubject<any> {
+    // One connection streams every keystroke, the server answers the latest
+    const protocol = location.protocol === 'https:' ? 'wss' : 'ws';
+    return webSocket<any>(`${protocol}://${location.host}/api/ws/film/`);
+  }
 }
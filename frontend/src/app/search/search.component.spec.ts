@@ -1,5 +1,5 @@
 import { ComponentFixture, TestBed } from '@angular/core/testing';
-import { of, throwError } from 'rxjs';
+import { of, throwError, Subject } from 'rxjs';
 import { SearchComponent, SearchResult } from './search.component';
 import { SearchService } from '../search.service';
 
@@ -7,9 +7,11 @@ describe('SearchComponent', () => {
   let component: SearchComponent;
   let fixture: ComponentFixture<SearchComponent>;
   let mockSearchService: jasmine.SpyObj<SearchService>;
+  let socketMessages: Subject<any>;
+  let mockSocket: any;
 
   beforeEach(() => {
-    const searchServiceSpy = jasmine.createSpyObj('SearchService', ['getSearchData']);
+    const searchServiceSpy = jasmine.createSpyObj('SearchService', ['getSearchData', 'getSuggestions', 'connectSearch']);
     TestBed.configureTestingModule({
       declarations: [SearchComponent],
       providers: [
@@ -20,6 +22,12 @@ describe('SearchComponent', () => {
     fixture = TestBed.createComponent(SearchComponent);
     component = fixture.componentInstance;
     mockSearchService = TestBed.inject(SearchService) as jasmine.SpyObj<SearchService>;
+
+    // Messages pushed on socketMessages are received from the server
+    socketMessages = new Subject<any>();
+    mockSocket = jasmine.createSpyObj('WebSocketSubject', ['next', 'complete']);
+    mockSocket.subscribe = (next: any, error: any, complete: any) => socketMessages.subscribe(next, error, complete);
+    mockSearchService.connectSearch.and.returnValue(mockSocket);
   });
 
   it('should create the component', () => {
@@ -167,4 +175,60 @@ describe('SearchComponent', () => {
     expect(console.error).toHaveBeenCalledWith('Error fetching data:', errorMessage);
   });
 
+  it('should fetch suggestions while typing', () => {
+    const mockSuggestions = [{text: 'Stranger Things', field: 'title', count: 1}];
+    mockSearchService.getSuggestions.and.returnValue(of(mockSuggestions));
+    component.filmType = 'show';
+    component.searchText = 'stranger';
+
+    component.whileTyping();
+
+    expect(mockSearchService.getSuggestions).toHaveBeenCalledWith('show', 'stranger');
+    expect(component.suggestions).toEqual(mockSuggestions);
+
+    // Clearing the search bar clears the suggestions without a request
+    component.searchText = '';
+    component.whileTyping();
+    expect(component.suggestions).toEqual([]);
+    expect(mockSearchService.getSuggestions).toHaveBeenCalledTimes(1);
+  });
+
+  it('should stream keystrokes over one connection and show only the latest results', () => {
+    mockSearchService.getSuggestions.and.returnValue(of([]));
+    const film = {...component.nullSearch, title: 'Stranger Things', date_added: '07152016'};
+    component.filmType = 'show';
+
+    component.searchText = 'strang';
+    component.whileTyping();
+    component.searchText = 'stranger';
+    component.whileTyping();
+
+    expect(mockSearchService.connectSearch).toHaveBeenCalledTimes(1);
+    expect(mockSocket.next).toHaveBeenCalledWith({film_type: 'show', query: 'strang', id: 1});
+    expect(mockSocket.next).toHaveBeenCalledWith({film_type: 'show', query: 'stranger', id: 2});
+
+    // Results of the superseded query are ignored
+    socketMessages.next({id: 1, total: 5, error: null, films: [component.nullSearch]});
+    expect(component.searchResult).toEqual([]);
+
+    socketMessages.next({id: 2, total: 1, error: null, films: [film]});
+    expect(component.searchResult[0].title).toEqual('Stranger Things');
+    expect(component.searchResult[0].date_added).toEqual('07/15/2016');
+
+    component.ngOnDestroy();
+    expect(mockSocket.complete).toHaveBeenCalled();
+  });
+
+  it('should reconnect after the connection fails', () => {
+    mockSearchService.getSuggestions.and.returnValue(of([]));
+    component.searchText = 'love';
+    component.whileTyping();
+
+    socketMessages.error('Connection lost');
+    socketMessages = new Subject<any>();
+    component.whileTyping();
+
+    expect(mockSearchService.connectSearch).toHaveBeenCalledTimes(2);
+  });
+
 });
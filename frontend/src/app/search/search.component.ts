@@ -1,4 +1,5 @@
-import { Component } from '@angular/core';
+import { Component, OnDestroy } from '@angular/core';
+import { WebSocketSubject } from 'rxjs/webSocket';
 import { SearchService } from '../search.service';
 import { setFadeInOut } from '../app.animation';
 
@@ -16,25 +17,46 @@ export interface SearchResult {
   description: string | null
 }
 
+export interface Suggestion {
+  text: string
+  field: string
+  count: number
+}
+
+export interface LiveResult {
+  id: number | null
+  total: number | null
+  error: string | null
+  films: SearchResult[] | null
+}
+
 @Component({
   selector: 'app-search',
   templateUrl: './search.component.html',
   styleUrls: ['./search.component.css'],
   animations: [setFadeInOut]
 })
-export class SearchComponent {
+export class SearchComponent implements OnDestroy {
   nullSearch = {title: "", director: "", cast: [], country: "",
                         date_added: "", release_year: -1, rating: "",
                         duration: -1, genres: [], description: ""};
   filmType = "movie";
   searchText = "";
   searchResult: SearchResult[] = [];
+  suggestions: Suggestion[] = [];
   validResults = true;
   errorRequest = false;
   anim_delays: number[] = Array.from({ length: 8 }, (_, index) => (index + 1) * 100);
+  private socket?: WebSocketSubject<any>;
+  private queryId = 0;
 
   constructor(private searchService: SearchService) {}
 
+  ngOnDestroy() {
+    // Closing the connection cancels any search still running
+    this.socket?.complete();
+  }
+
   
   isCastArray(index: number): boolean {
     // Check if cast is an array and if it has at least one element
@@ -49,12 +71,29 @@ export class SearchComponent {
 
   onFilmTypeChange() {
     // Reset search results when user changes the film type
+    this.queryId += 1;
     this.searchResult = [];
+    this.suggestions = [];
   }
 
   whileTyping() {
-    // Reset search results when user types in the search bar
-    this.searchResult = [];
+    // Reset search results when user clears the search bar
+    if (!this.searchText) {
+      this.queryId += 1;
+      this.searchResult = [];
+      this.suggestions = [];
+      return;
+    }
+    this.searchLive();
+    // Suggest completions for the text typed so far
+    this.searchService.getSuggestions(this.filmType, this.searchText).subscribe(
+      (result: Suggestion[]) => {
+        this.suggestions = result;
+      },
+      () => {
+        this.suggestions = [];
+      }
+    )
   }
 
   enterKey(event: KeyboardEvent) {
@@ -64,25 +103,54 @@ export class SearchComponent {
     }
   }
 
+  searchLive() {
+    // Send the text typed so far, the server debounces it and answers the latest query
+    if (!this.socket) {
+      this.socket = this.searchService.connectSearch();
+      this.socket.subscribe(
+        (message: LiveResult) => {
+          // Results of an older query are superseded by the one in flight
+          if (message.id !== this.queryId) {
+            return;
+          }
+          if (message.error) {
+            console.error('Error searching:', message.error);
+          } else {
+            this.showResults(message.films!);
+          }
+        },
+        // Reconnect on the next keystroke, Enter still searches over HTTP
+        () => this.socket = undefined,
+        () => this.socket = undefined
+      );
+    }
+    this.queryId += 1;
+    this.socket.next({film_type: this.filmType, query: this.searchText, id: this.queryId});
+  }
+
+  showResults(result: SearchResult[]) {
+    this.searchResult = result;
+    if (this.searchResult.length == 0) {
+      this.validResults = false;
+    } else {
+      this.validResults = true;
+      this.errorRequest = false;
+      // Turn date_added into a human readable date
+      for (let i = 0; i < this.searchResult.length; i++) {
+        if (typeof this.searchResult[i].date_added == "string" ) {
+          let date = this.searchResult[i].date_added!.slice(0, 2) + '/' + this.searchResult[i].date_added!.slice(2);
+          date = date.slice(0, 5) + '/' + date.slice(5);
+          this.searchResult[i].date_added = date;
+        }
+      }
+    }
+  }
+
   onSearch() {
     // Get search results from the API
     this.searchService.getSearchData(this.filmType, this.searchText).subscribe(
       (result: SearchResult[]) => {
-        this.searchResult = result;
-        if (this.searchResult.length == 0) {
-          this.validResults = false;
-        } else {
-          this.validResults = true;
-          this.errorRequest = false;
-          // Turn date_added into a human readable date
-          for (let i = 0; i < this.searchResult.length; i++) {
-            if (typeof this.searchResult[i].date_added == "string" ) {
-              let date = this.searchResult[i].date_added!.slice(0, 2) + '/' + this.searchResult[i].date_added!.slice(2);
-              date = date.slice(0, 5) + '/' + date.slice(5);
-              this.searchResult[i].date_added = date;
-            }
-          }
-        }
+        this.showResults(result);
       },
       (error) => {
         this.searchResult = [];